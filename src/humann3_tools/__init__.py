@@ -15,13 +15,17 @@ __version__ = "0.1.0"
 
 # Import key functions for easy access
 from src.humann3_tools.logger import setup_logger, log_print
+from src.humann3_tools.utils.lazy_imports import lazy_attributes
 
-# Import main functions
-from src.humann3_tools.core.humann3 import (
-    run_full_pipeline,
-    process_humann3_files_only,
-    analyze_existing_humann3_files,
-    run_pathway_differential_abundance,
-    run_gene_differential_abundance,
-    run_preprocessing_and_analysis  
-)
+# Main functions, imported on first use: core.humann3 loads the analysis
+# modules (matplotlib, sklearn, statsmodels), which the CLIs import this
+# package for but mostly do not need
+_CORE = "src.humann3_tools.core.humann3"
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "run_full_pipeline": _CORE,
+    "process_humann3_files_only": _CORE,
+    "analyze_existing_humann3_files": _CORE,
+    "run_pathway_differential_abundance": _CORE,
+    "run_gene_differential_abundance": _CORE,
+    "run_preprocessing_and_analysis": _CORE,
+})
@@ -1,19 +1,30 @@
 # humann3_tools/analysis/__init__.py
 """Analysis functions for processed HUMAnN3 data."""
 
-from src.humann3_tools.analysis.differential_abundance import (
-    aldex2_like,
-    ancom,
-    ancom_bc,
-    run_differential_abundance_analysis
-)
+from src.humann3_tools.utils.lazy_imports import lazy_attributes
 
-from src.humann3_tools.analysis.statistical import (
-    kruskal_wallis_dunn,
-    run_statistical_tests
-)
-
-from src.humann3_tools.analysis.visualizations import (
-    read_and_process_gene_families,
-    read_and_process_pathways
-)
+# Re-exports are imported on first use, so importing one analysis module (e.g.
+# abundance_matrix) does not load matplotlib, sklearn and statsmodels
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "aldex2_like": "src.humann3_tools.analysis.differential_abundance",
+    "ancom": "src.humann3_tools.analysis.differential_abundance",
+    "ancom_bc": "src.humann3_tools.analysis.differential_abundance",
+    "run_differential_abundance_analysis": "src.humann3_tools.analysis.differential_abundance",
+    "kruskal_wallis_dunn": "src.humann3_tools.analysis.statistical",
+    "kruskal_wallis_wide": "src.humann3_tools.analysis.statistical",
+    "dunn_posthoc_wide": "src.humann3_tools.analysis.statistical",
+    "save_dunn_results": "src.humann3_tools.analysis.statistical",
+    "run_statistical_tests": "src.humann3_tools.analysis.statistical",
+    "AbundanceMatrix": "src.humann3_tools.analysis.abundance_matrix",
+    "read_abundance_matrix": "src.humann3_tools.analysis.abundance_matrix",
+    "GroupedAbundance": "src.humann3_tools.analysis.grouped_abundance",
+    "sample_group_vector": "src.humann3_tools.analysis.grouped_abundance",
+    "PCAResult": "src.humann3_tools.analysis.pca",
+    "run_pca": "src.humann3_tools.analysis.pca",
+    "distance_matrix": "src.humann3_tools.analysis.beta_diversity",
+    "read_distance_matrix": "src.humann3_tools.analysis.beta_diversity",
+    "pcoa": "src.humann3_tools.analysis.beta_diversity",
+    "permanova": "src.humann3_tools.analysis.beta_diversity",
+    "read_and_process_gene_families": "src.humann3_tools.analysis.visualizations",
+    "read_and_process_pathways": "src.humann3_tools.analysis.visualizations",
+})
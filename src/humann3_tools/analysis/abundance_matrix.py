@@ -0,0 +1,300 @@
+# humann3_tools/analysis/abundance_matrix.py
+"""
+Sparse abundance matrices for HUMAnN3 tables.
+
+Unstratified gene family tables are mostly zeros, so they are held as a
+features x samples scipy.sparse CSR matrix with feature and sample indexes
+instead of a dense DataFrame. Transformations that turn zeros into non-zero
+values (log with a pseudocount, CLR) are stored as the sparse part plus a
+per-sample offset, so they can be used without densifying the table.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.humann3_tools.utils.table_cache import read_table_cache
+
+class AbundanceMatrix:
+    """
+    Features x samples abundance table backed by a scipy.sparse CSR matrix.
+    
+    The value of feature i in sample j is matrix[i, j] - offset[j]; the offset is
+    zero for raw abundances and is set by log_transform() and clr().
+    
+    Attributes:
+        matrix: scipy.sparse.csr_matrix of shape (n_features, n_samples)
+        features: pandas Index of feature IDs
+        samples: pandas Index of sample IDs
+        offset: Array of per-sample offsets subtracted from every value
+        index_name: Name of the feature column (e.g. "# Gene Family")
+    """
+    
+    def __init__(self, matrix, features, samples, offset=None, index_name=None):
+        self.matrix = sparse.csr_matrix(matrix, dtype=float)
+        self.features = pd.Index(features)
+        self.samples = pd.Index(samples)
+        if self.matrix.shape != (len(self.features), len(self.samples)):
+            raise ValueError(f"Matrix shape {self.matrix.shape} does not match "
+                             f"{len(self.features)} features and {len(self.samples)} samples")
+        self.offset = np.zeros(len(self.samples)) if offset is None else np.asarray(offset, dtype=float)
+        self.index_name = index_name
+    
+    @classmethod
+    def from_dataframe(cls, df):
+        """Build a sparse matrix from a dense features x samples DataFrame."""
+        return cls(sparse.csr_matrix(df.to_numpy(dtype=float)), df.index, df.columns,
+                   index_name=df.index.name)
+    
+    @property
+    def shape(self):
+        return self.matrix.shape
+    
+    @property
+    def index(self):
+        """Feature IDs (DataFrame-style alias for features)."""
+        return self.features
+    
+    @property
+    def columns(self):
+        """Sample IDs (DataFrame-style alias for samples)."""
+        return self.samples
+    
+    @property
+    def empty(self):
+        return self.matrix.shape[0] == 0 or self.matrix.shape[1] == 0
+    
+    @property
+    def density(self):
+        """Fraction of stored (non-zero) entries."""
+        n_cells = self.matrix.shape[0] * self.matrix.shape[1]
+        return self.matrix.nnz / n_cells if n_cells else 0.0
+    
+    def _derive(self, matrix, features=None, samples=None, offset=None):
+        """New matrix sharing this one's metadata."""
+        return AbundanceMatrix(
+            matrix,
+            self.features if features is None else features,
+            self.samples if samples is None else samples,
+            offset=self.offset if offset is None else offset,
+            index_name=self.index_name
+        )
+    
+    def to_dataframe(self):
+        """Dense DataFrame of the (transformed) values."""
+        values = self.matrix.toarray()
+        if self.offset.any():
+            values -= self.offset
+        df = pd.DataFrame(values, index=self.features, columns=self.samples)
+        df.index.name = self.index_name
+        return df
+    
+    def to_long(self, feature_col="Feature", sample_col="Sample", value_col="Abundance"):
+        """
+        Long-format DataFrame of the stored (non-zero) entries only.
+        
+        Args:
+            feature_col: Name of the feature column
+            sample_col: Name of the sample column
+            value_col: Name of the value column
+        
+        Returns:
+            DataFrame with one row per non-zero entry
+        """
+        coo = self.matrix.tocoo()
+        return pd.DataFrame({
+            feature_col: self.features[coo.row],
+            sample_col: self.samples[coo.col],
+            value_col: coo.data - self.offset[coo.col],
+        })
+    
+    def select_samples(self, samples):
+        """Matrix restricted to (and ordered by) the given samples."""
+        positions = self.samples.get_indexer(pd.Index(samples))
+        if (positions < 0).any():
+            missing = list(pd.Index(samples)[positions < 0][:5])
+            raise KeyError(f"Samples not found in abundance matrix: {missing}")
+        return self._derive(self.matrix[:, positions], samples=self.samples[positions],
+                            offset=self.offset[positions])
+    
+    def select_features(self, features):
+        """Matrix restricted to the given feature IDs or boolean mask."""
+        if isinstance(features, np.ndarray) and features.dtype == bool:
+            positions = np.flatnonzero(features)
+        else:
+            positions = self.features.get_indexer(pd.Index(features))
+            if (positions < 0).any():
+                missing = list(pd.Index(features)[positions < 0][:5])
+                raise KeyError(f"Features not found in abundance matrix: {missing}")
+        return self._derive(self.matrix[positions], features=self.features[positions])
+    
+    def drop_zero_features(self):
+        """Matrix without features that are zero in every sample (raw abundances only)."""
+        self._require_raw("drop_zero_features")
+        return self.select_features(np.diff(self.matrix.indptr) > 0)
+    
+    def _require_raw(self, operation):
+        if self.offset.any():
+            raise ValueError(f"{operation} needs untransformed abundances")
+    
+    def log_transform(self, base=10, pseudocount=1.0):
+        """
+        log(x + pseudocount) without densifying.
+        
+        Stored as log(1 + x / pseudocount) with a constant offset of -log(pseudocount),
+        so zeros stay implicit; with the default pseudocount of 1 the offset is zero.
+        
+        Args:
+            base: Logarithm base (default: 10, matching log10(x+1) in the plots)
+            pseudocount: Value added before taking the logarithm
+        
+        Returns:
+            Transformed AbundanceMatrix
+        """
+        self._require_raw("log_transform")
+        matrix = self.matrix.copy()
+        matrix.data = np.log1p(matrix.data / pseudocount) / np.log(base)
+        offset = np.full(len(self.samples), -np.log(pseudocount) / np.log(base))
+        return self._derive(matrix, offset=offset)
+    
+    def clr(self, pseudocount=None):
+        """
+        Centered log-ratio transform of each sample without densifying.
+        
+        clr(x) = log(x + p) - mean(log(x + p)); log(p) cancels, so the sparse part
+        is log(1 + x / p) and each sample's offset is the mean of that part.
+        
+        Args:
+            pseudocount: Value added to every abundance (default: half the smallest
+                         non-zero abundance, as the differential abundance methods use)
+        
+        Returns:
+            CLR-transformed AbundanceMatrix (natural logarithm)
+        """
+        self._require_raw("clr")
+        if pseudocount is None:
+            positive = self.matrix.data[self.matrix.data > 0]
+            pseudocount = positive.min() / 2 if positive.size else 1.0
+        matrix = self.matrix.copy()
+        matrix.data = np.log1p(matrix.data / pseudocount)
+        n_features = max(self.matrix.shape[0], 1)
+        offset = np.asarray(matrix.sum(axis=0)).ravel() / n_features
+        return self._derive(matrix, offset=offset)
+    
+    def feature_means(self):
+        """Mean value of each feature across samples."""
+        n_samples = max(self.matrix.shape[1], 1)
+        means = np.asarray(self.matrix.sum(axis=1)).ravel() / n_samples - self.offset.mean()
+        return pd.Series(means, index=self.features)
+    
+    def feature_variances(self, ddof=1):
+        """Variance of each feature across samples."""
+        n = self.matrix.shape[1]
+        if n - ddof <= 0:
+            return pd.Series(np.nan, index=self.features)
+        row_sum = np.asarray(self.matrix.sum(axis=1)).ravel()
+        row_sq = np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel()
+        # sum((m - o)^2) and sum(m - o) expanded so only stored entries are touched
+        cross = self.matrix @ self.offset
+        sum_sq = row_sq - 2 * cross + (self.offset ** 2).sum()
+        total = row_sum - self.offset.sum()
+        variances = (sum_sq - total ** 2 / n) / (n - ddof)
+        return pd.Series(np.maximum(variances, 0), index=self.features)
+    
+    def group_means(self, sample_groups):
+        """
+        Mean value of each feature within each group of samples.
+        
+        Args:
+            sample_groups: Series mapping sample IDs to groups (samples not in the
+                           matrix are ignored; the first entry of a repeated sample is used)
+        
+        Returns:
+            DataFrame of features x groups
+        """
+        sample_groups = sample_groups[~sample_groups.index.duplicated()]
+        sample_groups = sample_groups[sample_groups.index.isin(self.samples)]
+        groups = pd.Index(sample_groups.unique())
+        rows = self.samples.get_indexer(sample_groups.index)
+        cols = groups.get_indexer(sample_groups.to_numpy())
+        indicator = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(self.samples), len(groups))
+        )
+        counts = np.asarray(indicator.sum(axis=0)).ravel()
+        sums = np.asarray((self.matrix @ indicator).todense()) - self.offset @ indicator
+        return pd.DataFrame(sums / counts, index=self.features, columns=groups)
+    
+    def top_features(self, n, by="mean"):
+        """
+        IDs of the n features with the highest mean (or variance) across samples.
+        
+        Args:
+            n: Number of features
+            by: "mean" or "variance"
+        
+        Returns:
+            pandas Index of feature IDs, highest first
+        """
+        if by == "mean":
+            scores = self.feature_means()
+        elif by == "variance":
+            scores = self.feature_variances()
+        else:
+            raise ValueError(f"Unknown ranking for top features: {by}")
+        order = np.argsort(-scores.to_numpy(), kind="stable")[:n]
+        return self.features[order]
+
+def read_abundance_matrix(abundance_file, chunksize=50000, logger=None):
+    """
+    Read a HUMAnN3 table into a sparse AbundanceMatrix.
+    
+    Rows are parsed in chunks and each chunk is converted to CSR before the next is
+    read, so the full table is never held as a dense array. A current columnar
+    sidecar (see utils.table_cache) is used instead of parsing the TSV.
+    
+    Args:
+        abundance_file: Path to a tab-delimited table with features as rows
+        chunksize: Number of rows parsed at a time
+        logger: Logger instance
+    
+    Returns:
+        AbundanceMatrix
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    cached = read_table_cache(abundance_file, logger=logger)
+    if cached is not None:
+        values, features, samples, index_name = cached
+        # The sidecar is column-major, so convert contiguous blocks of samples,
+        # each about the size of a chunksize-row chunk of a 64-sample table
+        step = max(1, chunksize * 64 // max(len(features), 1))
+        blocks = [sparse.csc_matrix(values[:, start:start + step])
+                  for start in range(0, len(samples), step)]
+        matrix = sparse.hstack(blocks, format="csr") if blocks else sparse.csr_matrix((len(features), 0))
+        result = AbundanceMatrix(matrix, features, samples, index_name=index_name)
+        logger.info(f"Loaded sparse abundance matrix from columnar cache with {result.shape[0]} features "
+                    f"and {result.shape[1]} samples ({result.density:.1%} non-zero)")
+        return result
+    
+    blocks = []
+    features = []
+    samples = None
+    index_name = None
+    for chunk in pd.read_csv(abundance_file, sep='\t', index_col=0, chunksize=chunksize):
+        if samples is None:
+            samples = chunk.columns
+            index_name = chunk.index.name
+        blocks.append(sparse.csr_matrix(chunk.to_numpy(dtype=float)))
+        features.append(chunk.index)
+    
+    if samples is None:
+        raise ValueError(f"No data found in abundance file: {abundance_file}")
+    
+    matrix = sparse.vstack(blocks, format="csr")
+    matrix.eliminate_zeros()
+    result = AbundanceMatrix(matrix, features[0].append(features[1:]), samples, index_name=index_name)
+    logger.info(f"Loaded sparse abundance matrix with {result.shape[0]} features and "
+                f"{result.shape[1]} samples ({result.density:.1%} non-zero)")
+    return result
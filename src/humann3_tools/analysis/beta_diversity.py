@@ -0,0 +1,323 @@
+# humann3_tools/analysis/beta_diversity.py
+"""
+Beta-diversity distances, PCoA ordination and PERMANOVA for abundance tables.
+
+Distances between samples are computed in blocks of samples, each block
+against the samples from its own start onwards (the other half is mirrored),
+on a thread pool; every block is computed with whole-array NumPy/BLAS and
+scipy.sparse operations, so threads overlap wherever those release the GIL
+(matrix products, large element-wise operations). Tables can be dense
+DataFrames or sparse AbundanceMatrix objects (gene families), which are never
+densified:
+- braycurtis: sum|x - y| / sum(x + y), via the sum of shared minima, which on
+  sparse input only touches the features both samples contain
+- jaccard: presence/absence, from a matrix product of the 0/1 table
+- aitchison: Euclidean distance of CLR values, from the Gram matrix of the
+  sparse CLR part and the per-sample offsets (AbundanceMatrix.clr)
+Distance matrices can be cached on disk, keyed by a hash of the input, so
+plots and PERMANOVA reuse them.
+"""
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix
+from src.humann3_tools.analysis.pca import PCAResult, table_hash
+
+DISTANCE_METRICS = ("braycurtis", "jaccard", "aitchison")
+DISTANCE_CACHE_VERSION = 1
+# Samples per block of distance rows
+SAMPLE_BLOCK = 64
+# Largest temporary (elements) of a dense Bray-Curtis block; features are chunked to fit
+BLOCK_ELEMENTS = 1 << 22
+# Values gathered per batch for a sparse Bray-Curtis block (kept cache-sized)
+SPARSE_GATHER_ELEMENTS = 1 << 18
+PERMANOVA_PERMUTATIONS = 999
+
+def _samples_by_features(table):
+    """Raw values as a samples x features CSR matrix or dense array."""
+    if isinstance(table, AbundanceMatrix):
+        if table.offset.any():
+            raise ValueError("Distances need untransformed abundances")
+        return table.matrix.T.tocsr()
+    return table.to_numpy(dtype=float).T
+
+def _row_sums(X):
+    return np.asarray(X.sum(axis=1)).ravel()
+
+def _gram(X, start, stop):
+    """X[start:stop] @ X[start:].T as a dense array."""
+    product = X[start:stop] @ X[start:].T
+    return product.toarray() if sparse.issparse(product) else np.asarray(product)
+
+class _BrayCurtis:
+    def __init__(self, table):
+        self.X = _samples_by_features(table)
+        self.totals = _row_sums(self.X)
+        if sparse.issparse(self.X):
+            # Features x samples, to gather the samples sharing a sample's features
+            self.by_feature = self.X.T.tocsr()
+    
+    def _shared_minima(self, start, stop):
+        n = self.X.shape[0]
+        if sparse.issparse(self.X):
+            block = self.X[start:stop]
+            # Offset of each block entry's row in the flattened (rows x samples) sums
+            row_offsets = np.repeat(np.arange(stop - start) * n, np.diff(block.indptr))
+            # Running count of the values gathered for the block's entries (one per
+            # sample sharing the entry's feature), to batch the gathers
+            gathered = np.cumsum(np.diff(self.by_feature.indptr)[block.indices])
+            minima = np.zeros((stop - start) * n)
+            first = 0
+            while first < block.nnz:
+                done = gathered[first - 1] if first else 0
+                last = max(first + 1, int(np.searchsorted(gathered, done + SPARSE_GATHER_ELEMENTS, side="right")))
+                shared = self.by_feature[block.indices[first:last]]
+                counts = np.diff(shared.indptr)
+                minima += np.bincount(np.repeat(row_offsets[first:last], counts) + shared.indices,
+                                      weights=np.minimum(shared.data, np.repeat(block.data[first:last], counts)),
+                                      minlength=minima.size)
+                first = last
+            return minima.reshape(stop - start, n)[:, start:]
+        block = self.X[start:stop]
+        others = self.X[start:]
+        minima = np.zeros((stop - start, n - start))
+        step = max(1, BLOCK_ELEMENTS // max(block.shape[0] * others.shape[0], 1))
+        for first in range(0, self.X.shape[1], step):
+            minima += np.minimum(block[:, None, first:first + step], others[None, :, first:first + step]).sum(axis=2)
+        return minima
+    
+    def block(self, start, stop):
+        pair_totals = self.totals[start:stop, None] + self.totals[None, start:]
+        minima = self._shared_minima(start, stop)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distances = 1.0 - 2.0 * minima / pair_totals
+        distances[pair_totals == 0] = 0.0
+        return distances
+
+class _Jaccard:
+    def __init__(self, table):
+        X = _samples_by_features(table)
+        if sparse.issparse(X):
+            self.P = X.copy()
+            self.P.data = (self.P.data > 0).astype(float)
+            self.P.eliminate_zeros()
+        else:
+            self.P = (X > 0).astype(float)
+        self.counts = _row_sums(self.P)
+    
+    def block(self, start, stop):
+        shared = _gram(self.P, start, stop)
+        union = self.counts[start:stop, None] + self.counts[None, start:] - shared
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distances = 1.0 - shared / union
+        distances[union == 0] = 0.0
+        return distances
+
+class _Aitchison:
+    def __init__(self, table, pseudocount=None):
+        if not isinstance(table, AbundanceMatrix):
+            # Same CLR (and default pseudocount) as the sparse matrix, on dense values
+            table = AbundanceMatrix(sparse.csr_matrix(table.to_numpy(dtype=float)), table.index, table.columns)
+        clr = table.clr(pseudocount)
+        # CLR value = M - offset; keep M sparse (or dense when mostly non-zero)
+        M = clr.matrix.T.tocsr()
+        self.M = M.toarray() if clr.density > 0.5 else M
+        self.offset = clr.offset
+        self.sums = _row_sums(self.M)
+        self.squares = _row_sums(self.M.multiply(self.M) if sparse.issparse(self.M) else self.M ** 2)
+        self.n_features = self.M.shape[1]
+    
+    def block(self, start, stop):
+        rows, cols = slice(start, stop), slice(start, None)
+        offset_diff = self.offset[rows, None] - self.offset[None, cols]
+        squared = (self.squares[rows, None] + self.squares[None, cols] - 2 * _gram(self.M, start, stop)
+                   - 2 * offset_diff * (self.sums[rows, None] - self.sums[None, cols])
+                   + self.n_features * offset_diff ** 2)
+        return np.sqrt(np.maximum(squared, 0.0))
+
+def _cache_file(cache_dir, table, metric, pseudocount):
+    settings = (DISTANCE_CACHE_VERSION, metric, pseudocount if metric == "aitchison" else None)
+    return os.path.join(cache_dir, f"distances_{metric}_{table_hash(table, settings)}.npz")
+
+def read_distance_matrix(cache_file):
+    """
+    Distance matrix saved by distance_matrix(cache_dir=...).
+    
+    Returns:
+        Samples x samples DataFrame, or None if the file cannot be read
+    """
+    try:
+        with np.load(cache_file, allow_pickle=False) as cached:
+            samples = [str(sample) for sample in cached["samples"]]
+            return pd.DataFrame(cached["distances"], index=samples, columns=samples)
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _write_distance_matrix(cache_file, distances, logger):
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        np.savez(tmp_file, distances=distances.to_numpy(), samples=np.array(distances.index, dtype=str))
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.warning(f"Could not cache distance matrix in {cache_file}: {str(e)}")
+
+def distance_matrix(table, metric="braycurtis", pseudocount=None, block_size=SAMPLE_BLOCK, n_jobs=None,
+                    cache_dir=None, logger=None):
+    """
+    Pairwise distances between the samples (columns) of a features x samples table.
+    
+    Args:
+        table: Raw (untransformed) abundances, DataFrame or AbundanceMatrix
+        metric: "braycurtis", "jaccard" or "aitchison"
+        pseudocount: Value added before the CLR for aitchison (default: half the
+                     smallest non-zero abundance, see AbundanceMatrix.clr)
+        block_size: Samples per block of rows
+        n_jobs: Threads computing blocks (default: all CPUs)
+        cache_dir: Directory for cached matrices (None = no caching)
+        logger: Logger instance
+    
+    Returns:
+        Symmetric samples x samples DataFrame of distances
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"Unknown distance metric: {metric} (choose from {', '.join(DISTANCE_METRICS)})")
+    samples = [str(sample) for sample in table.columns]
+    
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = _cache_file(cache_dir, table, metric, pseudocount)
+        if os.path.isfile(cache_file):
+            cached = read_distance_matrix(cache_file)
+            if cached is not None and list(cached.index) == samples:
+                logger.info(f"Using cached {metric} distances from {cache_file}")
+                return cached
+    
+    start_time = time.time()
+    if metric == "braycurtis":
+        engine = _BrayCurtis(table)
+    elif metric == "jaccard":
+        engine = _Jaccard(table)
+    else:
+        engine = _Aitchison(table, pseudocount)
+    
+    n = len(samples)
+    distances = np.zeros((n, n))
+    starts = range(0, n, block_size)
+    
+    def fill(start):
+        stop = min(start + block_size, n)
+        distances[start:stop, start:] = engine.block(start, stop)
+    
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(fill, starts))
+    else:
+        for start in starts:
+            fill(start)
+    
+    # Mirror the upper triangle and clear rounding noise on the diagonal
+    distances = np.triu(distances, 1)
+    distances = distances + distances.T
+    result = pd.DataFrame(distances, index=samples, columns=samples)
+    logger.info(f"Computed {metric} distances between {n} samples over {table.shape[0]} features "
+                f"in {time.time() - start_time:.2f} seconds")
+    
+    if cache_file is not None:
+        _write_distance_matrix(cache_file, result, logger)
+    return result
+
+def pcoa(distances, n_components=10):
+    """
+    Principal coordinates analysis of a distance matrix.
+    
+    Eigendecomposition of the double-centred matrix -D^2 / 2. Only components with
+    positive eigenvalues are returned; proportions are relative to the sum of
+    the positive eigenvalues.
+    
+    Args:
+        distances: Samples x samples distance DataFrame
+        n_components: Most components to return
+    
+    Returns:
+        PCAResult with "PCo1", "PCo2", ... scores, the eigenvalues as
+        explained_variance and no loadings (components is None)
+    """
+    D = distances.to_numpy(dtype=float)
+    n = D.shape[0]
+    A = -0.5 * D ** 2
+    # Double centring without forming the centring matrix
+    B = A - A.mean(axis=0)[None, :] - A.mean(axis=1)[:, None] + A.mean()
+    eigenvalues, eigenvectors = np.linalg.eigh(B)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+    positive = eigenvalues > 1e-10 * abs(eigenvalues[0]) if n else np.zeros(0, dtype=bool)
+    total = eigenvalues[positive].sum()
+    k = min(n_components, int(positive.sum()))
+    scores = eigenvectors[:, :k] * np.sqrt(eigenvalues[:k])
+    # Deterministic signs: largest absolute score of every axis positive
+    if k:
+        signs = np.sign(scores[np.argmax(np.abs(scores), axis=0), np.arange(k)])
+        signs[signs == 0] = 1.0
+        scores = scores * signs
+    columns = [f"PCo{i + 1}" for i in range(k)]
+    return PCAResult(pd.DataFrame(scores, index=distances.index, columns=columns), None,
+                     eigenvalues[:k], eigenvalues[:k] / total if total > 0 else np.zeros(k), "pcoa")
+
+def permanova(distances, sample_groups, permutations=PERMANOVA_PERMUTATIONS, random_state=0):
+    """
+    PERMANOVA (Anderson 2001) test of group differences in a distance matrix.
+    
+    All permutations are evaluated at once: the within-group sums of squares of
+    every permuted labelling are read off one product of the squared distances
+    with the stacked group indicator matrices.
+    
+    Args:
+        distances: Samples x samples distance DataFrame
+        sample_groups: Series mapping sample IDs to groups (samples missing from
+                       either side are dropped)
+        permutations: Number of label permutations
+        random_state: Seed of the permutations
+    
+    Returns:
+        Dictionary with the test statistic, p-value, sample and group counts
+    """
+    samples = [sample for sample in distances.index if sample in sample_groups.index]
+    labels = pd.factorize(sample_groups.reindex(samples).to_numpy())[0]
+    n, n_groups = len(samples), labels.max() + 1 if len(samples) else 0
+    result = {"method": "PERMANOVA", "test_statistic_name": "pseudo-F", "sample_size": n,
+              "number_of_groups": int(n_groups), "permutations": permutations}
+    if n_groups < 2 or n_groups >= n:
+        result.update({"test_statistic": np.nan, "p_value": np.nan})
+        return result
+    
+    D2 = distances.loc[samples, samples].to_numpy(dtype=float) ** 2
+    group_sizes = np.bincount(labels, minlength=n_groups)
+    total_ss = D2.sum() / (2 * n)
+    
+    rng = np.random.default_rng(random_state)
+    labellings = np.vstack([labels] + [rng.permutation(labels) for _ in range(permutations)])
+    # Indicator of (labelling, group) for every sample: n x (labellings * groups)
+    indicator = np.zeros((n, len(labellings) * n_groups))
+    indicator[np.arange(n)[:, None], np.arange(len(labellings))[None, :] * n_groups + labellings.T] = 1.0
+    # sum of D^2 within each group: g' D2 g (halved for pairs), scaled by group size
+    within = ((D2 @ indicator) * indicator).sum(axis=0).reshape(len(labellings), n_groups)
+    within_ss = (within / (2 * group_sizes[None, :])).sum(axis=1)
+    f_stats = ((total_ss - within_ss) / (n_groups - 1)) / (within_ss / (n - n_groups))
+    
+    observed = f_stats[0]
+    result.update({
+        "test_statistic": float(observed),
+        "p_value": float((np.sum(f_stats[1:] >= observed) + 1) / (permutations + 1)),
+    })
+    return result
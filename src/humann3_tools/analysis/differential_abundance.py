@@ -1,9 +1,11 @@
 # humann3_tools/analysis/differential_abundance.py
 import os
+import warnings
 import numpy as np
 import pandas as pd
 import logging
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from scipy import stats
 from statsmodels.stats.multitest import multipletests
 
@@ -34,7 +36,95 @@ def clr_transform(data_matrix):
         geometric_means = np.mean(log_data, axis=1, keepdims=True)
         return log_data - geometric_means
 
-def aldex2_like(abundance_df, metadata_df, group_col, mc_samples=128, denom="all", filter_groups=None):
+def aldex2_monte_carlo(values, group1_idx, group2_idx, mc_samples=128, chunk_size=10000,
+                       max_memory_mb=1024, random_state=None):
+    """
+    Batched Monte Carlo engine for the ALDEx2-like test.
+
+    Dirichlet instances for all samples (and as many MC draws as fit in max_memory_mb)
+    are drawn as a single gamma-sampled array, CLR-transformed along the feature axis,
+    and Welch's t-test is computed for all features and draws at once. Random numbers
+    are consumed in the same order as one np.random.dirichlet call per sample per draw,
+    so a seeded run reproduces the per-feature implementation.
+
+    Parameters:
+    -----------
+    values : numpy.ndarray
+        Pseudocount-adjusted abundances with features as rows and samples as columns
+    group1_idx, group2_idx : array-like of int
+        Column positions of the samples in each group
+    mc_samples : int
+        Number of Monte Carlo samples to generate
+    chunk_size : int
+        Number of features per block when computing the test statistics
+    max_memory_mb : int
+        Approximate memory budget for one batch of Dirichlet instances
+    random_state : None, int or numpy.random.RandomState
+        Source of randomness; None uses the global numpy random state
+
+    Returns:
+    --------
+    tuple of (median_effects, median_pvals) numpy arrays, one value per feature
+    """
+    if random_state is None:
+        rng = np.random
+    elif isinstance(random_state, np.random.RandomState):
+        rng = random_state
+    else:
+        rng = np.random.RandomState(random_state)
+
+    values = np.asarray(values, dtype=float)
+    n_features, n_samples = values.shape
+    group1_idx = np.asarray(group1_idx)
+    group2_idx = np.asarray(group2_idx)
+
+    # Dirichlet parameters per sample (samples as rows) and per-sample totals
+    alpha = np.ascontiguousarray(values.T)
+    totals = alpha.sum(axis=1, keepdims=True)
+
+    # Number of MC draws that fit in the memory budget at once
+    instance_bytes = max(alpha.nbytes, 1)
+    batch_size = int(max(1, min(mc_samples, (max_memory_mb * 1024 * 1024) // instance_bytes)))
+
+    effects = np.empty((mc_samples, n_features))
+    pvals = np.empty((mc_samples, n_features))
+
+    for start in range(0, mc_samples, batch_size):
+        stop = min(start + batch_size, mc_samples)
+
+        # Dirichlet instances via normalized gamma draws, scaled to sample totals
+        instances = rng.standard_gamma(np.broadcast_to(alpha, (stop - start, n_samples, n_features)))
+        instances *= 1.0 / instances.sum(axis=2, keepdims=True)
+        instances *= totals
+
+        # CLR transformation along the feature axis
+        instances += 0.5
+        np.log(instances, out=instances)
+        instances -= instances.mean(axis=2, keepdims=True)
+
+        for f_start in range(0, n_features, chunk_size):
+            f_stop = min(f_start + chunk_size, n_features)
+            group1_values = instances[:, group1_idx, f_start:f_stop]
+            group2_values = instances[:, group2_idx, f_start:f_stop]
+
+            effects[start:stop, f_start:f_stop] = group1_values.mean(axis=1) - group2_values.mean(axis=1)
+
+            # Welch's t-test
+            pvals[start:stop, f_start:f_stop] = stats.ttest_ind(
+                group1_values, group2_values, axis=1, equal_var=False
+            ).pvalue
+
+        del instances
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median_effects = np.nanmedian(effects, axis=0)
+        median_pvals = np.nanmedian(pvals, axis=0)
+
+    return median_effects, median_pvals
+
+def aldex2_like(abundance_df, metadata_df, group_col, mc_samples=128, denom="all", filter_groups=None,
+                chunk_size=10000, random_state=None):
     """
     A Python implementation similar to ALDEx2 for differential abundance testing
     
@@ -54,6 +144,10 @@ def aldex2_like(abundance_df, metadata_df, group_col, mc_samples=128, denom="all
     filter_groups : list or None
         List of group names to include in the analysis. If provided, only these groups will be used.
         Must contain exactly 2 groups for ALDEx2.
+    chunk_size : int
+        Number of features per block in the Monte Carlo engine
+    random_state : None, int or numpy.random.RandomState
+        Seed or random state for the Dirichlet draws (None uses the global numpy state)
         
     Returns:
     --------
@@ -126,49 +220,16 @@ def aldex2_like(abundance_df, metadata_df, group_col, mc_samples=128, denom="all
     results = pd.DataFrame(index=abundance.index)
     results['feature'] = abundance.index
     
-    # Monte Carlo sampling of CLR transformations
-    all_clrs = []
-    
-    for i in range(mc_samples):
-        # Generate Dirichlet Monte Carlo instance
-        mc_instance = pd.DataFrame(index=abundance.index, columns=abundance.columns)
-        
-        for col in abundance.columns:
-            # Add random noise according to Dirichlet distribution
-            mc_instance[col] = np.random.dirichlet(abundance[col], 1)[0] * abundance[col].sum()
-        
-        # CLR transformation
-        clr_data = clr_transform(mc_instance.T + 0.5).T
-        all_clrs.append(clr_data)
-    
-    # Calculate effect sizes and p-values across MC instances
-    effect_sizes = []
-    pvals = []
-    
-    for clr_data in all_clrs:
-        # For each feature, compare between groups
-        for feature in clr_data.index:
-            group1_values = clr_data.loc[feature, group1_samples]
-            group2_values = clr_data.loc[feature, group2_samples]
-            
-            # Calculate effect size (difference of means)
-            effect = group1_values.mean() - group2_values.mean()
-            effect_sizes.append((feature, effect))
-            
-            # Welch's t-test
-            t_stat, p_val = stats.ttest_ind(
-                group1_values, group2_values, equal_var=False
-            )
-            pvals.append((feature, p_val))
-    
-    # Aggregate results
-    effect_df = pd.DataFrame(effect_sizes, columns=['feature', 'effect'])
-    pval_df = pd.DataFrame(pvals, columns=['feature', 'pval'])
-    
-    # Group by feature and calculate median effect and p-value
-    median_effects = effect_df.groupby('feature')['effect'].median()
-    median_pvals = pval_df.groupby('feature')['pval'].median()
-    
+    # Monte Carlo sampling of CLR transformations, median effect and p-value per feature
+    median_effects, median_pvals = aldex2_monte_carlo(
+        abundance.values,
+        abundance.columns.get_indexer(group1_samples),
+        abundance.columns.get_indexer(group2_samples),
+        mc_samples=mc_samples,
+        chunk_size=chunk_size,
+        random_state=random_state
+    )
+
     # Add to results
     results['effect_size'] = median_effects
     results['p_value'] = median_pvals
@@ -182,7 +243,164 @@ def aldex2_like(abundance_df, metadata_df, group_col, mc_samples=128, denom="all
     
     return results.sort_values('q_value')
 
-def ancom(abundance_df, metadata_df, group_col, alpha=0.05, denom="all", filter_groups=None):
+# Per-process state for the ANCOM block workers (set once by the pool initializer)
+_ancom_worker_state = {}
+
+def _ancom_init_worker(log_abundance, group_indices, alpha):
+    """Store the shared log matrix and group layout for ANCOM block tasks."""
+    _ancom_worker_state['log_abundance'] = log_abundance
+    _ancom_worker_state['group_indices'] = group_indices
+    _ancom_worker_state['alpha'] = alpha
+
+def _ancom_block_pvalues(log_rows, log_cols, group_indices):
+    """
+    Test the log ratios of every (row, column) feature pair in a block between groups.
+    
+    Uses Welch's t-test for two groups and one-way ANOVA otherwise, matching
+    scipy's ttest_ind(equal_var=False) and f_oneway.
+    
+    Returns:
+    --------
+    numpy.ndarray of p-values with shape (len(log_rows), len(log_cols))
+    """
+    # Log ratios for all pairs in the block: (rows, cols, samples)
+    log_ratios = log_rows[:, None, :] - log_cols[None, :, :]
+    
+    counts, means, sum_squares = [], [], []
+    for idx in group_indices:
+        group_values = log_ratios[:, :, idx]
+        group_mean = group_values.mean(axis=2)
+        counts.append(len(idx))
+        means.append(group_mean)
+        sum_squares.append(((group_values - group_mean[:, :, None]) ** 2).sum(axis=2))
+    del log_ratios
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if len(group_indices) == 2:
+            # Welch's t-test
+            n1, n2 = counts
+            vn1 = sum_squares[0] / (n1 - 1) / n1
+            vn2 = sum_squares[1] / (n2 - 1) / n2
+            df = (vn1 + vn2) ** 2 / (vn1 ** 2 / (n1 - 1) + vn2 ** 2 / (n2 - 1))
+            df = np.where(np.isnan(df), 1, df)
+            t_stat = (means[0] - means[1]) / np.sqrt(vn1 + vn2)
+            p_vals = 2 * stats.t.sf(np.abs(t_stat), df)
+        else:
+            # One-way ANOVA
+            n_total = sum(counts)
+            grand_mean = sum(n * m for n, m in zip(counts, means)) / n_total
+            ss_between = sum(n * (m - grand_mean) ** 2 for n, m in zip(counts, means))
+            ss_within = sum(sum_squares)
+            df_between = len(group_indices) - 1
+            df_within = n_total - len(group_indices)
+            f_stat = (ss_between / df_between) / (ss_within / df_within)
+            p_vals = stats.f.sf(f_stat, df_between, df_within)
+    
+    return p_vals
+
+def _ancom_block_counts(bounds):
+    """
+    Count significant log-ratio tests for one block of feature pairs.
+    
+    Args:
+        bounds: Tuple (row_start, row_stop, col_start, col_stop) into the feature axis
+        
+    Returns:
+        Tuple of (row_start, row_counts, col_start, col_counts)
+    """
+    row_start, row_stop, col_start, col_stop = bounds
+    log_abundance = _ancom_worker_state['log_abundance']
+    
+    p_vals = _ancom_block_pvalues(
+        log_abundance[row_start:row_stop],
+        log_abundance[col_start:col_stop],
+        _ancom_worker_state['group_indices']
+    )
+    significant = p_vals < _ancom_worker_state['alpha']
+    
+    # Blocks on the diagonal only count each unordered pair once
+    if row_start == col_start:
+        significant = np.triu(significant, k=1)
+    
+    return row_start, significant.sum(axis=1), col_start, significant.sum(axis=0)
+
+def ancom_w_statistic(log_abundance, group_codes, alpha=0.05, n_jobs=1, max_memory_mb=1024, logger=None):
+    """
+    Compute the ANCOM W statistic for every feature.
+    
+    W counts, for each feature, the other features whose log ratio with it differs
+    significantly between groups. The log ratio test is symmetric, so each unordered
+    pair is tested once, in blocks of pairs sized to fit max_memory_mb per worker.
+    
+    Parameters:
+    -----------
+    log_abundance : numpy.ndarray
+        Log-transformed abundances with features as rows and samples as columns
+    group_codes : array-like of int
+        Group code for each sample column
+    alpha : float
+        Significance level for tests
+    n_jobs : int
+        Number of worker processes for the blocks (1 = run in this process)
+    max_memory_mb : int
+        Approximate peak memory budget for the block computations
+    logger : logging.Logger
+        Logger for progress output
+        
+    Returns:
+    --------
+    numpy.ndarray of W counts, one per feature
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    log_abundance = np.ascontiguousarray(log_abundance, dtype=float)
+    n_features, n_samples = log_abundance.shape
+    group_codes = np.asarray(group_codes)
+    group_indices = [np.flatnonzero(group_codes == code) for code in np.unique(group_codes)]
+    n_jobs = max(1, n_jobs or 1)
+    
+    # Block edge so that the pair block and its temporaries fit the per-worker budget
+    budget_bytes = max_memory_mb * 1024 * 1024 / n_jobs
+    block_size = int(np.sqrt(budget_bytes / (n_samples * 8 * 4)))
+    block_size = max(1, min(n_features, block_size))
+    
+    starts = range(0, n_features, block_size)
+    blocks = [
+        (i, min(i + block_size, n_features), j, min(j + block_size, n_features))
+        for i in starts for j in starts if j >= i
+    ]
+    logger.info(f"ANCOM: testing {n_features * (n_features - 1) // 2} feature pairs "
+                f"in {len(blocks)} blocks of up to {block_size}x{block_size}")
+    
+    W = np.zeros(n_features, dtype=np.int64)
+    progress_step = max(1, len(blocks) // 20)
+    
+    def accumulate(done, block_result):
+        row_start, row_counts, col_start, col_counts = block_result
+        W[row_start:row_start + len(row_counts)] += row_counts
+        W[col_start:col_start + len(col_counts)] += col_counts
+        if done % progress_step == 0 or done == len(blocks):
+            logger.info(f"ANCOM: Processed block {done}/{len(blocks)}")
+    
+    if n_jobs == 1:
+        _ancom_init_worker(log_abundance, group_indices, alpha)
+        try:
+            for done, bounds in enumerate(blocks, start=1):
+                accumulate(done, _ancom_block_counts(bounds))
+        finally:
+            _ancom_worker_state.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_ancom_init_worker,
+                                 initargs=(log_abundance, group_indices, alpha)) as executor:
+            futures = [executor.submit(_ancom_block_counts, bounds) for bounds in blocks]
+            for done, future in enumerate(as_completed(futures), start=1):
+                accumulate(done, future.result())
+    
+    return W
+
+def ancom(abundance_df, metadata_df, group_col, alpha=0.05, denom="all", filter_groups=None,
+          n_jobs=1, max_memory_mb=1024):
     """
     ANCOM for differential abundance testing
     
@@ -201,6 +419,10 @@ def ancom(abundance_df, metadata_df, group_col, alpha=0.05, denom="all", filter_
         "unmapped_excluded" to exclude unmapped features
     filter_groups : list or None
         List of group names to include in the analysis. If provided, only these groups will be used.
+    n_jobs : int
+        Number of worker processes for the pairwise log-ratio tests
+    max_memory_mb : int
+        Approximate peak memory budget for the pairwise log-ratio tests
         
     Returns:
     --------
@@ -265,45 +487,18 @@ def ancom(abundance_df, metadata_df, group_col, alpha=0.05, denom="all", filter_
     results = pd.DataFrame(index=abundance.index)
     results['feature'] = abundance.index
     
-    # For each feature, compare against all other features
+    # Log matrix is computed once; every pairwise log ratio is a difference of its rows
     n_features = len(abundance.index)
-    W = {feature: 0 for feature in abundance.index}
+    log_abundance = np.log(abundance.values.astype(float))
+    group_codes = pd.Index(unique_groups).get_indexer(groups.loc[abundance.columns])
     
-    # For each feature (i)
-    for i, feature_i in enumerate(abundance.index):
-        if i % 50 == 0:  # Progress update for large datasets
-            logger.info(f"ANCOM: Processing feature {i+1}/{n_features}")
-            
-        # Compare with all other features (j)
-        for j, feature_j in enumerate(abundance.index):
-            if i != j:
-                # Log ratio
-                log_ratio = np.log(abundance.loc[feature_i] / abundance.loc[feature_j])
-                
-                # Perform statistical test on log ratio between groups
-                group_values = {}
-                for group in groups.unique():
-                    group_values[group] = log_ratio[groups == group]
-                
-                if len(groups.unique()) == 2:
-                    # Two groups: t-test
-                    group_list = list(group_values.values())
-                    t_stat, p_val = stats.ttest_ind(
-                        group_list[0], group_list[1], equal_var=False
-                    )
-                else:
-                    # Multiple groups: ANOVA
-                    anova_groups = []
-                    for group, values in group_values.items():
-                        anova_groups.append(values)
-                    f_stat, p_val = stats.f_oneway(*anova_groups)
-                
-                # Count significant tests
-                if p_val < alpha:
-                    W[feature_i] += 1
+    W = ancom_w_statistic(
+        log_abundance, group_codes, alpha=alpha,
+        n_jobs=n_jobs, max_memory_mb=max_memory_mb, logger=logger
+    )
     
     # Calculate W statistic and add to results
-    results['W'] = [W[feature] for feature in results['feature']]
+    results['W'] = W
     results['W_ratio'] = results['W'] / (n_features - 1)
     
     # Add detection threshold (cutoff)
@@ -317,6 +512,42 @@ def ancom(abundance_df, metadata_df, group_col, alpha=0.05, denom="all", filter_
     
     return results.sort_values('W', ascending=False)
 
+def batched_least_squares(design, responses):
+    """
+    Fit the same linear model to many responses with a single least-squares solve.
+    
+    Equivalent to fitting statsmodels OLS separately to each response column, but
+    the design matrix is factorized once and shared by all features.
+    
+    Parameters:
+    -----------
+    design : numpy.ndarray
+        Design matrix with samples as rows and model terms as columns
+    responses : numpy.ndarray
+        Response matrix with samples as rows and features as columns
+        
+    Returns:
+    --------
+    tuple of (params, std_errors, p_values), each with shape (n_terms, n_features)
+    """
+    design = np.asarray(design, dtype=float)
+    responses = np.asarray(responses, dtype=float)
+    
+    params, _, rank, _ = np.linalg.lstsq(design, responses, rcond=None)
+    df_resid = design.shape[0] - rank
+    
+    residuals = responses - design @ params
+    sigma2 = np.einsum('ij,ij->j', residuals, residuals) / df_resid
+    
+    # Unscaled covariance is shared by all features; only the residual variance differs
+    unscaled_var = np.diag(np.linalg.pinv(design.T @ design))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std_errors = np.sqrt(np.outer(unscaled_var, sigma2))
+        t_stats = params / std_errors
+    p_values = 2 * stats.t.sf(np.abs(t_stats), df_resid)
+    
+    return params, std_errors, p_values
+
 def ancom_bc(abundance_df, metadata_df, group_col, formula=None, denom="all", filter_groups=None):
     """
     ANCOM-BC for differential abundance testing
@@ -345,11 +576,10 @@ def ancom_bc(abundance_df, metadata_df, group_col, formula=None, denom="all", fi
     logger = logging.getLogger('humann3_analysis')
     
     try:
-        import statsmodels.api as sm
-        from statsmodels.formula.api import ols
+        import patsy
     except ImportError:
-        logger.error("statsmodels is required for ANCOM-BC")
-        raise ImportError("statsmodels is required for ANCOM-BC")
+        logger.error("patsy (installed with statsmodels) is required for ANCOM-BC")
+        raise ImportError("patsy (installed with statsmodels) is required for ANCOM-BC")
     
     # Make sure metadata and abundance data have matching samples
     shared_samples = list(set(abundance_df.columns) & set(metadata_df.index))
@@ -428,40 +658,29 @@ def ancom_bc(abundance_df, metadata_df, group_col, formula=None, denom="all", fi
         formula = f"feature ~ C({group_col})"
         logger.info(f"Using formula: {formula}")
     
-    # Run models for each feature
-    pvals = []
-    effects = []
-    
-    for i, feature in enumerate(clr_abundance_t.columns):
-        if i % 100 == 0:  # Progress update for large datasets
-            logger.info(f"ANCOM-BC: Processing feature {i+1}/{len(clr_abundance_t.columns)}")
-            
-        # Create a temporary dataframe for regression
-        temp_df = pd.DataFrame({
-            'feature': clr_abundance_t[feature],
-            **metadata
-        })
-        
-        try:
-            # Fit the model
-            model = ols(formula, data=temp_df).fit()
-            
-            # Extract p-values for the group effect
-            for term in model.pvalues.index:
-                if group_col in term and term != 'Intercept':
-                    pvals.append((feature, model.pvalues[term]))
-                    effects.append((feature, model.params[term]))
-                    break
-        except Exception as e:
-            logger.warning(f"Error in ANCOM-BC regression for feature {feature}: {str(e)}")
-    
-    # Compile results
-    pval_df = pd.DataFrame(pvals, columns=['feature', 'p_value'])
-    effect_df = pd.DataFrame(effects, columns=['feature', 'effect_size'])
-    
-    # Add to results
-    results = results.merge(pval_df, on='feature', how='left')
-    results = results.merge(effect_df, on='feature', how='left')
+    # Build the design matrix once; it is identical for every feature
+    design_formula = formula.split('~', 1)[-1]
+    try:
+        design = patsy.dmatrix(design_formula, metadata, return_type='dataframe')
+    except Exception as e:
+        logger.error(f"Error building ANCOM-BC design matrix from formula '{formula}': {str(e)}")
+        raise
+    
+    # Coefficient for the group effect (first non-intercept term mentioning group_col)
+    group_terms = [term for term in design.columns if group_col in term and term != 'Intercept']
+    if not group_terms:
+        logger.error(f"No term for {group_col} found in ANCOM-BC design: {list(design.columns)}")
+        raise ValueError(f"Formula '{formula}' has no term for {group_col}")
+    term_idx = design.columns.get_loc(group_terms[0])
+    
+    # Samples with missing covariates are dropped from the design, as in the per-feature fits
+    responses = clr_abundance_t.loc[design.index]
+    
+    logger.info(f"ANCOM-BC: Fitting {responses.shape[1]} features against {design.shape[1]} model terms")
+    params, _, p_values = batched_least_squares(design.values, responses.values)
+    
+    results['p_value'] = p_values[term_idx]
+    results['effect_size'] = params[term_idx]
     
     # Multiple testing correction
     results['q_value'] = multipletests(results['p_value'], method='fdr_bh')[1]
@@ -0,0 +1,144 @@
+# humann3_tools/analysis/grouped_abundance.py
+"""
+Wide abundance tables paired with a sample -> group vector for plotting.
+
+Plots used to melt the whole features x samples table and merge it with the
+metadata, which for gene families is one row (carrying every metadata column)
+per feature and sample. GroupedAbundance keeps the wide table, dense or a
+sparse AbundanceMatrix, next to the group of each sample. Statistics several
+plots need (the transformed table, feature and group means) are computed on
+first use and shared; long format is built only for the features a plot shows.
+"""
+from functools import cached_property
+
+import numpy as np
+
+from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix
+
+def sample_group_vector(metadata_df, sample_id_col, group_col, samples=None):
+    """
+    Group of each sample from a metadata table.
+    
+    Args:
+        metadata_df: Metadata DataFrame (repeated sample rows are allowed; the
+                     first one is used)
+        sample_id_col: Column with sample IDs
+        group_col: Column with groups
+        samples: Restrict to (and order by) these samples, skipping unknown ones
+    
+    Returns:
+        Series mapping sample IDs to groups
+    """
+    groups = metadata_df.drop_duplicates(sample_id_col).set_index(sample_id_col)[group_col]
+    if samples is not None:
+        groups = groups.reindex([sample for sample in samples if sample in groups.index])
+    return groups
+
+class GroupedAbundance:
+    """
+    Features x samples abundance table with the group of each sample.
+    
+    Attributes:
+        abundance: DataFrame or AbundanceMatrix restricted to the grouped samples
+        sample_groups: Series mapping each sample (in column order) to its group
+        log_transform: Whether transformed is log10(x + 1) of abundance
+    """
+    
+    def __init__(self, abundance, sample_groups, transformed=None, log_transform=True):
+        """
+        Args:
+            abundance: Features x samples DataFrame or AbundanceMatrix
+            sample_groups: Series mapping sample IDs to groups; samples missing
+                           from either side are dropped
+            transformed: Already transformed table over the same samples (default:
+                         computed from abundance on first use)
+            log_transform: Transform with log10(x + 1) (False: transformed is abundance)
+        """
+        sample_groups = sample_groups[~sample_groups.index.duplicated()]
+        samples = [sample for sample in abundance.columns if sample in sample_groups.index]
+        self.abundance = self._select(abundance, samples)
+        self.sample_groups = sample_groups.reindex(samples)
+        self.log_transform = log_transform
+        if transformed is not None:
+            self.transformed = self._select(transformed, samples)
+    
+    @staticmethod
+    def _select(table, samples):
+        if isinstance(table, AbundanceMatrix):
+            return table.select_samples(samples)
+        return table[samples]
+    
+    @property
+    def samples(self):
+        return list(self.sample_groups.index)
+    
+    @cached_property
+    def groups(self):
+        """Groups in order of first appearance."""
+        return list(self.sample_groups.unique())
+    
+    @cached_property
+    def transformed(self):
+        if not self.log_transform:
+            return self.abundance
+        if isinstance(self.abundance, AbundanceMatrix):
+            return self.abundance.log_transform(base=10, pseudocount=1.0)
+        return np.log10(self.abundance + 1)
+    
+    def _table(self, transformed):
+        return self.transformed if transformed else self.abundance
+    
+    @staticmethod
+    def _feature_means(table):
+        if isinstance(table, AbundanceMatrix):
+            return table.feature_means()
+        return table.mean(axis=1)
+    
+    @cached_property
+    def feature_means(self):
+        """Mean abundance of each feature across samples."""
+        return self._feature_means(self.abundance)
+    
+    @cached_property
+    def transformed_feature_means(self):
+        """Mean transformed abundance of each feature across samples."""
+        return self._feature_means(self.transformed)
+    
+    @cached_property
+    def group_means(self):
+        """Mean abundance of each feature within each group (features x groups)."""
+        if isinstance(self.abundance, AbundanceMatrix):
+            return self.abundance.group_means(self.sample_groups)[self.groups]
+        by_group = self.abundance.T.groupby(self.sample_groups.to_numpy(), sort=False, dropna=False)
+        return by_group.mean().T[self.groups]
+    
+    def top_features(self, n, transformed=False):
+        """IDs of the n features with the highest mean, highest first."""
+        means = self.transformed_feature_means if transformed else self.feature_means
+        return means.sort_values(ascending=False, kind="stable").head(n).index
+    
+    def feature_table(self, features, transformed=False):
+        """Dense features x samples DataFrame of the given features only."""
+        table = self._table(transformed)
+        if isinstance(table, AbundanceMatrix):
+            return table.select_features(features).to_dataframe()
+        return table.loc[features]
+    
+    def to_long(self, features, transformed=False, feature_col="Feature", sample_col="Sample",
+                value_col="Abundance", group_col="Group"):
+        """
+        Long-format table of the given features, with each sample's group.
+        
+        Returns:
+            DataFrame with one row per feature and sample
+        """
+        table = self.feature_table(features, transformed).rename_axis(feature_col).reset_index()
+        long_df = table.melt(id_vars=feature_col, var_name=sample_col, value_name=value_col)
+        long_df[group_col] = long_df[sample_col].map(self.sample_groups)
+        return long_df
+    
+    def group_means_long(self, features, feature_col="Feature", value_col="Abundance", group_col="Group"):
+        """Long-format group means of the given features (one row per group and feature)."""
+        means = self.group_means.loc[features].rename_axis(feature_col).reset_index()
+        long_df = means.melt(id_vars=feature_col, var_name=group_col, value_name=value_col)
+        return long_df[[group_col, feature_col, value_col]]
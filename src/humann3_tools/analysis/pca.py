@@ -0,0 +1,283 @@
+# humann3_tools/analysis/pca.py
+"""
+PCA of samples for large, sparse feature tables.
+
+The table is standardized (centred and scaled per feature, as StandardScaler
+does) implicitly: products with the standardized matrix are computed from the
+raw dense or sparse values, so a sparse AbundanceMatrix is never densified as
+a whole. Backends:
+- full: sklearn PCA on the densified standardized matrix (small tables)
+- randomized: randomized truncated SVD (Halko et al.) through matrix products
+- incremental: exact PCA from the samples x samples Gram matrix, accumulated
+  over chunks of features, so only one chunk is dense at a time
+Several components cost little more than two, so results always carry the
+explained variance of every computed component. Results can be cached on disk,
+keyed by a hash of the input values, sample and feature IDs and the settings.
+"""
+import os
+import time
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.decomposition import PCA
+
+from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix
+
+PCA_METHODS = ("auto", "full", "randomized", "incremental")
+DEFAULT_COMPONENTS = 10
+# Largest table (samples x features) "auto" densifies for the full backend
+FULL_PCA_MAX_CELLS = 20_000_000
+FEATURE_CHUNK = 20000
+RANDOMIZED_OVERSAMPLES = 10
+RANDOMIZED_POWER_ITERATIONS = 4
+PCA_CACHE_VERSION = 1
+
+class PCAResult:
+    """
+    Fitted PCA of the samples of a table.
+    
+    Attributes:
+        scores: DataFrame of samples x components ("PC1", "PC2", ...)
+        components: Array of components x features (feature loadings)
+        explained_variance: Variance of the scores of each component
+        explained_variance_ratio: Fraction of the total variance per component
+        method: Backend that computed the result
+        from_cache: Whether the result was loaded from the cache
+    """
+    
+    def __init__(self, scores, components, explained_variance, explained_variance_ratio, method,
+                 from_cache=False):
+        self.scores = scores
+        self.components = components
+        self.explained_variance = explained_variance
+        self.explained_variance_ratio = explained_variance_ratio
+        self.method = method
+        self.from_cache = from_cache
+    
+    def variance_table(self):
+        """Explained variance per component as a DataFrame."""
+        return pd.DataFrame({
+            "Component": list(self.scores.columns),
+            "ExplainedVariance": self.explained_variance,
+            "ExplainedVarianceRatio": self.explained_variance_ratio,
+            "CumulativeRatio": np.cumsum(self.explained_variance_ratio),
+        })
+
+class _StandardizedMatrix:
+    """
+    Samples x features matrix Z = (X - mean) / scale, without materializing Z.
+    
+    X is held as A - offset[:, None] with A dense or sparse (the AbundanceMatrix
+    representation of transformed values).
+    """
+    
+    def __init__(self, table, scale=True, chunk_size=FEATURE_CHUNK):
+        if isinstance(table, AbundanceMatrix):
+            self.A = table.matrix.T.tocsr()
+            self.offset = np.asarray(table.offset, dtype=float)
+        else:
+            self.A = table.to_numpy(dtype=float).T
+            self.offset = np.zeros(table.shape[1])
+        self.n_samples, self.n_features = self.A.shape
+        self.chunk_size = chunk_size
+        self.mean, variance = self._moments()
+        self.scale = np.sqrt(variance) if scale else np.ones(self.n_features)
+        # Constant features are only centred, like StandardScaler does
+        self.scale[self.scale < 1e-8 * np.maximum(np.abs(self.mean), 1.0)] = 1.0
+        # Squared Frobenius norm of Z: the total variance times n_samples
+        self.total = self.n_samples * float(np.sum(variance / self.scale ** 2))
+    
+    def _block(self, start, stop):
+        block = self.A[:, start:stop]
+        return block.toarray() if sparse.issparse(block) else np.asarray(block)
+    
+    def _moments(self):
+        if sparse.issparse(self.A):
+            n = self.n_samples
+            sums = np.asarray(self.A.sum(axis=0)).ravel() - self.offset.sum()
+            squares = (np.asarray(self.A.multiply(self.A).sum(axis=0)).ravel()
+                       - 2 * (self.A.T @ self.offset) + (self.offset ** 2).sum())
+            mean = sums / n
+            return mean, np.maximum(squares / n - mean ** 2, 0.0)
+        # Dense: two-pass moments per chunk, without a full-size temporary
+        mean = np.empty(self.n_features)
+        variance = np.empty(self.n_features)
+        for start in range(0, self.n_features, self.chunk_size):
+            block = self._block(start, start + self.chunk_size)
+            mean[start:start + block.shape[1]] = block.mean(axis=0)
+            variance[start:start + block.shape[1]] = block.var(axis=0)
+        return mean, variance
+    
+    def chunks(self):
+        """Dense standardized (start, Z[:, start:stop]) blocks over the features."""
+        for start in range(0, self.n_features, self.chunk_size):
+            stop = min(start + self.chunk_size, self.n_features)
+            block = self._block(start, stop) - self.offset[:, None]
+            yield start, (block - self.mean[start:stop]) / self.scale[start:stop]
+    
+    def dot(self, V):
+        """Z @ V for a features x k array."""
+        W = V / self.scale[:, None]
+        return self.A @ W - np.outer(self.offset, W.sum(axis=0)) - (self.mean @ W)[None, :]
+    
+    def rdot(self, U):
+        """Z.T @ U for a samples x k array."""
+        AtU = self.A.T @ U
+        return (AtU - (self.offset @ U)[None, :] - np.outer(self.mean, U.sum(axis=0))) / self.scale[:, None]
+    
+    def dense(self):
+        Z = np.empty((self.n_samples, self.n_features))
+        for start, block in self.chunks():
+            Z[:, start:start + block.shape[1]] = block
+        return Z
+
+def _flip_signs(scores, components):
+    """Make the largest absolute score of every component positive (deterministic output)."""
+    signs = np.sign(scores[np.argmax(np.abs(scores), axis=0), np.arange(scores.shape[1])])
+    signs[signs == 0] = 1.0
+    return scores * signs, components * signs[:, None]
+
+def _pca_full(Z, k):
+    pca = PCA(n_components=k, svd_solver="full")
+    scores = pca.fit_transform(Z.dense())
+    return scores, pca.components_
+
+def _pca_randomized(Z, k, random_state, n_iter=RANDOMIZED_POWER_ITERATIONS, oversamples=RANDOMIZED_OVERSAMPLES):
+    rng = np.random.default_rng(random_state)
+    width = min(k + oversamples, Z.n_samples, Z.n_features)
+    Q, _ = np.linalg.qr(Z.dot(rng.standard_normal((Z.n_features, width))))
+    for _ in range(n_iter):
+        P, _ = np.linalg.qr(Z.rdot(Q))
+        Q, _ = np.linalg.qr(Z.dot(P))
+    B = Z.rdot(Q).T
+    Ub, S, Vt = np.linalg.svd(B, full_matrices=False)
+    U = Q @ Ub
+    return U[:, :k] * S[:k], Vt[:k]
+
+def _pca_incremental(Z, k):
+    gram = np.zeros((Z.n_samples, Z.n_samples))
+    for _, block in Z.chunks():
+        gram += block @ block.T
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1][:k]
+    S = np.sqrt(np.maximum(eigenvalues[order], 0.0))
+    U = eigenvectors[:, order]
+    # Loadings from a second pass over the chunks: V = Z.T U / S
+    components = np.zeros((k, Z.n_features))
+    safe = np.where(S > 0, S, 1.0)
+    for start, block in Z.chunks():
+        components[:, start:start + block.shape[1]] = (block.T @ U / safe).T
+    return U * S, components
+
+def table_hash(table, settings, chunk_size=FEATURE_CHUNK):
+    """
+    Hash of a table's values, sample and feature IDs and some settings.
+    
+    Args:
+        table: Features x samples DataFrame or AbundanceMatrix
+        settings: Any repr()-able value identifying how the result was computed
+        chunk_size: Feature rows hashed at a time for dense tables
+    
+    Returns:
+        Hexadecimal digest, usable as a cache key
+    """
+    digest = hashlib.blake2b(repr(settings).encode("utf-8"), digest_size=16)
+    digest.update("\t".join(map(str, table.columns)).encode("utf-8"))
+    digest.update("\t".join(map(str, table.index)).encode("utf-8"))
+    if isinstance(table, AbundanceMatrix):
+        matrix = table.matrix
+        for array in (matrix.data, matrix.indices, matrix.indptr, table.offset):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    else:
+        values = table.to_numpy(dtype=float)
+        for start in range(0, values.shape[0], chunk_size):
+            digest.update(np.ascontiguousarray(values[start:start + chunk_size]).tobytes())
+    return digest.hexdigest()
+
+def _read_cached(cache_file, samples):
+    try:
+        with np.load(cache_file, allow_pickle=False) as cached:
+            scores = cached["scores"]
+            columns = [f"PC{i + 1}" for i in range(scores.shape[1])]
+            return PCAResult(pd.DataFrame(scores, index=samples, columns=columns), cached["components"],
+                             cached["explained_variance"], cached["explained_variance_ratio"],
+                             str(cached["method"]), from_cache=True)
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _write_cached(cache_file, result, logger):
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        np.savez(tmp_file, scores=result.scores.to_numpy(), components=result.components,
+                 explained_variance=result.explained_variance,
+                 explained_variance_ratio=result.explained_variance_ratio, method=result.method)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.warning(f"Could not cache PCA result in {cache_file}: {str(e)}")
+
+def run_pca(table, n_components=DEFAULT_COMPONENTS, method="auto", scale=True, random_state=0,
+            chunk_size=FEATURE_CHUNK, cache_dir=None, logger=None):
+    """
+    PCA of the samples (columns) of a features x samples table.
+    
+    Args:
+        table: Features x samples DataFrame or AbundanceMatrix, already transformed
+        n_components: Components to compute (limited by the table's size)
+        method: "auto" (full for tables up to FULL_PCA_MAX_CELLS dense cells,
+                randomized otherwise), "full", "randomized" or "incremental"
+        scale: Scale every feature to unit variance after centring
+        random_state: Seed of the randomized backend
+        chunk_size: Features per dense block for the incremental backend and moments
+        cache_dir: Directory for cached results (None = no caching)
+        logger: Logger instance
+    
+    Returns:
+        PCAResult
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    if method not in PCA_METHODS:
+        raise ValueError(f"Unknown PCA method: {method} (choose from {', '.join(PCA_METHODS)})")
+    n_features, n_samples = table.shape
+    k = max(1, min(n_components, n_samples, n_features))
+    if method == "auto":
+        dense_input = not isinstance(table, AbundanceMatrix)
+        method = "full" if dense_input and n_samples * n_features <= FULL_PCA_MAX_CELLS else "randomized"
+    
+    cache_file = None
+    if cache_dir is not None:
+        settings = (method, k, bool(scale), random_state if method == "randomized" else None)
+        cache_file = os.path.join(cache_dir, f"pca_{table_hash(table, (PCA_CACHE_VERSION, settings), chunk_size)}.npz")
+        if os.path.isfile(cache_file):
+            cached = _read_cached(cache_file, table.columns)
+            if cached is not None:
+                logger.info(f"Using cached PCA ({cached.method}) from {cache_file}")
+                return cached
+    
+    start_time = time.time()
+    Z = _StandardizedMatrix(table, scale=scale, chunk_size=chunk_size)
+    if method == "full":
+        scores, components = _pca_full(Z, k)
+    elif method == "randomized":
+        scores, components = _pca_randomized(Z, k, random_state)
+    else:
+        scores, components = _pca_incremental(Z, k)
+    scores, components = _flip_signs(scores, components)
+    
+    squared = (scores ** 2).sum(axis=0)
+    explained_variance = squared / max(n_samples - 1, 1)
+    explained_variance_ratio = squared / Z.total if Z.total > 0 else np.zeros(k)
+    columns = [f"PC{i + 1}" for i in range(k)]
+    result = PCAResult(pd.DataFrame(scores, index=table.columns, columns=columns), components,
+                       explained_variance, explained_variance_ratio, method)
+    logger.info(f"Computed {k} principal components of {n_samples} samples x {n_features} features "
+                f"({method}) in {time.time() - start_time:.2f} seconds")
+    
+    if cache_file is not None:
+        _write_cached(cache_file, result, logger)
+    return result
@@ -5,73 +5,334 @@ import logging
 import traceback
 import os
 
-from scipy.stats import kruskal
+from scipy.stats import chi2, norm, rankdata
 from statsmodels.stats.multitest import multipletests
-import scikit_posthocs as sp
 
 from src.humann3_tools.utils.file_utils import sanitize_filename
 
+def _tie_correction_rows(values):
+    """
+    Kruskal-Wallis tie correction term sum(t^3 - t) for each row of a 2D array.
+    
+    Args:
+        values: 2D array with one feature per row
+        
+    Returns:
+        1D array with the tie term for every row
+    """
+    n_rows, n_cols = values.shape
+    sorted_values = np.sort(values, axis=1)
+    
+    # A run of tied values starts at every row start and wherever the sorted value changes
+    run_starts = np.ones((n_rows, n_cols), dtype=bool)
+    run_starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    start_positions = np.flatnonzero(run_starts)
+    run_lengths = np.diff(np.append(start_positions, n_rows * n_cols)).astype(float)
+    
+    return np.bincount(start_positions // n_cols, weights=run_lengths ** 3 - run_lengths,
+                       minlength=n_rows)
+
+
+def feature_rank_summary(abundance_df, sample_groups):
+    """
+    Rank every feature row once and summarize the ranks per group.
+    
+    The summary holds everything Kruskal-Wallis and Dunn's test need, so the rank
+    matrix itself is never rebuilt per feature. Missing values (NaN) are left out
+    of their feature's ranks, as if the feature had not been measured in that
+    sample.
+    
+    Args:
+        abundance_df: Wide DataFrame with features as rows and samples as columns
+        sample_groups: Series mapping sample IDs (abundance columns) to group labels
+        
+    Returns:
+        Dict with group_labels, group_sizes and rank_sums (features x groups),
+        tie_terms, n_samples, n_groups and testable (per feature), or None if no
+        feature has 2+ groups with 2+ samples each
+    """
+    sample_groups = pd.Series(sample_groups).reindex(abundance_df.columns).dropna()
+    group_labels = np.asarray(sample_groups.unique(), dtype=object)
+    if len(group_labels) < 2:
+        return None
+    
+    values = abundance_df[sample_groups.index].to_numpy(dtype=float)
+    membership = (sample_groups.to_numpy(dtype=object)[:, None] == group_labels[None, :]).astype(float)
+    present = ~np.isnan(values)
+    
+    # Rank each feature across samples, then sum ranks within each group
+    if present.all():
+        ranks = rankdata(values, axis=1)
+        tie_terms = _tie_correction_rows(values)
+    else:
+        # Missing values rank after every present value, so they leave the ranks
+        # of the present values unchanged; their own ranks and tie run are dropped
+        filled = np.where(present, values, np.inf)
+        ranks = np.where(present, rankdata(filled, axis=1), 0.0)
+        n_missing = (~present).sum(axis=1).astype(float)
+        tie_terms = _tie_correction_rows(filled) - (n_missing ** 3 - n_missing)
+    group_sizes = present.astype(float) @ membership
+    
+    # Like scipy.stats.kruskal on the groups a feature has: every group present
+    # needs 2+ values, and at least 2 groups must be present
+    n_groups = (group_sizes > 0).sum(axis=1)
+    testable = ((group_sizes == 0) | (group_sizes >= 2)).all(axis=1) & (n_groups >= 2)
+    if not testable.any():
+        return None
+    
+    return {
+        "group_labels": group_labels,
+        "group_sizes": group_sizes,
+        "rank_sums": ranks @ membership,
+        "tie_terms": tie_terms,
+        "n_samples": present.sum(axis=1).astype(float),
+        "n_groups": n_groups,
+        "testable": testable
+    }
+
+
+def kruskal_wallis_wide(abundance_df, sample_groups, feature_col="Pathway", alpha=0.05, logger=None,
+                        rank_summary=None):
+    """
+    Kruskal-Wallis test for every feature of a wide abundance table at once.
+    
+    Each feature row is ranked once; H statistics come from per-group rank sums
+    with the same tie correction as scipy.stats.kruskal.
+    
+    Args:
+        abundance_df: Wide DataFrame with features as rows and samples as columns
+        sample_groups: Series mapping sample IDs (abundance columns) to group labels
+        feature_col: Name of the feature column in the results
+        alpha: Significance threshold for the FDR-adjusted p-values
+        logger: Logger instance for logging
+        rank_summary: Precomputed result of feature_rank_summary for the same inputs
+        
+    Returns:
+        DataFrame with feature_col, KW_stat, KW_pvalue, KW_padj and Reject_H0
+    """
+    if rank_summary is None:
+        rank_summary = feature_rank_summary(abundance_df, sample_groups)
+    
+    if rank_summary is None:
+        if logger:
+            group_sizes = pd.Series(sample_groups).reindex(abundance_df.columns).value_counts()
+            logger.warning(f"Kruskal-Wallis needs at least 2 groups with 2+ samples each, "
+                           f"found group sizes {group_sizes.to_dict()}")
+        return pd.DataFrame()
+    
+    n_samples = rank_summary["n_samples"]
+    group_sizes = rank_summary["group_sizes"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ssbn = np.where(group_sizes > 0, rank_summary["rank_sums"] ** 2 / group_sizes, 0.0).sum(axis=1)
+        h_stat = 12.0 / (n_samples * (n_samples + 1)) * ssbn - 3 * (n_samples + 1)
+        ties = 1 - rank_summary["tie_terms"] / (n_samples ** 3 - n_samples)
+    
+    if logger and (~rank_summary["testable"]).any():
+        logger.debug(f"Skipping {int((~rank_summary['testable']).sum())} features without 2+ groups "
+                     f"of 2+ samples")
+    
+    # Features whose values are all identical have no defined H statistic
+    identical = rank_summary["testable"] & ~(ties > 0)
+    if logger and identical.any():
+        logger.debug(f"Skipping {int(identical.sum())} features with identical values in all samples")
+    
+    testable = rank_summary["testable"] & (ties > 0)
+    h_stat = h_stat[testable] / ties[testable]
+    kw_df = pd.DataFrame({
+        feature_col: abundance_df.index[testable],
+        "KW_stat": h_stat,
+        "KW_pvalue": chi2.sf(h_stat, rank_summary["n_groups"][testable] - 1)
+    })
+    if kw_df.empty:
+        return pd.DataFrame()
+    
+    reject, pvals_corrected, _, _ = multipletests(kw_df["KW_pvalue"], alpha=alpha, method="fdr_bh")
+    kw_df["KW_padj"] = pvals_corrected
+    kw_df["Reject_H0"] = reject
+    return kw_df
+
+
+def _holm_rows(p_values):
+    """
+    Holm step-down adjustment applied independently to each row of a 2D array.
+    NaN entries are not tests: they stay NaN and do not count towards the row's tests.
+    """
+    n_tests = (~np.isnan(p_values)).sum(axis=1)
+    # argsort puts NaN last, so every row's tests come first in sorted order
+    order = np.argsort(p_values, axis=1)
+    sorted_p = np.take_along_axis(p_values, order, axis=1)
+    multipliers = n_tests[:, None] - np.arange(p_values.shape[1])[None, :]
+    adjusted = np.maximum.accumulate(sorted_p * multipliers, axis=1)
+    adjusted = np.minimum(adjusted, 1)
+    
+    result = np.empty_like(adjusted)
+    np.put_along_axis(result, order, adjusted, axis=1)
+    return result
+
+
+def dunn_posthoc_wide(rank_summary, features, feature_rows, feature_col="Pathway"):
+    """
+    Dunn's post-hoc test with Holm correction for many features in one pass.
+    
+    Matches scikit_posthocs.posthoc_dunn(p_adjust="holm") feature by feature,
+    using the group rank sums and tie terms already computed for Kruskal-Wallis.
+    Pairs with a group a feature has no values for are left out.
+    
+    Args:
+        rank_summary: Result of feature_rank_summary for the abundance table
+        features: Names of the features to test
+        feature_rows: Row positions of those features in the abundance table
+        feature_col: Name of the feature column in the results
+        
+    Returns:
+        Long-format DataFrame with one row per feature and pair of groups:
+        feature_col, Group1, Group2, Dunn_z, Dunn_pvalue, Dunn_padj.
+        Dunn_z is positive when Group1 has the higher mean rank.
+    """
+    # Groups in sorted order, as posthoc_dunn reports them
+    order = pd.Index(rank_summary["group_labels"]).argsort()
+    group_labels = rank_summary["group_labels"][order]
+    feature_rows = np.asarray(feature_rows, dtype=int)
+    group_sizes = rank_summary["group_sizes"][feature_rows][:, order]
+    
+    n_samples = rank_summary["n_samples"][feature_rows]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_ranks = rank_summary["rank_sums"][feature_rows][:, order] / group_sizes
+    tie_adjust = rank_summary["tie_terms"][feature_rows] / (12.0 * (n_samples - 1))
+    
+    first, second = np.triu_indices(len(group_labels), 1)
+    measured = (group_sizes[:, first] > 0) & (group_sizes[:, second] > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pair_weights = 1.0 / group_sizes[:, first] + 1.0 / group_sizes[:, second]
+        variance = (n_samples * (n_samples + 1.0) / 12.0 - tie_adjust)[:, None] * pair_weights
+        z_values = np.where(measured, (mean_ranks[:, first] - mean_ranks[:, second]) / np.sqrt(variance), np.nan)
+    p_values = 2.0 * norm.sf(np.abs(z_values))
+    p_adjusted = _holm_rows(p_values)
+    
+    n_pairs = len(first)
+    measured = measured.ravel()
+    return pd.DataFrame({
+        feature_col: np.repeat(np.asarray(features, dtype=object), n_pairs)[measured],
+        "Group1": np.tile(group_labels[first], len(feature_rows))[measured],
+        "Group2": np.tile(group_labels[second], len(feature_rows))[measured],
+        "Dunn_z": z_values.ravel()[measured],
+        "Dunn_pvalue": p_values.ravel()[measured],
+        "Dunn_padj": p_adjusted.ravel()[measured]
+    })
+
+
+def dunn_results_to_matrix(dunn_df):
+    """
+    Convert one feature's long-format Dunn results to a symmetric group x group
+    matrix of adjusted p-values (the layout of scikit_posthocs.posthoc_dunn).
+    """
+    groups = pd.Index(dunn_df["Group1"]).union(pd.Index(dunn_df["Group2"])).unique().sort_values()
+    matrix = pd.DataFrame(1.0, index=groups, columns=groups)
+    for g1, g2, padj in zip(dunn_df["Group1"], dunn_df["Group2"], dunn_df["Dunn_padj"]):
+        matrix.loc[g1, g2] = padj
+        matrix.loc[g2, g1] = padj
+    return matrix
+
+
+def save_dunn_results(dunn_df, output_dir, feature_col="Pathway", file_format="csv",
+                      split_features=False, logger=None):
+    """
+    Save consolidated Dunn's post-hoc results.
+    
+    Args:
+        dunn_df: Long-format Dunn results from dunn_posthoc_wide
+        output_dir: Directory to save results
+        feature_col: Column name for feature (pathway or gene)
+        file_format: "csv" or "parquet" for the consolidated table
+        split_features: Also write one dunn_<feature>.csv matrix per feature
+        logger: Logger instance for logging
+        
+    Returns:
+        Path to the consolidated results file
+    """
+    if file_format == "parquet":
+        dunn_path = os.path.join(output_dir, "dunn_posthoc_results.parquet")
+        try:
+            dunn_df.to_parquet(dunn_path, index=False)
+        except ImportError:
+            if logger:
+                logger.warning("Parquet support (pyarrow or fastparquet) not available; saving Dunn's results as CSV")
+            file_format = "csv"
+    if file_format != "parquet":
+        dunn_path = os.path.join(output_dir, "dunn_posthoc_results.csv")
+        dunn_df.to_csv(dunn_path, index=False)
+    if logger:
+        logger.info(f"Saved Dunn's post-hoc results for {dunn_df[feature_col].nunique()} features: {dunn_path}")
+    
+    if split_features:
+        dunn_dir = os.path.join(output_dir, "dunn_posthoc_tests")
+        os.makedirs(dunn_dir, exist_ok=True)
+        for feat, feat_df in dunn_df.groupby(feature_col, sort=False):
+            safe_feat = sanitize_filename(feat)
+            dunn_results_to_matrix(feat_df).to_csv(os.path.join(dunn_dir, f"dunn_{safe_feat}.csv"))
+        if logger:
+            logger.info(f"Saved per-feature Dunn's post-hoc matrices in {dunn_dir}")
+    
+    return dunn_path
+
+
 def kruskal_wallis_dunn(df_long, group_col="Group", feature_col="Pathway", 
-                       abundance_col="Abundance", alpha=0.05, logger=None):
+                       abundance_col="Abundance", alpha=0.05, logger=None, sample_groups=None,
+                       sample_col="SampleName"):
     """
     1) Kruskal-Wallis across multiple groups
     2) Adjust p-values (Benjamini–Hochberg)
-    3) Dunn's post-hoc for significant features
+    3) Dunn's post-hoc (Holm-adjusted) for significant features
     
     Args:
-        df_long: Long-format DataFrame with samples, features, and abundances
+        df_long: Long-format DataFrame with samples, features, and abundances, or a
+            wide feature-by-sample table when sample_groups is given
         group_col: Column name for grouping variable
         feature_col: Column name for feature (pathway or gene)
         abundance_col: Column name for abundance values
         alpha: Significance threshold
         logger: Logger instance for logging
+        sample_groups: Series mapping sample IDs to groups for wide input
+        sample_col: Column name for sample IDs in long-format input
         
     Returns:
-        Tuple of (kw_results_df, dict_of_posthoc_dfs)
+        Tuple of (kw_results_df, dunn_results_df) where dunn_results_df is in long
+        format with one row per significant feature and pair of groups
     """
     if logger:
         logger.info(f"Running Kruskal-Wallis and Dunn's (group={group_col}, feature={feature_col})")
-    features = df_long[feature_col].unique()
-    results = []
-    for i, feat in enumerate(features):
-        sub = df_long[df_long[feature_col] == feat]
-        groups = sub[group_col].unique()
-        group_data = [sub.loc[sub[group_col] == g, abundance_col] for g in groups]
-        if any(len(x) < 2 for x in group_data):
-            continue  # skip
-        try:
-            stat, pval = kruskal(*group_data)
-            results.append({
-                feature_col: feat,
-                "KW_stat": stat,
-                "KW_pvalue": pval
-            })
-        except Exception as e:
-            if logger:
-                logger.warning(f"Error Kruskal-Wallis on {feat}: {str(e)}")
     
-    if not results:
-        return pd.DataFrame(), {}
-    kw_df = pd.DataFrame(results)
-    reject, pvals_corrected, _, _ = multipletests(kw_df["KW_pvalue"], alpha=alpha, method="fdr_bh")
-    kw_df["KW_padj"] = pvals_corrected
-    kw_df["Reject_H0"] = reject
+    if sample_groups is None:
+        # Features x samples, NaN where a feature has no row for a sample. Repeated
+        # rows of a feature and sample (e.g. a sample listed twice in the metadata)
+        # stay separate observations, numbered by _occurrence
+        long_df = df_long.assign(_occurrence=df_long.groupby([feature_col, sample_col], sort=False).cumcount())
+        columns = [sample_col, "_occurrence"]
+        abundance_df = long_df.pivot(index=feature_col, columns=columns, values=abundance_col)
+        abundance_df = abundance_df.reindex(long_df[feature_col].unique())
+        sample_groups = long_df.drop_duplicates(columns).set_index(columns)[group_col]
+    else:
+        abundance_df = df_long
+    
+    rank_summary = feature_rank_summary(abundance_df, sample_groups)
+    kw_df = kruskal_wallis_wide(abundance_df, sample_groups, feature_col=feature_col,
+                                alpha=alpha, logger=logger, rank_summary=rank_summary)
+    if kw_df.empty:
+        return pd.DataFrame(), pd.DataFrame()
     
     # Dunn's post-hoc for those with Reject_H0 = True
-    posthoc_results = {}
-    sig_features = kw_df[kw_df["Reject_H0"]][feature_col].tolist()
-    for feat in sig_features:
-        sub = df_long[df_long[feature_col] == feat]
-        try:
-            posthoc_df = sp.posthoc_dunn(sub, val_col=abundance_col, group_col=group_col, p_adjust="holm")
-            posthoc_results[feat] = posthoc_df
-        except Exception as e:
-            if logger:
-                logger.warning(f"Error Dunn's on {feat}: {str(e)}")
-    return kw_df, posthoc_results
+    sig_features = kw_df.loc[kw_df["Reject_H0"], feature_col]
+    dunn_df = dunn_posthoc_wide(
+        rank_summary,
+        sig_features.to_numpy(),
+        abundance_df.index.get_indexer(sig_features),
+        feature_col=feature_col
+    )
+    return kw_df, dunn_df
 
 
-def run_statistical_tests(pathways_merged, output_dir, logger, group_col="Group"):
+def run_statistical_tests(pathways_merged, output_dir, logger, group_col="Group",
+                          dunn_format="csv", split_dunn=False):
     """
     Run statistical tests on pathway data and save results.
     
@@ -80,6 +341,8 @@ def run_statistical_tests(pathways_merged, output_dir, logger, group_col="Group"
         output_dir: Directory to save results
         logger: Logger instance
         group_col: Column name for grouping variable
+        dunn_format: File format for the consolidated Dunn's results ("csv" or "parquet")
+        split_dunn: Also write one Dunn's matrix file per significant pathway
     """
     logger.info(f"Running statistical tests on pathways data (Kruskal-Wallis + Dunn) with grouping variable '{group_col}'.")
     try:
@@ -101,14 +364,9 @@ def run_statistical_tests(pathways_merged, output_dir, logger, group_col="Group"
         sig_count = sum(kw_results["Reject_H0"])
         logger.info(f"{sig_count} significant pathways found after FDR correction")
         
-        if dunn_results:
-            dunn_dir = os.path.join(output_dir, "dunn_posthoc_tests")
-            os.makedirs(dunn_dir, exist_ok=True)
-            for feat, pdf in dunn_results.items():
-                safe_feat = sanitize_filename(feat)
-                path = os.path.join(dunn_dir, f"dunn_{safe_feat}.csv")
-                pdf.to_csv(path)
-            logger.info(f"Saved Dunn's post-hoc results for {len(dunn_results)} features.")
+        if not dunn_results.empty:
+            save_dunn_results(dunn_results, output_dir, feature_col="Pathway",
+                              file_format=dunn_format, split_features=split_dunn, logger=logger)
     except Exception as e:
         logger.error(f"Error in statistical tests: {str(e)}")
         logger.error(traceback.format_exc())
\ No newline at end of file
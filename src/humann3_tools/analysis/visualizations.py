@@ -2,13 +2,31 @@
 import os
 import traceback
 import pandas as pd
-import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
 
 from src.humann3_tools.utils.file_utils import strip_suffix
+from src.humann3_tools.analysis.grouped_abundance import GroupedAbundance, sample_group_vector
+from src.humann3_tools.analysis.pca import run_pca
+
+def _plot_first_features_by_group(grouped, feature_col, title, output_path, n=20):
+    """Bar plot of the group means of the first n features (by ID); only those are made long."""
+    features = grouped.abundance.index.sort_values()[:n]
+    plot_df = grouped.group_means_long(features, feature_col=feature_col)
+    plt.figure(figsize=(8,4))
+    sns.barplot(data=plot_df, x="Group", y="Abundance", hue=feature_col)
+    plt.title(title)
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(output_path, format="svg", dpi=300)
+    plt.close()
+
+def _sample_pca(grouped, sample_key_df, logger=None):
+    """PCA of the standardized log10(x+1) table; returns (scores with sample metadata, PCAResult)."""
+    pca = run_pca(grouped.transformed, logger=logger)
+    pca_df = pca.scores[["PC1","PC2"]].rename_axis("SampleName").reset_index()
+    pca_merged = pd.merge(pca_df, sample_key_df.drop_duplicates("SampleName"), on="SampleName", how="left")
+    return pca_merged, pca
 
 def read_and_process_gene_families(unstrat_genefam, sample_key_df, output_dir, logger):
     """
@@ -21,7 +39,7 @@ def read_and_process_gene_families(unstrat_genefam, sample_key_df, output_dir, l
         logger: Logger instance
         
     Returns:
-        DataFrame with processed gene family data in long format
+        Wide gene family table (gene families x samples in the sample key)
     """
     try:
         df = pd.read_csv(unstrat_genefam, sep="\t")
@@ -44,37 +62,24 @@ def read_and_process_gene_families(unstrat_genefam, sample_key_df, output_dir, l
             logger.warning(f"Renaming first column '{first_col}' to 'Gene_Family'")
             df.rename(columns={first_col: "Gene_Family"}, inplace=True)
         
-        long_df = df.melt(
-            id_vars="Gene_Family",
-            var_name="SampleName",
-            value_name="Abundance"
-        )
-        merged = pd.merge(long_df, sample_key_df, on="SampleName", how="inner")
-        if merged.empty:
+        # Keep the table wide: melting and merging it with the sample key would
+        # repeat every sample key column for each gene family and sample
+        df = df.set_index("Gene_Family")
+        if df.index.has_duplicates:
+            df = df.groupby(level=0, sort=False).sum()
+        grouped = GroupedAbundance(df, sample_group_vector(sample_key_df, "SampleName", "Group"))
+        if not grouped.samples:
             raise ValueError("No matching samples after merging gene families with sample key.")
         
         # Plot example bar
-        grouped = merged.groupby(["Group", "Gene_Family"])["Abundance"].mean().reset_index()
-        plt.figure(figsize=(8,4))
-        sns.barplot(data=grouped.head(20), x="Group", y="Abundance", hue="Gene_Family")
-        plt.title("Mean Abundance of First 20 Gene Families by Group")
-        plt.xticks(rotation=45)
-        plt.tight_layout()
         bar_path = os.path.join(output_dir, "gene_families_bar.svg")
-        plt.savefig(bar_path, format="svg", dpi=300)
-        plt.close()
+        _plot_first_features_by_group(grouped, "Gene_Family",
+                                      "Mean Abundance of First 20 Gene Families by Group", bar_path)
         logger.info(f"Saved gene families bar plot: {bar_path}")
         
         # PCA
-        pivoted = merged.pivot_table(index="SampleName", columns="Gene_Family", values="Abundance", aggfunc="sum")
-        pivoted_log = np.log10(pivoted+1)
-        sc = StandardScaler()
-        scaled = sc.fit_transform(pivoted_log)
-        pca = PCA(n_components=2)
-        pca_scores = pca.fit_transform(scaled)
-        pca_df = pd.DataFrame(pca_scores, columns=["PC1","PC2"], index=pivoted.index).reset_index()
-        pca_merged = pd.merge(pca_df, sample_key_df, on="SampleName", how="left")
-        logger.info(f"Gene families PCA variance ratio: {pca.explained_variance_ratio_[:2]}")
+        pca_merged, pca = _sample_pca(grouped, sample_key_df, logger)
+        logger.info(f"Gene families PCA variance ratio: {pca.explained_variance_ratio}")
         
         plt.figure(figsize=(8, 5))  # Increased width to accommodate the legend
         sns.scatterplot(data=pca_merged, x="PC1", y="PC2", hue="Group", style="BMTStatus")
@@ -89,7 +94,7 @@ def read_and_process_gene_families(unstrat_genefam, sample_key_df, output_dir, l
         plt.close()
         logger.info(f"Saved gene families PCA plot: {pca_path}")
         
-        return merged
+        return grouped.abundance
     except Exception as e:
         logger.error(f"Error reading gene families: {str(e)}")
         logger.error(traceback.format_exc())
@@ -124,7 +129,7 @@ def read_and_process_pathways(unstrat_pathways, sample_key_df, output_dir, logge
                 new_cols.append(strip_suffix(c))
         df.columns = new_cols
         
-        # Melt
+        # Melt (the statistical tests take the long table; pathway tables are small)
         pathways_long = df.melt(
             id_vars="Pathway",
             var_name="SampleName",
@@ -134,28 +139,20 @@ def read_and_process_pathways(unstrat_pathways, sample_key_df, output_dir, logge
         if merged.empty:
             raise ValueError("No matching samples after merging pathways with sample key.")
         
+        # The plots work on the wide table
+        wide = df.set_index("Pathway")
+        if wide.index.has_duplicates:
+            wide = wide.groupby(level=0, sort=False).sum()
+        grouped = GroupedAbundance(wide, sample_group_vector(sample_key_df, "SampleName", "Group"))
+        
         # Bar plot
-        grouped = merged.groupby(["Group", "Pathway"])["Abundance"].mean().reset_index()
-        plt.figure(figsize=(8,4))
-        sns.barplot(data=grouped.head(20), x="Group", y="Abundance", hue="Pathway")
-        plt.title("Mean Abundance of First 20 Pathways by Group")
-        plt.xticks(rotation=45)
-        plt.tight_layout()
         bar_path = os.path.join(output_dir, "pathways_bar.svg")
-        plt.savefig(bar_path, format="svg", dpi=300)
-        plt.close()
+        _plot_first_features_by_group(grouped, "Pathway", "Mean Abundance of First 20 Pathways by Group", bar_path)
         logger.info(f"Saved pathways bar plot: {bar_path}")
         
         # PCA
-        pivoted = merged.pivot_table(index="SampleName", columns="Pathway", values="Abundance", aggfunc="sum")
-        pivoted_log = np.log10(pivoted+1)
-        sc = StandardScaler()
-        scaled = sc.fit_transform(pivoted_log)
-        pca = PCA(n_components=2)
-        pca_scores = pca.fit_transform(scaled)
-        pca_df = pd.DataFrame(pca_scores, columns=["PC1","PC2"], index=pivoted.index).reset_index()
-        pca_merged = pd.merge(pca_df, sample_key_df, on="SampleName", how="left")
-        logger.info(f"Pathways PCA variance ratio: {pca.explained_variance_ratio_[:2]}")
+        pca_merged, pca = _sample_pca(grouped, sample_key_df, logger)
+        logger.info(f"Pathways PCA variance ratio: {pca.explained_variance_ratio}")
         
         plt.figure(figsize=(8,5))
         sns.scatterplot(data=pca_merged, x="PC1", y="PC2", hue="Group", style="BMTStatus")
@@ -12,5 +12,8 @@ This package contains the command-line interface modules for each step of the wo
 - main_cli.py: Main CLI interface that dispatches to the other modules
 """
 
-# Import main CLI entry point
-from src.humann3_tools.cli.main_cli import main
+from src.humann3_tools.utils.lazy_imports import lazy_attributes
+
+# Main CLI entry point, imported on first use so that importing one CLI module
+# does not import all of them
+__getattr__, __dir__ = lazy_attributes(__name__, {"main": "src.humann3_tools.cli.main_cli"})
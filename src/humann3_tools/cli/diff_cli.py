@@ -18,9 +18,11 @@ from typing import Dict, List, Tuple, Optional, Union
 # Import internal modules
 try:
     from src.humann3_tools.analysis.differential_abundance import run_differential_abundance_analysis
+    from src.humann3_tools.utils.table_cache import read_abundance_table
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from src.humann3_tools.analysis.differential_abundance import run_differential_abundance_analysis
+    from src.humann3_tools.utils.table_cache import read_abundance_table
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
@@ -152,18 +154,38 @@ def main():
     # Set denominator based on exclude_unmapped flag
     denom = "unmapped_excluded" if args.exclude_unmapped else "all"
     
+    # Read abundance data (from the join stage's columnar cache when it is current)
+    try:
+        abundance_df = read_abundance_table(args.abundance_file, logger=logger)
+        logger.info(f"Loaded abundance data with {abundance_df.shape[0]} features and {abundance_df.shape[1]} samples")
+        metadata_df = pd.read_csv(args.metadata_file)
+    except Exception as e:
+        logger.error(f"Error reading input files: {str(e)}")
+        return 1
+    
+    # Auto-detect sample ID column if not specified
+    sample_id_col = args.sample_id_col
+    if not sample_id_col:
+        common_id_cols = ["SampleName", "Sample", "SampleID", "Sample_ID", "sample_name", "sample_id"]
+        sample_id_col = next((col for col in common_id_cols if col in metadata_df.columns), metadata_df.columns[0])
+        logger.info(f"Using sample ID column: {sample_id_col}")
+    
+    if sample_id_col not in metadata_df.columns:
+        logger.error(f"Sample ID column '{sample_id_col}' not found in metadata")
+        return 1
+    
+    metadata_df = metadata_df.set_index(sample_id_col)
+    
     # Run differential abundance analysis
     success = run_differential_abundance_analysis(
-        abundance_file=args.abundance_file,
-        metadata_file=args.metadata_file,
-        output_dir=args.output_dir,
+        abundance_df,
+        metadata_df,
+        args.output_dir,
         group_col=args.group_col,
         methods=methods,
-        feature_type=args.feature_type,
         denom=denom,
         filter_groups=filter_groups,
-        sample_id_col=args.sample_id_col,
-        alpha=args.alpha
+        logger=logger
     )
     
     if not success:
@@ -41,12 +41,16 @@ try:
     from src.humann3_tools.utils.input_handler import get_input_files, find_kneaddata_output_files
     from src.humann3_tools.utils.cmd_utils import run_cmd
     from src.humann3_tools.utils.resource_utils import track_peak_memory
+    from src.humann3_tools.utils.file_utils import concatenate_files, paired_concat_path, stage_files
+    from src.humann3_tools.humann3.output_manifest import resolve_humann3_outputs, update_run_manifest
  
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from src.humann3_tools.utils.input_handler import get_input_files, find_kneaddata_output_files
     from src.humann3_tools.utils.cmd_utils import run_cmd
     from src.humann3_tools.utils.resource_utils import track_peak_memory
+    from src.humann3_tools.utils.file_utils import concatenate_files, paired_concat_path, stage_files
+    from src.humann3_tools.humann3.output_manifest import resolve_humann3_outputs, update_run_manifest
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
@@ -110,17 +114,11 @@ def prepare_humann3_input(kneaddata_files: List[str], sample_id: str, output_dir
     
     if paired and len(kneaddata_files) >= 2:
         # For paired data, need to concatenate
-        concat_file = os.path.join(interm_dir, f"{sample_id}_paired_concat.fastq")
+        concat_file = paired_concat_path(interm_dir, sample_id, kneaddata_files)
         logger.info(f"Concatenating {len(kneaddata_files)} KneadData files for sample {sample_id}")
         
         try:
-            with open(concat_file, 'w') as outfile:
-                for file_path in kneaddata_files:
-                    logger.debug(f"Adding file: {os.path.basename(file_path)}")
-                    with open(file_path, 'r') as infile:
-                        outfile.write(infile.read())
-            
-            if os.path.getsize(concat_file) > 0:
+            if concatenate_files(kneaddata_files, concat_file, logger=logger) > 0:
                 logger.info(f"Created concatenated file for HUMAnN3: {concat_file}")
                 return concat_file
             else:
@@ -269,29 +267,8 @@ def process_sample_humann3(
         logger.error(f"HUMAnN3 failed for sample {sample_id}")
         return {}
     
-    # Find output files
-    output_files = {
-        'genefamilies': None,
-        'pathabundance': None,
-        'pathcoverage': None,
-        'metaphlan': None
-    }
-    
-    for root, _, files in os.walk(sample_outdir):
-        for file in files:
-            if not file.endswith(".tsv"):
-                continue
-                
-            file_path = os.path.join(root, file)
-            
-            if "genefamilies" in file.lower():
-                output_files['genefamilies'] = file_path
-            elif "pathabundance" in file.lower():
-                output_files['pathabundance'] = file_path
-            elif "pathcoverage" in file.lower():
-                output_files['pathcoverage'] = file_path
-            elif "metaphlan_bugs_list" in file.lower():
-                output_files['metaphlan'] = file_path
+    # Outputs are named after the input file, so look them up instead of walking
+    output_files = resolve_humann3_outputs(sample_outdir, input_file, options, logger=logger)
     
     # Log which files were found
     found_files = [k for k, v in output_files.items() if v is not None]
@@ -303,6 +280,10 @@ def process_sample_humann3(
     
     return output_files
 
+def humann3_sample_task(input_file, sample_id=None, **kwargs):
+    """Run process_sample_humann3 on a run_parallel sample tuple (None on failure)."""
+    return process_sample_humann3(sample_id, input_file, **kwargs) or None
+
 def run_humann3_parallel(
     samples: Dict[str, Dict],
     output_dir: str,
@@ -311,11 +292,18 @@ def run_humann3_parallel(
     threads_per_sample: int = 1,
     max_parallel: Optional[int] = None,
     options: Optional[Dict] = None,
-    paired: bool = False
+    paired: bool = False,
+    resume: bool = False,
+    adaptive_threads: bool = False
 ) -> Dict[str, Dict[str, str]]:
     """
     Run HUMAnN3 on multiple samples in parallel.
     
+    Samples are packed within the memory available by
+    preprocessing.parallel.run_parallel: longest projected runtime (from the
+    run history) first, then largest projected memory, then largest input.
+    Each sample writes a completion manifest in <output_dir>/checkpoints.
+    
     Args:
         samples: Dictionary mapping sample IDs to sample information
         output_dir: Base directory for outputs
@@ -325,11 +313,16 @@ def run_humann3_parallel(
         max_parallel: Maximum number of parallel samples
         options: Dictionary of additional HUMAnN3 options
         paired: Whether to treat input as paired-end (for preparation)
+        resume: Skip samples whose completion manifest is still valid
+        adaptive_threads: Give the last samples the threads the drained queue leaves free
         
     Returns:
         Dictionary mapping sample IDs to dictionaries of output file paths by type
     """
-    from concurrent.futures import ProcessPoolExecutor
+    from src.humann3_tools.preprocessing.parallel import run_parallel
+    from src.humann3_tools.utils.checkpoint import default_checkpoint_dir
+    from src.humann3_tools.utils.resource_utils import estimate_sample_memory, default_metrics_file
+    from src.humann3_tools.utils.run_history import RunPredictor
     
     # Set default max_parallel based on CPU count if not specified
     if max_parallel is None:
@@ -374,40 +367,17 @@ def run_humann3_parallel(
     
     logger.info(f"Prepared {len(prepared_inputs)} samples for HUMAnN3 processing")
     
-    results = {}
-    
-    # Process samples in parallel
-    with ProcessPoolExecutor(max_workers=max_parallel) as executor:
-        # Create futures for all samples
-        futures = {}
-        for sample_id, input_file in prepared_inputs.items():
-            # Submit job
-            future = executor.submit(
-                process_sample_humann3,
-                sample_id, 
-                input_file,
-                output_dir,
-                nucleotide_db,
-                protein_db,
-                threads_per_sample,
-                options
-            )
-            futures[future] = sample_id
-        
-        # Collect results
-        for future in futures:
-            sample_id = futures[future]
-            try:
-                output_files = future.result()
-                if output_files:
-                    results[sample_id] = output_files
-                    logger.info(f"Successfully processed sample {sample_id}")
-                else:
-                    logger.error(f"Failed to process sample {sample_id}")
-            except Exception as e:
-                logger.error(f"Error processing sample {sample_id}: {str(e)}")
-    
-    return results
+    predictor = RunPredictor.from_history("humann", threads=threads_per_sample, logger=logger,
+                                          default_memory=estimate_sample_memory("humann3"))
+    
+    return run_parallel(list(prepared_inputs.items()), humann3_sample_task, max_workers=max_parallel,
+                        memory_per_sample=predictor.predict_memory,
+                        runtime_per_sample=predictor.predict_runtime,
+                        checkpoint_dir=default_checkpoint_dir(output_dir), checkpoint_stage="humann",
+                        resume=resume, metrics_file=default_metrics_file(os.path.join(output_dir, "logs")),
+                        adaptive_threads=adaptive_threads,
+                        output_dir=output_dir, nucleotide_db=nucleotide_db, protein_db=protein_db,
+                        threads=threads_per_sample, options=options)
 
 def organize_output_files(results, output_dir):
     """
@@ -428,27 +398,17 @@ def organize_output_files(results, output_dir):
         'metaphlan': os.path.join(output_dir, "MetaphlanFiles")
     }
     
-    # Create directories if they don't exist
+    # Link (or copy) every file in one batch; empty directories are still created
     for dir_path in output_dirs.values():
         os.makedirs(dir_path, exist_ok=True)
     
-    # Copy files to respective directories
+    file_pairs = []
     for sample_id, sample_outputs in results.items():
         for output_type, file_path in sample_outputs.items():
             if file_path is None:
                 continue
-                
-            # Get destination directory
-            dest_dir = output_dirs[output_type]
-            
-            # Copy file
-            dest_path = os.path.join(dest_dir, os.path.basename(file_path))
-            try:
-                import shutil
-                shutil.copy2(file_path, dest_path)
-                logger.debug(f"Copied {output_type} file for {sample_id} to {dest_path}")
-            except Exception as e:
-                logger.warning(f"Failed to copy {output_type} file for {sample_id}: {str(e)}")
+            file_pairs.append((file_path, os.path.join(output_dirs[output_type], os.path.basename(file_path))))
+    stage_files(file_pairs, mode="link", logger=logger)
     
     return output_dirs
 
@@ -525,6 +485,10 @@ def parse_args(args=None, parent_parser=None):
                                help="Process samples in parallel")
     processing_group.add_argument("--max-parallel", type=int,
                                help="Maximum number of samples to process in parallel")
+    processing_group.add_argument("--adaptive-threads", action="store_true",
+                               help="Give the last samples the threads left free once no samples are waiting")
+    processing_group.add_argument("--resume", action="store_true",
+                               help="Skip samples that completed in a previous run with the same inputs and options")
     
     # HUMAnN3 pipeline options
     pipeline_group = parser.add_argument_group("HUMAnN3 Pipeline Options")
@@ -657,69 +621,27 @@ def main(args=None):
             else:
                 humann3_options[option] = True
     
-    # Run HUMAnN3
+    # Run HUMAnN3 (one sample at a time unless --use-parallel)
     if args.use_parallel:
-        # Parallel processing
         logger.info("Using parallel processing for HUMAnN3")
-        results = run_humann3_parallel(
-            samples=samples,
-            output_dir=args.output_dir,
-            nucleotide_db=args.nucleotide_db,
-            protein_db=args.protein_db,
-            threads_per_sample=args.threads,
-            max_parallel=args.max_parallel,
-            options=humann3_options,
-            paired=args.paired
-        )
     else:
-        # Sequential processing
         logger.info("Processing samples sequentially")
-        results = {}
-        
-        for sample_id, sample_info in samples.items():
-            # Prepare input file
-            input_file = None
-            
-            # Check if we have KneadData files or direct input files
-            if 'kneaddata_files' in sample_info and sample_info['kneaddata_files']:
-                input_file = prepare_humann3_input(
-                    sample_info['kneaddata_files'], 
-                    sample_id, 
-                    args.output_dir, 
-                    args.paired
-                )
-            elif 'files' in sample_info and sample_info['files']:
-                # If single input file, use it directly; if multiple, concatenate if paired
-                if len(sample_info['files']) == 1:
-                    input_file = sample_info['files'][0]
-                elif args.paired and len(sample_info['files']) >= 2:
-                    input_file = prepare_humann3_input(
-                        sample_info['files'],
-                        sample_id,
-                        args.output_dir,
-                        args.paired
-                    )
-                else:
-                    logger.warning(f"Sample {sample_id} has {len(sample_info['files'])} files but paired={args.paired}. Using first file.")
-                    input_file = sample_info['files'][0]
-            
-            if not input_file:
-                logger.warning(f"Skipping sample {sample_id}: no valid input file")
-                continue
-                
-            # Process the sample with HUMAnN3
-            output_files = process_sample_humann3(
-                sample_id=sample_id,
-                input_file=input_file,
-                output_dir=args.output_dir,
-                nucleotide_db=args.nucleotide_db,
-                protein_db=args.protein_db,
-                threads=args.threads,
-                options=humann3_options
-            )
-            
-            if output_files:
-                results[sample_id] = output_files
+    results = run_humann3_parallel(
+        samples=samples,
+        output_dir=args.output_dir,
+        nucleotide_db=args.nucleotide_db,
+        protein_db=args.protein_db,
+        threads_per_sample=args.threads,
+        max_parallel=args.max_parallel if args.use_parallel else 1,
+        options=humann3_options,
+        paired=args.paired,
+        resume=args.resume,
+        adaptive_threads=args.adaptive_threads
+    )
+    
+    # Record each sample's outputs for the join step
+    if results:
+        update_run_manifest(args.output_dir, results, logger=logger)
     
     # Organize outputs if requested
     if args.organize_outputs and results:
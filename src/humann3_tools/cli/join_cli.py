@@ -36,11 +36,19 @@ try:
     from src.humann3_tools.utils.cmd_utils import run_cmd
     from src.humann3_tools.utils.resource_utils import track_peak_memory
     from src.humann3_tools.utils.file_utils import strip_suffixes_from_file_headers
+    from src.humann3_tools.humann3.renorm import renorm_tables
+    from src.humann3_tools.humann3.table_join import join_split_humann_tables
+    from src.humann3_tools.utils.table_cache import write_table_caches
+    from src.humann3_tools.humann3.output_manifest import manifest_files
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from src.humann3_tools.utils.cmd_utils import run_cmd
     from src.humann3_tools.utils.resource_utils import track_peak_memory
     from src.humann3_tools.utils.file_utils import strip_suffixes_from_file_headers
+    from src.humann3_tools.humann3.renorm import renorm_tables
+    from src.humann3_tools.humann3.table_join import join_split_humann_tables
+    from src.humann3_tools.utils.table_cache import write_table_caches
+    from src.humann3_tools.humann3.output_manifest import manifest_files
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
@@ -89,7 +97,11 @@ def join_normalize_tables(
     output_basename: Optional[str] = None,
     update_snames: bool = False,
     file_pattern: Optional[str] = None,
-    strip_headers: bool = True
+    strip_headers: bool = True,
+    engine: str = "humann",
+    threads: int = 1,
+    keep_joined: bool = False,
+    write_cache: bool = True
 ) -> Optional[Dict[str, str]]:
     """
     Join, normalize, and unstratify HUMAnN3 output files.
@@ -103,10 +115,18 @@ def join_normalize_tables(
         update_snames: Whether to update sample names during normalization
         file_pattern: Pattern for input files
         strip_headers: Whether to strip suffixes from column headers
+        engine: "humann" to use humann_renorm_table/humann_join_tables, or "native" for
+                in-process normalization and a streaming join (falls back to the
+                humann utilities on failure)
+        threads: Number of worker processes for native normalization and joining
+        keep_joined: With the native engine, also write the joined (unsplit) table;
+                     the humann engine always writes it
+        write_cache: Write a columnar sidecar next to each output table for faster
+                     loading by the stats, diff and viz modules
         
     Returns:
-        Dictionary mapping output types (unstratified, stratified) to file paths,
-        or None if processing fails
+        Dictionary mapping output types (unstratified, stratified, and joined when
+        kept) to file paths, or None if processing fails
     """
     
     # Determine file type and pattern
@@ -126,9 +146,18 @@ def join_normalize_tables(
     # Use provided pattern or default
     pattern = file_pattern if file_pattern else default_pattern
     
-    # Find input files
+    # Find input files, from the HUMAnN3 run manifest when it records every matching file
     search_pattern = os.path.join(input_dir, pattern)
     input_files = glob.glob(search_pattern)
+    recorded_files = None if file_pattern else manifest_files(input_dir, file_type, logger=logger)
+    if recorded_files is not None:
+        unrecorded = sorted(set(map(os.path.abspath, input_files)) - set(map(os.path.abspath, recorded_files)))
+        if unrecorded:
+            logger.warning(f"{len(unrecorded)} files matching {pattern} are not in the run manifest; "
+                           f"joining all matching files instead: "
+                           f"{', '.join(os.path.basename(f) for f in unrecorded)}")
+        else:
+            input_files = recorded_files
     
     if not input_files:
         logger.error(f"No files found matching pattern: {search_pattern}")
@@ -144,14 +173,29 @@ def join_normalize_tables(
         os.makedirs(norm_dir, exist_ok=True)
         
         # Normalize each file
-        logger.info(f"Normalizing files to {units} units...")
+        logger.info(f"Normalizing files to {units} units ({engine} engine)...")
         normalized_files = []
         
+        file_pairs = []
         for input_file in input_files:
             basename = os.path.basename(input_file)
             sample_name = basename.replace(f"_{file_type}.tsv", "").replace(f".{file_type}.tsv", "")
             output_norm = os.path.join(norm_dir, f"{sample_name}_{file_type}_{units}.tsv")
-            
+            file_pairs.append((input_file, output_norm))
+        
+        # Native engine normalizes in-process; anything it cannot handle goes to humann_renorm_table
+        if engine == "native":
+            native_results = renorm_tables(file_pairs, units=units, update_snames=update_snames,
+                                           threads=threads)
+            fallback_pairs = [(i, o) for i, o in file_pairs if not native_results.get(i)]
+            normalized_files = [o for i, o in file_pairs if native_results.get(i)]
+            if fallback_pairs:
+                logger.warning(f"Native normalization failed for {len(fallback_pairs)} files; "
+                               f"falling back to humann_renorm_table")
+        else:
+            fallback_pairs = file_pairs
+        
+        for input_file, output_norm in fallback_pairs:
             cmd = [
                 "humann_renorm_table",
                 "--input", input_file,
@@ -192,6 +236,26 @@ def join_normalize_tables(
     logger.info("Joining files...")
     joined_output = os.path.join(output_dir, f"{output_basename}.tsv")
     
+    # Native engine joins, splits and cleans headers in a single streaming pass
+    if engine == "native":
+        try:
+            output_files = join_split_humann_tables(
+                files_to_join,
+                os.path.join(output_dir, f"{output_basename}_unstratified.tsv"),
+                os.path.join(output_dir, f"{output_basename}_stratified.tsv"),
+                joined_file=joined_output if keep_joined else None,
+                strip_headers=strip_headers,
+                threads=threads
+            )
+            if not keep_joined:
+                del output_files['joined']
+            logger.info(f"Successfully joined and split files into: {output_dir}")
+            if write_cache:
+                write_table_caches(output_files.values(), logger)
+            return output_files
+        except Exception as e:
+            logger.warning(f"Native join failed ({str(e)}); falling back to humann_join_tables")
+    
     join_cmd = [
         "humann_join_tables",
         "-i", files_to_join,
@@ -273,6 +337,9 @@ def join_normalize_tables(
     else:
         logger.warning("Could not find stratified output file")
     
+    if write_cache:
+        write_table_caches(output_files.values(), logger)
+    
     return output_files
 
 def parse_args(args=None, parent_parser=None):
@@ -345,6 +412,9 @@ Common Usage:
                       help="Base filename for output (default: derived from file type, e.g., 'pathway_abundance_cpm')")
     output_group.add_argument("--units", default="cpm", choices=["cpm", "relab"],
                       help="Normalization units: cpm (counts per million) or relab (relative abundance) (default: cpm)")
+    output_group.add_argument("--keep-joined", action="store_true",
+                      help="With --engine native, also write the joined table before splitting "
+                           "(the humann engine always writes it)")
     
     # Additional options
     format_group = parser.add_argument_group("Format Options")
@@ -354,6 +424,16 @@ Common Usage:
                       help="Glob pattern for input files (default is based on file type, e.g., '*pathabundance.tsv')")
     format_group.add_argument("--no-strip-headers", action="store_true",
                       help="Don't strip suffixes from column headers (keep full sample names)")
+    format_group.add_argument("--no-cache", action="store_true",
+                      help="Don't write the columnar sidecar (<table>.tsv.cache/) next to each output table")
+    
+    # Performance options
+    perf_group = parser.add_argument_group("Performance Options")
+    perf_group.add_argument("--engine", default="humann", choices=["humann", "native"],
+                      help="Engine for normalization and joining: humann (HUMAnN utilities) or native "
+                           "(in-process renormalization and streaming k-way merge join) (default: humann)")
+    perf_group.add_argument("--threads", type=int, default=1,
+                      help="Number of worker processes for the native engine (default: 1)")
     
     # Logging options
     log_group = parser.add_argument_group("Logging Options")
@@ -391,13 +471,12 @@ def main(args=None):
     start_time = time.time()
     
     # Check required utilities
-    utils_to_check = [
-        "humann_join_tables",
-        "humann_split_stratified_table"
-    ]
+    utils_to_check = []
+    if args.engine == "humann":
+        utils_to_check.extend(["humann_join_tables", "humann_split_stratified_table"])
     
     # Add humann_renorm_table if normalization is needed
-    if (args.pathabundance or args.genefamilies) and args.units:
+    if (args.pathabundance or args.genefamilies) and args.units and args.engine == "humann":
         utils_to_check.append("humann_renorm_table")
     
     # Check all required utilities
@@ -425,7 +504,11 @@ def main(args=None):
         output_basename=args.output_basename,
         update_snames=args.update_snames,
         file_pattern=args.file_pattern,
-        strip_headers=not args.no_strip_headers
+        strip_headers=not args.no_strip_headers,
+        engine=args.engine,
+        threads=args.threads,
+        keep_joined=args.keep_joined,
+        write_cache=not args.no_cache
     )
     
     if not results:
@@ -181,16 +181,28 @@ def process_sample_kneaddata(sample_id: str,
     
     return output_files
 
+def kneaddata_sample_task(input_file, sample_id=None, paired_file=None, **kwargs):
+    """Run process_sample_kneaddata on a run_parallel sample tuple (None on failure)."""
+    input_files = [input_file, paired_file] if paired_file else [input_file]
+    return process_sample_kneaddata(sample_id, input_files, **kwargs) or None
+
 def run_kneaddata_parallel(samples: Dict[str, Dict],
                         output_dir: str,
                         reference_dbs: List[str],
                         threads_per_sample: int = 1,
                         max_parallel: Optional[int] = None,
                         paired: bool = False,
-                        options: Optional[Dict] = None) -> Dict[str, List[str]]:
+                        options: Optional[Dict] = None,
+                        resume: bool = False,
+                        adaptive_threads: bool = False) -> Dict[str, List[str]]:
     """
     Run KneadData on multiple samples in parallel.
     
+    Samples are packed within the memory available by
+    preprocessing.parallel.run_parallel: longest projected runtime (from the
+    run history) first, then largest projected memory, then largest input.
+    Each sample writes a completion manifest in <output_dir>/checkpoints.
+    
     Args:
         samples: Dictionary mapping sample IDs to sample information
         output_dir: Base directory for outputs
@@ -199,61 +211,46 @@ def run_kneaddata_parallel(samples: Dict[str, Dict],
         max_parallel: Maximum number of parallel samples
         paired: Whether to process as paired-end
         options: Dictionary of additional KneadData options
+        resume: Skip samples whose completion manifest is still valid
+        adaptive_threads: Give the last samples the threads the drained queue leaves free
         
     Returns:
         Dictionary mapping sample IDs to lists of output file paths
     """
-    from concurrent.futures import ProcessPoolExecutor
+    from src.humann3_tools.preprocessing.parallel import run_parallel
+    from src.humann3_tools.utils.checkpoint import default_checkpoint_dir
+    from src.humann3_tools.utils.resource_utils import estimate_sample_memory, default_metrics_file
+    from src.humann3_tools.utils.run_history import RunPredictor
     
     # Set default max_parallel based on CPU count if not specified
     if max_parallel is None:
         available_cpus = multiprocessing.cpu_count()
         max_parallel = max(1, available_cpus // threads_per_sample)
     
-    logger.info(f"Running KneadData in parallel: {len(samples)} samples, " 
+    logger.info(f"Running KneadData: {len(samples)} samples, " 
                 f"{max_parallel} parallel processes, {threads_per_sample} threads per sample")
     
-    results = {}
-    
-    # Define a wrapper for parallel processing
-    def process_sample_wrapper(sample_id, sample_info):
+    sample_list = []
+    for sample_id, sample_info in samples.items():
         if not sample_info['files']:
             logger.warning(f"Skipping sample {sample_id}: no input files")
-            return sample_id, []
-        
-        output_files = process_sample_kneaddata(
-            sample_id=sample_id, 
-            input_files=sample_info['files'],
-            output_dir=output_dir,
-            reference_dbs=reference_dbs,
-            threads=threads_per_sample,
-            paired=paired,
-            options=options
-        )
-        return sample_id, output_files
-    
-    # Process samples in parallel
-    with ProcessPoolExecutor(max_workers=max_parallel) as executor:
-        # Submit jobs
-        futures = {
-            executor.submit(process_sample_wrapper, sample_id, sample_info): sample_id 
-            for sample_id, sample_info in samples.items()
-        }
-        
-        # Collect results
-        for future in futures:
-            sample_id = futures[future]
-            try:
-                result_id, output_files = future.result()
-                if output_files:
-                    results[result_id] = output_files
-                    logger.info(f"Successfully processed sample {result_id}")
-                else:
-                    logger.error(f"Failed to process sample {result_id}")
-            except Exception as e:
-                logger.error(f"Error processing sample {sample_id}: {str(e)}")
-    
-    return results
+            continue
+        if paired and len(sample_info['files']) >= 2:
+            sample_list.append((sample_id, sample_info['files'][0], sample_info['files'][1]))
+        else:
+            sample_list.append((sample_id, sample_info['files'][0]))
+    
+    predictor = RunPredictor.from_history("kneaddata", threads=threads_per_sample, logger=logger,
+                                          default_memory=estimate_sample_memory("kneaddata"))
+    
+    return run_parallel(sample_list, kneaddata_sample_task, max_workers=max_parallel,
+                        memory_per_sample=predictor.predict_memory,
+                        runtime_per_sample=predictor.predict_runtime,
+                        checkpoint_dir=default_checkpoint_dir(output_dir), checkpoint_stage="kneaddata",
+                        resume=resume, metrics_file=default_metrics_file(os.path.join(output_dir, "logs")),
+                        adaptive_threads=adaptive_threads,
+                        output_dir=output_dir, reference_dbs=reference_dbs, threads=threads_per_sample,
+                        paired=paired, options=options)
 
 def parse_args():
     """Parse command line arguments for the KneadData module."""
@@ -307,6 +304,10 @@ def parse_args():
                       help="Process multiple samples in parallel")
     parser.add_argument("--max-parallel", type=int, default=None,
                       help="Maximum number of samples to process in parallel")
+    parser.add_argument("--adaptive-threads", action="store_true",
+                      help="Give the last samples the threads left free once no samples are waiting")
+    parser.add_argument("--resume", action="store_true",
+                      help="Skip samples that completed in a previous run with the same inputs and options")
     
     # Logging options
     parser.add_argument("--log-file", 
@@ -367,40 +368,22 @@ def main():
             else:
                 kneaddata_options[option] = True
     
-    # Run KneadData
+    # Run KneadData (one sample at a time unless --use-parallel)
     if args.use_parallel:
-        # Parallel processing
         logger.info("Using parallel processing for KneadData")
-        results = run_kneaddata_parallel(
-            samples=samples,
-            output_dir=args.output_dir,
-            reference_dbs=args.reference_dbs,
-            threads_per_sample=args.threads,
-            max_parallel=args.max_parallel,
-            paired=args.paired,
-            options=kneaddata_options
-        )
     else:
-        # Sequential processing
         logger.info("Processing samples sequentially")
-        results = {}
-        for sample_id, sample_info in samples.items():
-            if not sample_info['files']:
-                logger.warning(f"Skipping sample {sample_id}: no input files")
-                continue
-                
-            output_files = process_sample_kneaddata(
-                sample_id=sample_id,
-                input_files=sample_info['files'],
-                output_dir=args.output_dir,
-                reference_dbs=args.reference_dbs,
-                threads=args.threads,
-                paired=args.paired,
-                options=kneaddata_options
-            )
-            
-            if output_files:
-                results[sample_id] = output_files
+    results = run_kneaddata_parallel(
+        samples=samples,
+        output_dir=args.output_dir,
+        reference_dbs=args.reference_dbs,
+        threads_per_sample=args.threads,
+        max_parallel=args.max_parallel if args.use_parallel else 1,
+        paired=args.paired,
+        options=kneaddata_options,
+        resume=args.resume,
+        adaptive_threads=args.adaptive_threads
+    )
     
     # Log results summary
     if results:
@@ -30,15 +30,22 @@ import argparse
 import importlib
 import logging
 import warnings
-import pkg_resources
 
-# Import CLI modules
-from src.humann3_tools.cli import kneaddata_cli
-from src.humann3_tools.cli import humann3_cli
-from src.humann3_tools.cli import join_cli
-from src.humann3_tools.cli import stats_cli
-from src.humann3_tools.cli import diff_cli
-from src.humann3_tools.cli import viz_cli
+# CLI module of every command, imported only when that command runs: stats,
+# diff and viz load matplotlib, seaborn, sklearn, statsmodels and
+# scikit-posthocs, which --help and the preprocessing commands do not need
+COMMAND_MODULES = {
+    'humann3': "src.humann3_tools.cli.humann3_cli",
+    'join': "src.humann3_tools.cli.join_cli",
+    'kneaddata': "src.humann3_tools.cli.kneaddata_cli",
+    'stats': "src.humann3_tools.cli.stats_cli",
+    'diff': "src.humann3_tools.cli.diff_cli",
+    'viz': "src.humann3_tools.cli.viz_cli",
+}
+
+def load_command(command):
+    """Import the CLI module of a command."""
+    return importlib.import_module(COMMAND_MODULES[command])
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
@@ -135,27 +142,27 @@ def main():
     try:
         if command == 'humann3':
             logger.info(f"Running HUMAnN3...")
-            return humann3_cli.main()
+            return load_command('humann3').main()
             
         elif command == 'join':
             logger.info(f"Running Join...")
-            return join_cli.main()
+            return load_command('join').main()
             
         elif command == 'kneaddata':
             logger.info("Running KneadData...")
-            return kneaddata_cli.main()
+            return load_command('kneaddata').main()
             
         elif command == 'stats':
             logger.info("Running Statistics...")
-            return stats_cli.main()
+            return load_command('stats').main()
             
         elif command == 'diff':
             logger.info("Running Differential Analysis...")
-            return diff_cli.main()
+            return load_command('diff').main()
             
         elif command == 'viz':
             logger.info("Running Visualization...")
-            return viz_cli.main()
+            return load_command('viz').main()
         
         elif command == '--help' or command == '-h':
             # Show help
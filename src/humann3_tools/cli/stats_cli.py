@@ -6,22 +6,24 @@ import argparse
 import logging
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Optional, Tuple, Union
-from scipy.stats import kruskal
-
-try:
-    import scikit_posthocs as sp
-except ImportError:
-    sp = None
+from typing import Optional, Tuple, Union
 
 # Import internal modules
 try:
     from src.humann3_tools.utils.resource_utils import track_peak_memory
-    from src.humann3_tools.utils.file_utils import sanitize_filename
+    from src.humann3_tools.analysis.statistical import (
+        feature_rank_summary, kruskal_wallis_wide, dunn_posthoc_wide, save_dunn_results
+    )
+    from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix, read_abundance_matrix
+    from src.humann3_tools.utils.table_cache import read_abundance_table
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from src.humann3_tools.utils.resource_utils import track_peak_memory
-    from src.humann3_tools.utils.file_utils import sanitize_filename
+    from src.humann3_tools.analysis.statistical import (
+        feature_rank_summary, kruskal_wallis_wide, dunn_posthoc_wide, save_dunn_results
+    )
+    from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix, read_abundance_matrix
+    from src.humann3_tools.utils.table_cache import read_abundance_table
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
@@ -32,9 +34,9 @@ def read_and_process_data(
     sample_id_col: Optional[str] = None, 
     group_col: str = "Group",
     feature_type: str = "pathway"
-) -> Tuple[pd.DataFrame, List[str], str, str]:
+) -> Tuple[pd.DataFrame, pd.Series, str, str]:
     """
-    Read abundance and metadata files and merge them into a long-format DataFrame.
+    Read abundance and metadata files and match abundance samples to their groups.
     
     Args:
         abundance_file: Path to abundance file (unstratified)
@@ -44,17 +46,23 @@ def read_and_process_data(
         feature_type: Type of features in abundance file ("pathway" or "gene")
         
     Returns:
-        Tuple of (merged_long_df, groups, feature_col, sample_id_col)
+        Tuple of (abundance_df, sample_groups, feature_col, sample_id_col), where
+        abundance_df is the wide table restricted to samples found in the metadata
+        and sample_groups maps each of those samples to its group
     """
     logger.info(f"Reading abundance file: {abundance_file}")
     
     # Read abundance file (make sure it's tab-delimited and has row names in first column)
     try:
-        abundance_df = pd.read_csv(abundance_file, sep='\t', index_col=0)
+        if feature_type == "gene":
+            # Gene family tables are mostly zeros; keep them sparse until matched to the metadata
+            abundance_df = read_abundance_matrix(abundance_file, logger=logger)
+        else:
+            abundance_df = read_abundance_table(abundance_file, logger=logger)
         logger.info(f"Loaded abundance data with {abundance_df.shape[0]} features and {abundance_df.shape[1]} samples")
     except Exception as e:
         logger.error(f"Error reading abundance file: {str(e)}")
-        return pd.DataFrame(), [], "", ""
+        return pd.DataFrame(), pd.Series(dtype=object), "", ""
     
     logger.info(f"Reading metadata file: {metadata_file}")
     
@@ -64,7 +72,7 @@ def read_and_process_data(
         logger.info(f"Loaded metadata with {metadata_df.shape[0]} samples and {metadata_df.shape[1]} columns")
     except Exception as e:
         logger.error(f"Error reading metadata file: {str(e)}")
-        return pd.DataFrame(), [], "", ""
+        return pd.DataFrame(), pd.Series(dtype=object), "", ""
     
     # Auto-detect sample ID column if not specified
     if not sample_id_col:
@@ -82,44 +90,39 @@ def read_and_process_data(
     # Verify sample ID column exists
     if sample_id_col not in metadata_df.columns:
         logger.error(f"Sample ID column '{sample_id_col}' not found in metadata")
-        return pd.DataFrame(), [], "", ""
+        return pd.DataFrame(), pd.Series(dtype=object), "", ""
     
     # Verify group column exists
     if group_col not in metadata_df.columns:
         logger.error(f"Group column '{group_col}' not found in metadata")
-        return pd.DataFrame(), [], "", ""
+        return pd.DataFrame(), pd.Series(dtype=object), "", ""
     
-    # Convert abundance data to long format
     feature_col = "Pathway" if feature_type == "pathway" else "Gene_Family"
-    long_df = abundance_df.reset_index().melt(
-        id_vars=abundance_df.index.name, 
-        var_name=sample_id_col, 
-        value_name="Abundance"
-    )
     
-    # Rename feature column
-    long_df = long_df.rename(columns={abundance_df.index.name: feature_col})
-    
-    # Merge with metadata
-    merged_df = pd.merge(
-        long_df, 
-        metadata_df,
-        on=sample_id_col,
-        how="inner"
-    )
+    # Match abundance columns to metadata samples; the table stays wide
+    sample_groups = metadata_df.drop_duplicates(sample_id_col).set_index(sample_id_col)[group_col]
+    shared_samples = [sample for sample in abundance_df.columns if sample in sample_groups.index]
     
-    # Check if merge was successful
-    if merged_df.empty:
+    # Check if matching was successful
+    if not shared_samples:
         logger.error("No matching samples between abundance data and metadata")
-        return pd.DataFrame(), [], "", ""
+        return pd.DataFrame(), pd.Series(dtype=object), "", ""
     
-    logger.info(f"Successfully merged abundance data with metadata. Working with {len(merged_df)} rows.")
+    if isinstance(abundance_df, AbundanceMatrix):
+        # Features that are zero in every matched sample are constant, and the
+        # Kruskal-Wallis test skips them anyway, so drop them before densifying
+        abundance_df = abundance_df.select_samples(shared_samples).drop_zero_features().to_dataframe()
+    else:
+        abundance_df = abundance_df[shared_samples]
+    sample_groups = sample_groups.loc[shared_samples]
+    logger.info(f"Matched {len(shared_samples)} samples with metadata. "
+                f"Working with {abundance_df.shape[0]} features.")
     
     # Get unique groups
-    groups = merged_df[group_col].unique().tolist()
+    groups = sample_groups.unique().tolist()
     logger.info(f"Found {len(groups)} groups: {groups}")
     
-    return merged_df, groups, feature_col, sample_id_col
+    return abundance_df, sample_groups, feature_col, sample_id_col
 
 def run_statistical_tests(
     abundance_file: str,
@@ -128,7 +131,9 @@ def run_statistical_tests(
     group_col: str = "Group",
     feature_type: str = "pathway",
     sample_id_col: Optional[str] = None,
-    alpha: float = 0.05
+    alpha: float = 0.05,
+    dunn_format: str = "csv",
+    split_dunn: bool = False
 ) -> bool:
     """
     Run statistical tests on HUMAnN3 output data.
@@ -141,6 +146,8 @@ def run_statistical_tests(
         feature_type: Type of features in abundance file ("pathway" or "gene")
         sample_id_col: Column in metadata for sample IDs (auto-detected if None)
         alpha: Significance threshold
+        dunn_format: File format for the consolidated Dunn's results ("csv" or "parquet")
+        split_dunn: Also write one Dunn's matrix file per significant feature
         
     Returns:
         Boolean indicating success or failure
@@ -149,22 +156,24 @@ def run_statistical_tests(
     os.makedirs(output_dir, exist_ok=True)
     
     # Read and process data
-    merged_df, groups, feature_col, detected_sample_id_col = read_and_process_data(
+    abundance_df, sample_groups, feature_col, detected_sample_id_col = read_and_process_data(
         abundance_file, metadata_file, sample_id_col, group_col, feature_type
     )
     
-    if merged_df.empty:
+    if abundance_df.empty:
         logger.error("Failed to process input data")
         return False
     
     # Check number of groups
+    groups = sample_groups.unique().tolist()
     if len(groups) < 2:
         logger.error(f"Need at least 2 groups for statistical testing, found {len(groups)}")
         return False
     
     # Run Kruskal-Wallis and Dunn's test
     kw_results, dunn_results = kruskal_wallis_dunn(
-        df_long=merged_df,
+        abundance_df=abundance_df,
+        sample_groups=sample_groups,
         group_col=group_col,
         feature_col=feature_col,
         abundance_col="Abundance",
@@ -182,18 +191,9 @@ def run_statistical_tests(
     logger.info(f"Saved Kruskal-Wallis results to {kw_path}")
     
     # Save Dunn's post-hoc test results
-    if dunn_results:
-        dunn_dir = os.path.join(output_dir, "dunn_posthoc_tests")
-        os.makedirs(dunn_dir, exist_ok=True)
-        
-        for feat, pdf in dunn_results.items():
-            feat_safe = sanitize_filename(feat)
-            dunn_path = os.path.join(dunn_dir, f"dunn_{feat_safe}.csv")
-            pdf.to_csv(dunn_path)
-        
-        logger.info(f"Saved Dunn's post-hoc results for {len(dunn_results)} features in {dunn_dir}")
-    elif sp is None:
-        logger.warning("Dunn's post-hoc tests were skipped (scikit_posthocs not available)")
+    if not dunn_results.empty:
+        save_dunn_results(dunn_results, output_dir, feature_col=feature_col,
+                          file_format=dunn_format, split_features=split_dunn, logger=logger)
     else:
         logger.warning("No Dunn's post-hoc results to save")
     
@@ -206,17 +206,17 @@ def run_statistical_tests(
         f.write(f"Metadata File: {os.path.basename(metadata_file)}\n")
         f.write(f"Feature Type: {feature_type}\n")
         f.write(f"Group Column: {group_col}\n")
-        f.write(f"Groups: {', '.join(groups)}\n\n")
+        f.write(f"Groups: {', '.join(map(str, groups))}\n\n")
         
         f.write(f"Kruskal-Wallis Test Results\n")
         f.write(f"-------------------------\n")
         f.write(f"Total Features Tested: {len(kw_results)}\n")
         f.write(f"Significant Features (q < {alpha}): {sum(kw_results['Reject_H0'])}\n\n")
         
-        if dunn_results:
+        if not dunn_results.empty:
             f.write(f"Dunn's Post-hoc Tests\n")
             f.write(f"--------------------\n")
-            f.write(f"Features with Post-hoc Tests: {len(dunn_results)}\n")
+            f.write(f"Features with Post-hoc Tests: {dunn_results[feature_col].nunique()}\n")
     
     logger.info(f"Saved statistical summary to {summary_path}")
     return True
@@ -240,7 +240,8 @@ Key Features:
 
 Output Files:
   • kruskal_wallis_results.csv: Contains test statistics and adjusted p-values for all features
-  • dunn_posthoc_tests/: Directory with pairwise comparison results for significant features
+  • dunn_posthoc_results.csv: Pairwise comparison results for all significant features (long format)
+  • dunn_posthoc_tests/: Per-feature pairwise comparison matrices (with --split-dunn)
   • statistical_summary.txt: Summary of the analysis, including counts of significant features
 
 Common Usage:
@@ -272,6 +273,10 @@ Common Usage:
                       help="Column name in metadata for sample IDs (autodetected if not specified)")
     parser.add_argument("--alpha", type=float, default=0.05,
                       help="Significance threshold for statistical tests (default: 0.05)")
+    parser.add_argument("--dunn-format", choices=["csv", "parquet"], default="csv",
+                      help="File format for the consolidated Dunn's post-hoc results (default: csv)")
+    parser.add_argument("--split-dunn", action="store_true",
+                      help="Also write one Dunn's post-hoc matrix file per significant feature")
     
     # Logging options
     parser.add_argument("--log-file", 
@@ -295,10 +300,6 @@ def main():
     logger.info("Starting HUMAnN3 Tools Statistical Testing Module")
     start_time = time.time()
     
-    # Check if required Python packages are available
-    if sp is None:
-        logger.warning("scikit_posthocs is not installed. Dunn's post-hoc tests will be skipped.")
-    
     # Check if files exist
     for file_path, desc in [(args.abundance_file, "Abundance file"), (args.metadata_file, "Metadata file")]:
         if not os.path.exists(file_path):
@@ -313,7 +314,9 @@ def main():
         group_col=args.group_col,
         feature_type=args.feature_type,
         sample_id_col=args.sample_id_col,
-        alpha=args.alpha
+        alpha=args.alpha,
+        dunn_format=args.dunn_format,
+        split_dunn=args.split_dunn
     )
     
     if not success:
@@ -369,22 +372,24 @@ import argparse
 import logging
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Optional, Tuple, Union
-from scipy.stats import kruskal
-
-try:
-    import scikit_posthocs as sp
-except ImportError:
-    sp = None
+from typing import Optional, Tuple, Union
 
 # Import internal modules
 try:
     from src.humann3_tools.utils.resource_utils import track_peak_memory
-    from src.humann3_tools.utils.file_utils import sanitize_filename
+    from src.humann3_tools.analysis.statistical import (
+        feature_rank_summary, kruskal_wallis_wide, dunn_posthoc_wide, save_dunn_results
+    )
+    from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix, read_abundance_matrix
+    from src.humann3_tools.utils.table_cache import read_abundance_table
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from src.humann3_tools.utils.resource_utils import track_peak_memory
-    from src.humann3_tools.utils.file_utils import sanitize_filename
+    from src.humann3_tools.analysis.statistical import (
+        feature_rank_summary, kruskal_wallis_wide, dunn_posthoc_wide, save_dunn_results
+    )
+    from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix, read_abundance_matrix
+    from src.humann3_tools.utils.table_cache import read_abundance_table
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
@@ -415,113 +420,61 @@ def setup_logger(log_file=None, log_level=logging.INFO):
     return logger
 
 def kruskal_wallis_dunn(
-    df_long: pd.DataFrame, 
+    abundance_df: pd.DataFrame, 
+    sample_groups: pd.Series, 
     group_col: str = "Group", 
     feature_col: str = "Pathway", 
     abundance_col: str = "Abundance", 
     alpha: float = 0.05
-) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Perform Kruskal-Wallis tests followed by Dunn's post-hoc tests.
     
     Steps:
-    1. Kruskal-Wallis across multiple groups
+    1. Kruskal-Wallis across multiple groups (all features at once on the wide table)
     2. Adjust p-values (Benjamini–Hochberg)
-    3. Dunn's post-hoc for significant features
+    3. Dunn's post-hoc (Holm-adjusted) for significant features, reusing the KW ranks
     
     Args:
-        df_long: Long-format DataFrame with samples, features, and abundances
+        abundance_df: Wide DataFrame with features as rows and samples as columns
+        sample_groups: Series mapping sample IDs to groups
         group_col: Column name for grouping variable
         feature_col: Column name for feature (pathway or gene)
         abundance_col: Column name for abundance values
         alpha: Significance threshold
         
     Returns:
-        Tuple of (kw_results_df, dict_of_posthoc_dfs)
+        Tuple of (kw_results_df, dunn_results_df) with Dunn's results in long format
     """
-    # Check if scikit_posthocs is available for Dunn's test
-    if sp is None:
-        logger.warning("scikit_posthocs not available; will skip Dunn's post-hoc tests")
-    
-    # Get unique features
-    features = df_long[feature_col].unique()
-    logger.info(f"Running Kruskal-Wallis tests on {len(features)} features")
+    logger.info(f"Running Kruskal-Wallis tests on {abundance_df.shape[0]} features")
     
-    # Run Kruskal-Wallis test for each feature
-    results = []
-    
-    from statsmodels.stats.multitest import multipletests
-    
-    for i, feat in enumerate(features):
-        if i % 100 == 0:
-            logger.debug(f"Processing feature {i+1}/{len(features)}")
-            
-        sub = df_long[df_long[feature_col] == feat]
-        groups = sub[group_col].unique()
-        
-        # Skip features with too few groups
-        if len(groups) < 2:
-            logger.debug(f"Skipping feature {feat}: only {len(groups)} group(s)")
-            continue
-        
-        # Get data for each group
-        group_data = [sub.loc[sub[group_col] == g, abundance_col].values for g in groups]
-        
-        # Skip if any group has too few samples
-        if any(len(x) < 2 for x in group_data):
-            groups_too_small = [groups[i] for i, x in enumerate(group_data) if len(x) < 2]
-            logger.debug(f"Skipping feature {feat}: groups {groups_too_small} have fewer than 2 samples")
-            continue
-        
-        try:
-            # Run Kruskal-Wallis test
-            stat, pval = kruskal(*group_data)
-            
-            results.append({
-                feature_col: feat,
-                "KW_stat": stat,
-                "KW_pvalue": pval,
-                "Group_count": len(groups),
-                "Groups": ",".join(groups)
-            })
-        except Exception as e:
-            logger.warning(f"Error in Kruskal-Wallis test for feature {feat}: {str(e)}")
+    # Rank every feature once; both tests work from the same rank summary
+    rank_summary = feature_rank_summary(abundance_df, sample_groups)
+    kw_df = kruskal_wallis_wide(abundance_df, sample_groups, feature_col=feature_col,
+                                alpha=alpha, logger=logger, rank_summary=rank_summary)
     
     # Check if we have any results
-    if not results:
+    if kw_df.empty:
         logger.warning("No valid Kruskal-Wallis test results")
-        return pd.DataFrame(), {}
+        return pd.DataFrame(), pd.DataFrame()
     
-    # Create results DataFrame
-    kw_df = pd.DataFrame(results)
-    
-    # Apply multiple testing correction
-    reject, pvals_corrected, _, _ = multipletests(kw_df["KW_pvalue"], alpha=alpha, method="fdr_bh")
-    kw_df["KW_padj"] = pvals_corrected
-    kw_df["Reject_H0"] = reject
+    groups = sample_groups.unique()
+    kw_df.insert(3, "Group_count", len(groups))
+    kw_df.insert(4, "Groups", ",".join(map(str, groups)))
     
     # Count significant features
     sig_count = sum(kw_df["Reject_H0"])
     logger.info(f"Found {sig_count} significant features after FDR correction")
     
-    # Run Dunn's post-hoc tests for significant features
-    posthoc_results = {}
-    
-    if sp is not None and sig_count > 0:
+    # Run Dunn's post-hoc tests for all significant features in one pass
+    sig_features = kw_df.loc[kw_df["Reject_H0"], feature_col]
+    if sig_count > 0:
         logger.info("Running Dunn's post-hoc tests for significant features")
-        sig_features = kw_df[kw_df["Reject_H0"]][feature_col].tolist()
-        
-        for i, feat in enumerate(sig_features):
-            if i % 20 == 0:
-                logger.debug(f"Running Dunn's test for feature {i+1}/{len(sig_features)}")
-                
-            sub = df_long[df_long[feature_col] == feat]
-            
-            try:
-                # Run Dunn's test
-                posthoc_df = sp.posthoc_dunn(sub, val_col=abundance_col, group_col=group_col, p_adjust="holm")
-                posthoc_results[feat] = posthoc_df
-            except Exception as e:
-                logger.warning(f"Error in Dunn's post-hoc test for feature {feat}: {str(e)}")
-    
-    return kw_df, posthoc_results
\ No newline at end of file
+    dunn_df = dunn_posthoc_wide(
+        rank_summary,
+        sig_features.to_numpy(),
+        abundance_df.index.get_indexer(sig_features),
+        feature_col=feature_col
+    )
+    
+    return kw_df, dunn_df
\ No newline at end of file
@@ -4,6 +4,7 @@ HUMAnN3 Tools Visualization Module
 
 This module creates various visualizations from HUMAnN3 output files, including:
 - PCA plots
+- PCoA ordination of Bray-Curtis, Jaccard or Aitchison distances (with PERMANOVA)
 - Heatmaps
 - Barplots
 - Abundance histograms
@@ -26,6 +27,12 @@ Examples:
                   --metadata-file metadata.csv \
                   --feature "PWY-5484: glycolysis I" \
                   --output-dir ./visualizations
+  
+  # Beta-diversity ordination of the sparse gene family table:
+  humann3-tools viz --abundance-file joined_output/gene_families_cpm_unstratified.tsv \
+                  --metadata-file metadata.csv \
+                  --feature-type gene --pcoa --distance-metric aitchison \
+                  --output-dir ./visualizations
                     
   # Specify group column:
   humann3-tools viz --abundance-file joined_output/pathway_abundance_cpm_unstratified.tsv \
@@ -44,19 +51,37 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from typing import Dict, List, Optional, Tuple, Union
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
 
 # Import internal modules
 try:
     from src.humann3_tools.utils.resource_utils import track_peak_memory
+    from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix, read_abundance_matrix
+    from src.humann3_tools.analysis.grouped_abundance import GroupedAbundance, sample_group_vector
+    from src.humann3_tools.analysis.pca import PCA_METHODS, DEFAULT_COMPONENTS, run_pca
+    from src.humann3_tools.analysis.beta_diversity import DISTANCE_METRICS, distance_matrix, pcoa, permanova
+    from src.humann3_tools.utils.table_cache import read_abundance_table
+    from src.humann3_tools.utils.render_pool import render_tasks, write_render_index
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from src.humann3_tools.utils.resource_utils import track_peak_memory
+    from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix, read_abundance_matrix
+    from src.humann3_tools.analysis.grouped_abundance import GroupedAbundance, sample_group_vector
+    from src.humann3_tools.analysis.pca import PCA_METHODS, DEFAULT_COMPONENTS, run_pca
+    from src.humann3_tools.analysis.beta_diversity import DISTANCE_METRICS, distance_matrix, pcoa, permanova
+    from src.humann3_tools.utils.table_cache import read_abundance_table
+    from src.humann3_tools.utils.render_pool import render_tasks, write_render_index
 
 # Set up logging
 logger = logging.getLogger('humann3_tools')
 
+# Render in worker processes by default from this many figures on (spawning costs a few seconds)
+PARALLEL_RENDER_MIN_TASKS = 8
+# Columns naming the feature in results files, in order of preference
+FEATURE_RESULT_COLUMNS = ["feature", "Feature", "Pathway", "Gene_Family", "# Pathway", "# Gene Family"]
+# Columns marking significant features in results files (boolean, then adjusted p-value)
+SIGNIFICANT_RESULT_COLUMNS = ["Reject_H0", "significant"]
+ADJUSTED_P_RESULT_COLUMNS = ["q_value", "KW_padj", "padj", "p_adj"]
+
 def setup_logger(log_file=None, log_level=logging.INFO):
     """Set up the logger with console and optional file output."""
     # Remove any existing handlers to avoid duplication
@@ -88,8 +113,9 @@ def read_and_process_data(
     sample_id_col: Optional[str] = None, 
     group_col: str = "Group",
     feature_type: str = "pathway",
-    log_transform: bool = True
-) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, List[str], str, str]:
+    log_transform: bool = True,
+    sparse: Optional[bool] = None
+) -> Tuple[Union[pd.DataFrame, AbundanceMatrix], Union[pd.DataFrame, AbundanceMatrix], pd.DataFrame, List[str], str, str]:
     """
     Read abundance and metadata files and prepare data for visualization.
     
@@ -100,15 +126,25 @@ def read_and_process_data(
         group_col: Column in metadata for grouping
         feature_type: Type of features in abundance file ("pathway" or "gene")
         log_transform: Whether to apply log10(x+1) transformation
+        sparse: Keep the abundance table as a sparse AbundanceMatrix (default: only
+                for gene families)
         
     Returns:
-        Tuple of (abundance_df, abundance_transformed, merged_long_df, groups, feature_col, sample_id_col)
+        Tuple of (abundance_df, abundance_transformed, sample_metadata, groups, feature_col, sample_id_col),
+        where sample_metadata holds one metadata row per shared sample; the
+        abundance tables stay wide (see GroupedAbundance for long format)
     """
     logger.info(f"Reading abundance file: {abundance_file}")
     
+    if sparse is None:
+        sparse = feature_type == "gene"
+    
     # Read abundance file
     try:
-        abundance_df = pd.read_csv(abundance_file, sep='\t', index_col=0)
+        if sparse:
+            abundance_df = read_abundance_matrix(abundance_file, logger=logger)
+        else:
+            abundance_df = read_abundance_table(abundance_file, logger=logger)
         logger.info(f"Loaded abundance data with {abundance_df.shape[0]} features and {abundance_df.shape[1]} samples")
     except Exception as e:
         logger.error(f"Error reading abundance file: {str(e)}")
@@ -147,46 +183,45 @@ def read_and_process_data(
         return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), [], "", ""
     
     # Get intersection of samples
-    shared_samples = list(set(abundance_df.columns) & set(metadata_df[sample_id_col]))
+    # Keep the table's sample order, so repeated runs (and cached PCA) see the same input
+    metadata_samples = set(metadata_df[sample_id_col])
+    shared_samples = [sample for sample in abundance_df.columns if sample in metadata_samples]
     if not shared_samples:
         logger.error("No matching samples between abundance data and metadata")
         return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), [], "", ""
     
-    # Filter abundance data to shared samples
-    abundance_filtered = abundance_df[shared_samples]
-    
-    # Apply log transformation if requested
-    if log_transform:
-        logger.info("Applying log10(x+1) transformation")
-        abundance_transformed = np.log10(abundance_filtered + 1)
-    else:
-        abundance_transformed = abundance_filtered
-    
-    # Convert to long format for certain plots
     feature_col = "Pathway" if feature_type == "pathway" else "Gene_Family"
-    long_df = abundance_filtered.reset_index().melt(
-        id_vars=abundance_filtered.index.name, 
-        var_name=sample_id_col, 
-        value_name="Abundance"
-    )
-    
-    # Rename feature column
-    long_df = long_df.rename(columns={abundance_filtered.index.name: feature_col})
     
-    # Merge with metadata
-    merged_df = pd.merge(
-        long_df, 
-        metadata_df,
-        on=sample_id_col,
-        how="inner"
-    )
+    if sparse:
+        # Transform without densifying; zeros stay implicit
+        abundance_filtered = abundance_df.select_samples(shared_samples)
+        if log_transform:
+            logger.info("Applying log10(x+1) transformation")
+            abundance_transformed = abundance_filtered.log_transform(base=10, pseudocount=1.0)
+        else:
+            abundance_transformed = abundance_filtered
+    else:
+        # Filter abundance data to shared samples
+        abundance_filtered = abundance_df[shared_samples]
+        
+        # Apply log transformation if requested
+        if log_transform:
+            logger.info("Applying log10(x+1) transformation")
+            abundance_transformed = np.log10(abundance_filtered + 1)
+        else:
+            abundance_transformed = abundance_filtered
+        
+    # Plots work on the wide tables plus each sample's metadata row; a long table
+    # merged with the metadata would repeat every metadata column per feature
+    sample_metadata = metadata_df[metadata_df[sample_id_col].isin(shared_samples)]
+    sample_metadata = sample_metadata.drop_duplicates(sample_id_col)
     
     # Get unique groups
-    groups = metadata_df[group_col].unique().tolist()
+    groups = sample_metadata[group_col].unique().tolist()
     
     logger.info(f"Successfully processed data with {len(shared_samples)} samples and {len(groups)} groups")
     
-    return abundance_filtered, abundance_transformed, merged_df, groups, feature_col, sample_id_col
+    return abundance_filtered, abundance_transformed, sample_metadata, groups, feature_col, sample_id_col
 
 def generate_pca_plot(
     abundance_transformed: pd.DataFrame,
@@ -197,11 +232,18 @@ def generate_pca_plot(
     output_dir: str = "./visualizations",
     output_format: str = "svg",
     dpi: int = 300,
-    feature_type: str = "pathway"
+    feature_type: str = "pathway",
+    grouped: Optional[GroupedAbundance] = None,
+    pca_method: str = "auto",
+    n_components: int = DEFAULT_COMPONENTS,
+    cache_dir: Optional[str] = None
 ) -> str:
     """
     Generate PCA plot from abundance data.
     
+    Computes n_components components (see analysis.pca.run_pca) and writes
+    their explained variance next to the plot.
+    
     Args:
         abundance_transformed: Transformed abundance data
         metadata_df: Metadata DataFrame
@@ -212,37 +254,44 @@ def generate_pca_plot(
         output_format: Output file format (svg, png, pdf)
         dpi: DPI for raster formats
         feature_type: Type of features ("pathway" or "gene")
+        grouped: Shared GroupedAbundance of the same data (built from the
+                 arguments if None)
+        pca_method: PCA backend ("auto", "full", "randomized" or "incremental")
+        n_components: Number of components to compute (at least 2)
+        cache_dir: Directory for cached PCA results (None = no caching)
         
     Returns:
         Path to output file
     """
     logger.info("Generating PCA plot...")
     
-    # Get shared samples
-    shared_samples = list(set(abundance_transformed.columns) & set(metadata_df[sample_id_col]))
-    
-    # Filter data to shared samples
-    abundance_filtered = abundance_transformed[shared_samples]
-    
-    # Scale data
-    scaler = StandardScaler()
-    scaled_data = scaler.fit_transform(abundance_filtered.T)
-    
-    # Run PCA
-    pca = PCA(n_components=2)
-    pca_result = pca.fit_transform(scaled_data)
+    if grouped is None:
+        grouped = GroupedAbundance(abundance_transformed, sample_group_vector(metadata_df, sample_id_col, group_col),
+                                   transformed=abundance_transformed)
+    shared_samples = grouped.samples
+    
+    # Scaled PCA; sparse tables are standardized implicitly, not densified
+    pca = run_pca(grouped.transformed, n_components=max(n_components, 2), method=pca_method,
+                  cache_dir=cache_dir, logger=logger)
+    if pca.scores.shape[1] < 2:
+        logger.error("PCA plot needs at least 2 samples and 2 features")
+        return None
+    
+    # Explained variance of every computed component
+    variance_df = pca.variance_table()
+    for row in variance_df.itertuples(index=False):
+        logger.info(f"{row.Component}: {row.ExplainedVarianceRatio * 100:.1f}% of variance "
+                    f"({row.CumulativeRatio * 100:.1f}% cumulative)")
+    variance_file = os.path.join(output_dir, f"pca_{feature_type}_explained_variance.tsv")
+    variance_df.to_csv(variance_file, sep='\t', index=False)
     
     # Create DataFrame with PCA results
-    pca_df = pd.DataFrame(
-        data=pca_result,
-        columns=['PC1', 'PC2'],
-        index=shared_samples
-    )
+    pca_df = pca.scores[['PC1', 'PC2']].reindex(shared_samples)
     
-    # Add metadata
+    # Add metadata, one row per sample
     pca_df = pd.merge(
         pca_df.reset_index(),
-        metadata_df,
+        metadata_df.drop_duplicates(sample_id_col),
         left_on='index',
         right_on=sample_id_col,
         how='inner'
@@ -274,7 +323,7 @@ def generate_pca_plot(
         )
     
     # Add variance explained
-    variance_explained = pca.explained_variance_ratio_ * 100
+    variance_explained = pca.explained_variance_ratio * 100
     plt.xlabel(f'PC1 ({variance_explained[0]:.1f}%)')
     plt.ylabel(f'PC2 ({variance_explained[1]:.1f}%)')
     
@@ -294,6 +343,110 @@ def generate_pca_plot(
     logger.info(f"PCA plot saved to {output_file}")
     return output_file
 
+def generate_pcoa_plot(
+    abundance_df: pd.DataFrame,
+    metadata_df: pd.DataFrame,
+    sample_id_col: str,
+    group_col: str,
+    shape_col: Optional[str] = None,
+    output_dir: str = "./visualizations",
+    output_format: str = "svg",
+    dpi: int = 300,
+    feature_type: str = "pathway",
+    grouped: Optional[GroupedAbundance] = None,
+    metric: str = "braycurtis",
+    permutations: int = 999,
+    threads: Optional[int] = None,
+    cache_dir: Optional[str] = None
+) -> str:
+    """
+    Generate a PCoA ordination plot from a beta-diversity distance matrix.
+    
+    Distances are computed on the raw abundances (see analysis.beta_diversity),
+    also for sparse gene family tables, and tested for group differences with
+    PERMANOVA.
+    
+    Args:
+        abundance_df: Abundance data (not log-transformed)
+        metadata_df: Metadata DataFrame
+        sample_id_col: Column in metadata for sample IDs
+        group_col: Column in metadata for grouping/coloring
+        shape_col: Optional column in metadata for point shapes
+        output_dir: Directory for output files
+        output_format: Output file format (svg, png, pdf)
+        dpi: DPI for raster formats
+        feature_type: Type of features ("pathway" or "gene")
+        grouped: Shared GroupedAbundance of the same data (built from the
+                 arguments if None)
+        metric: Distance metric ("braycurtis", "jaccard" or "aitchison")
+        permutations: PERMANOVA permutations (0 = no test)
+        threads: Threads computing the distance matrix (default: all CPUs)
+        cache_dir: Directory for cached distance matrices (None = no caching)
+    
+    Returns:
+        Path to output file
+    """
+    logger.info(f"Generating PCoA plot ({metric} distances)...")
+    
+    if grouped is None:
+        grouped = GroupedAbundance(abundance_df, sample_group_vector(metadata_df, sample_id_col, group_col))
+    
+    distances = distance_matrix(grouped.abundance, metric=metric, n_jobs=threads, cache_dir=cache_dir,
+                                logger=logger)
+    ordination = pcoa(distances)
+    if ordination.scores.shape[1] < 2:
+        logger.error("PCoA plot needs at least 2 positive eigenvalues")
+        return None
+    
+    variance_df = ordination.variance_table()
+    variance_file = os.path.join(output_dir, f"pcoa_{metric}_{feature_type}_explained_variance.tsv")
+    variance_df.to_csv(variance_file, sep='\t', index=False)
+    
+    title_suffix = ""
+    if permutations > 0:
+        test = permanova(distances, grouped.sample_groups, permutations=permutations)
+        logger.info(f"PERMANOVA ({metric}, {group_col}): pseudo-F = {test['test_statistic']:.3f}, "
+                    f"p = {test['p_value']:.4f} ({permutations} permutations)")
+        title_suffix = f"\nPERMANOVA pseudo-F = {test['test_statistic']:.2f}, p = {test['p_value']:.3g}"
+    
+    # Add metadata, one row per sample
+    pcoa_df = pd.merge(
+        ordination.scores[['PCo1', 'PCo2']].rename_axis(None).reset_index(),
+        metadata_df.drop_duplicates(sample_id_col),
+        left_on='index',
+        right_on=sample_id_col,
+        how='inner'
+    )
+    
+    plt.figure(figsize=(10, 8))
+    sns.scatterplot(
+        data=pcoa_df,
+        x='PCo1',
+        y='PCo2',
+        hue=group_col,
+        style=shape_col if shape_col and shape_col in metadata_df.columns else None,
+        s=100,
+        alpha=0.8
+    )
+    
+    variance_explained = ordination.explained_variance_ratio * 100
+    plt.xlabel(f'PCo1 ({variance_explained[0]:.1f}%)')
+    plt.ylabel(f'PCo2 ({variance_explained[1]:.1f}%)')
+    
+    feature_type_plural = "Pathways" if feature_type == "pathway" else "Gene Families"
+    metric_name = {"braycurtis": "Bray-Curtis", "jaccard": "Jaccard", "aitchison": "Aitchison"}[metric]
+    plt.title(f'PCoA of {feature_type_plural} ({metric_name}){title_suffix}')
+    
+    plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+    plt.tight_layout()
+    
+    output_file = os.path.join(output_dir, f"pcoa_{metric}_{feature_type}.{output_format}")
+    plt.savefig(output_file, dpi=dpi, bbox_inches='tight')
+    plt.close()
+    
+    logger.info(f"PCoA plot saved to {output_file}")
+    return output_file
+
 def generate_heatmap(
     abundance_transformed: pd.DataFrame,
     metadata_df: pd.DataFrame,
@@ -303,7 +456,8 @@ def generate_heatmap(
     output_format: str = "svg",
     dpi: int = 300,
     feature_type: str = "pathway",
-    top_n: int = 25
+    top_n: int = 25,
+    grouped: Optional[GroupedAbundance] = None
 ) -> str:
     """
     Generate heatmap of top features.
@@ -318,30 +472,27 @@ def generate_heatmap(
         dpi: DPI for raster formats
         feature_type: Type of features ("pathway" or "gene")
         top_n: Number of top features to include
+        grouped: Shared GroupedAbundance of the same data (built from the
+                 arguments if None)
         
     Returns:
         Path to output file
     """
     logger.info(f"Generating heatmap of top {top_n} features...")
     
-    # Get shared samples
-    shared_samples = list(set(abundance_transformed.columns) & set(metadata_df[sample_id_col]))
-    
-    # Filter data to shared samples
-    abundance_filtered = abundance_transformed[shared_samples]
-    
-    # Calculate feature means and select top features
-    feature_means = abundance_filtered.mean(axis=1)
-    top_features = feature_means.sort_values(ascending=False).head(top_n).index
+    if grouped is None:
+        grouped = GroupedAbundance(abundance_transformed, sample_group_vector(metadata_df, sample_id_col, group_col),
+                                   transformed=abundance_transformed)
     
-    # Filter to top features
-    top_data = abundance_filtered.loc[top_features]
+    # Rank features on the wide table and densify only the top rows
+    top_features = grouped.top_features(top_n, transformed=True)
+    top_data = grouped.feature_table(top_features, transformed=True)
     
     # Get sample grouping
-    sample_groups = metadata_df.set_index(sample_id_col).loc[shared_samples, group_col]
+    sample_groups = grouped.sample_groups
     
     # Sort samples by group
-    sorted_samples = sample_groups.sort_values().index
+    sorted_samples = sample_groups.sort_values(kind="stable").index
     
     # Prepare data for heatmap
     heatmap_data = top_data[sorted_samples]
@@ -388,7 +539,8 @@ def generate_barplot(
     output_format: str = "svg",
     dpi: int = 300,
     feature_type: str = "pathway",
-    top_n: int = 25
+    top_n: int = 25,
+    grouped: Optional[GroupedAbundance] = None
 ) -> str:
     """
     Generate barplot of top features by group.
@@ -403,38 +555,26 @@ def generate_barplot(
         dpi: DPI for raster formats
         feature_type: Type of features ("pathway" or "gene")
         top_n: Number of top features to include
+        grouped: Shared GroupedAbundance of the same data (built from the
+                 arguments if None)
         
     Returns:
         Path to output file
     """
     logger.info(f"Generating barplot of top {top_n} features...")
     
-    # Get shared samples
-    shared_samples = list(set(abundance_df.columns) & set(metadata_df[sample_id_col]))
+    if grouped is None:
+        grouped = GroupedAbundance(abundance_df, sample_group_vector(metadata_df, sample_id_col, group_col))
     
-    # Filter data to shared samples
-    abundance_filtered = abundance_df[shared_samples]
-    
-    # Get group information for each sample
-    sample_groups = metadata_df.set_index(sample_id_col).loc[shared_samples, group_col]
-    
-    # Calculate mean abundance per group
-    group_means = {}
-    for group in sample_groups.unique():
-        group_samples = sample_groups[sample_groups == group].index
-        group_means[group] = abundance_filtered[group_samples].mean(axis=1)
-    
-    # Combine group means into a DataFrame
-    mean_df = pd.DataFrame(group_means)
-    
-    # Calculate overall mean abundance for each feature
-    mean_df['overall_mean'] = mean_df.mean(axis=1)
+    # Mean abundance per group (features x groups), shared with other plots
+    mean_df = grouped.group_means
     
     # Sort by overall mean abundance and get top N features
-    top_features = mean_df.sort_values('overall_mean', ascending=False).head(top_n).drop('overall_mean', axis=1)
+    overall_mean = mean_df.mean(axis=1)
+    top_features = overall_mean.sort_values(ascending=False, kind="stable").head(top_n).index
     
     # Transpose for easier plotting
-    plot_df = top_features.transpose()
+    plot_df = mean_df.loc[top_features].transpose()
     
     # Create bar plot
     plt.figure(figsize=(12, 8))
@@ -469,7 +609,8 @@ def generate_feature_boxplot(
     output_format: str = "svg",
     dpi: int = 300,
     log_transform: bool = True,
-    feature_type: str = "pathway"
+    feature_type: str = "pathway",
+    grouped: Optional[GroupedAbundance] = None
 ) -> str:
     """
     Generate boxplot for a specific feature.
@@ -485,6 +626,8 @@ def generate_feature_boxplot(
         dpi: DPI for raster formats
         log_transform: Whether to apply log10(x+1) transformation
         feature_type: Type of features ("pathway" or "gene")
+        grouped: Shared GroupedAbundance of the same data (built from the
+                 arguments if None)
         
     Returns:
         Path to output file
@@ -496,27 +639,14 @@ def generate_feature_boxplot(
         logger.error(f"Feature '{feature}' not found in abundance data")
         return ""
     
-    # Get shared samples
-    shared_samples = list(set(abundance_df.columns) & set(metadata_df[sample_id_col]))
+    if grouped is None:
+        grouped = GroupedAbundance(abundance_df, sample_group_vector(metadata_df, sample_id_col, group_col),
+                                   log_transform=log_transform)
     
-    # Filter data to shared samples
-    abundance_filtered = abundance_df[shared_samples]
+    y_label = "log10(Abundance + 1)" if log_transform else "Abundance"
     
-    # Get feature abundance
-    feature_abundance = abundance_filtered.loc[feature]
-    
-    # Apply log transformation if requested
-    if log_transform:
-        feature_abundance = np.log10(feature_abundance + 1)
-        y_label = f"log10(Abundance + 1)"
-    else:
-        y_label = "Abundance"
-    
-    # Create DataFrame for plotting
-    plot_df = pd.DataFrame({
-        'Abundance': feature_abundance,
-        group_col: [metadata_df.set_index(sample_id_col).loc[sample, group_col] for sample in shared_samples]
-    })
+    # Long format of just this feature
+    plot_df = grouped.to_long([feature], transformed=log_transform, group_col=group_col)
     
     # Create plot
     plt.figure(figsize=(10, 6))
@@ -556,7 +686,8 @@ def generate_abundance_histogram(
     output_format: str = "svg",
     dpi: int = 300,
     log_transform: bool = True,
-    feature_type: str = "pathway"
+    feature_type: str = "pathway",
+    grouped: Optional[GroupedAbundance] = None
 ) -> str:
     """
     Generate histograms of abundance distributions.
@@ -571,28 +702,24 @@ def generate_abundance_histogram(
         dpi: DPI for raster formats
         log_transform: Whether to apply log10(x+1) transformation
         feature_type: Type of features ("pathway" or "gene")
+        grouped: Shared GroupedAbundance of the same data (built from the
+                 arguments if None)
         
     Returns:
         Path to output file
     """
     logger.info("Generating abundance histograms...")
     
-    # Get shared samples
-    shared_samples = list(set(abundance_df.columns) & set(metadata_df[sample_id_col]))
-    
-    # Filter data to shared samples
-    abundance_filtered = abundance_df[shared_samples]
+    if grouped is None:
+        grouped = GroupedAbundance(abundance_df, sample_group_vector(metadata_df, sample_id_col, group_col),
+                                   log_transform=log_transform)
     
     # Apply log transformation if requested
-    if log_transform:
-        abundance_transformed = np.log10(abundance_filtered + 1)
-        transform_label = "log10(Abundance + 1)"
-    else:
-        abundance_transformed = abundance_filtered
-        transform_label = "Abundance"
+    abundance_transformed = grouped.transformed if log_transform else grouped.abundance
+    transform_label = "log10(Abundance + 1)" if log_transform else "Abundance"
     
     # Get group information
-    sample_groups = metadata_df.set_index(sample_id_col).loc[shared_samples, group_col]
+    sample_groups = grouped.sample_groups
     
     # Create plot
     plt.figure(figsize=(12, 8))
@@ -600,7 +727,11 @@ def generate_abundance_histogram(
     # Plot histograms for each group
     for group in sample_groups.unique():
         group_samples = sample_groups[sample_groups == group].index
-        group_data = abundance_transformed[group_samples].values.flatten()
+        if isinstance(abundance_transformed, AbundanceMatrix):
+            # Only non-zero values are plotted, which are exactly the stored entries
+            group_data = abundance_transformed.select_samples(group_samples).matrix.data
+        else:
+            group_data = abundance_transformed[group_samples].values.flatten()
         
         # Filter out zeros and NaNs
         group_data = group_data[~np.isnan(group_data)]
@@ -626,6 +757,67 @@ def generate_abundance_histogram(
     logger.info(f"Abundance histogram saved to {output_file}")
     return output_file
 
+def read_feature_list(features_file: str, alpha: Optional[float] = 0.05) -> List[str]:
+    """
+    Read the features to plot from a results file or a plain list.
+    
+    Results files (CSV/TSV from the statistics or differential abundance steps)
+    are reduced to their significant features: rows flagged in Reject_H0 or
+    significant, or else with an adjusted p-value (q_value, KW_padj, ...) below
+    alpha. Files without a known feature column are read as one feature per line.
+    
+    Args:
+        features_file: Results file or text file with one feature per line
+        alpha: Significance threshold for adjusted p-values (None = all rows)
+    
+    Returns:
+        List of unique features in file order
+    """
+    try:
+        results = pd.read_csv(features_file, sep=None, engine="python")
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError):
+        results = pd.DataFrame()
+    feature_col = next((col for col in FEATURE_RESULT_COLUMNS if col in results.columns), None)
+    if feature_col is None:
+        with open(features_file) as f:
+            features = [line.strip() for line in f if line.strip()]
+        return list(dict.fromkeys(features))
+    
+    if alpha is not None:
+        flag_col = next((col for col in SIGNIFICANT_RESULT_COLUMNS if col in results.columns), None)
+        padj_col = next((col for col in ADJUSTED_P_RESULT_COLUMNS if col in results.columns), None)
+        if flag_col is not None:
+            results = results[results[flag_col].astype(str).str.lower().isin(["true", "1"])]
+        elif padj_col is not None:
+            results = results[results[padj_col] < alpha]
+    return list(dict.fromkeys(results[feature_col].dropna().astype(str)))
+
+# Plot type -> (generator, name of its abundance argument)
+PLOT_GENERATORS = {
+    "pca": (generate_pca_plot, "abundance_transformed"),
+    "pcoa": (generate_pcoa_plot, "abundance_df"),
+    "barplot": (generate_barplot, "abundance_df"),
+    "heatmap": (generate_heatmap, "abundance_transformed"),
+    "histogram": (generate_abundance_histogram, "abundance_df"),
+    "boxplot": (generate_feature_boxplot, "abundance_df"),
+}
+
+def _render_plot(tables, context, plot_type, kwargs):
+    """
+    Render one figure (task function for utils.render_pool.render_tasks).
+    
+    Worker processes build their GroupedAbundance from the shared abundance
+    table on their first task and reuse it for the rest.
+    """
+    grouped = context.get("grouped")
+    if grouped is None:
+        grouped = context["grouped"] = GroupedAbundance(tables["abundance"], context["sample_groups"],
+                                                        log_transform=context["log_transform"])
+    generator, abundance_arg = PLOT_GENERATORS[plot_type]
+    abundance = grouped.transformed if abundance_arg == "abundance_transformed" else grouped.abundance
+    return generator(**{abundance_arg: abundance}, metadata_df=context["sample_metadata"], grouped=grouped,
+                     **context["common"], **kwargs)
+
 def parse_args():
     """Parse command line arguments for the Visualization module."""
     parser = argparse.ArgumentParser(
@@ -647,6 +839,7 @@ Key Features:
 
 Plot Types:
   • PCA: Principal Component Analysis for sample clustering and dimensionality reduction
+  • PCoA: Principal Coordinates of Bray-Curtis, Jaccard or Aitchison distances, with a PERMANOVA test
   • Heatmap: Hierarchical clustering heatmap of top features across samples
   • Barplot: Grouped bar charts of top features by group
   • Boxplot: Distribution boxplots for specific features
@@ -658,6 +851,9 @@ Common Usage:
 
   # Generate specific visualization types:
   humann3-tools viz --abundance-file joined_output/pathway_abundance_cpm_unstratified.tsv --metadata-file metadata.csv --pca --heatmap
+  
+  # Boxplots for every significant pathway of a statistics run, on 8 worker processes:
+  humann3-tools viz --abundance-file joined_output/pathway_abundance_cpm_unstratified.tsv --metadata-file metadata.csv --features-from kruskal_wallis_pathways.csv --render-workers 8
 
   # Create boxplot for a specific pathway:
   humann3-tools viz --abundance-file joined_output/pathway_abundance_cpm_unstratified.tsv --metadata-file metadata.csv --feature "PWY-7219: adenosine ribonucleotides de novo biosynthesis"
@@ -698,6 +894,22 @@ Common Usage:
     # Plot selection
     parser.add_argument("--pca", action="store_true", default=True,
                       help="Generate PCA plot")
+    parser.add_argument("--pca-method", default="auto", choices=list(PCA_METHODS),
+                      help="PCA backend: full, randomized truncated SVD, incremental over feature "
+                           "chunks, or auto (full for small dense tables, randomized otherwise)")
+    parser.add_argument("--pca-components", type=int, default=DEFAULT_COMPONENTS,
+                      help=f"Number of principal components to compute and report explained "
+                           f"variance for (default: {DEFAULT_COMPONENTS})")
+    parser.add_argument("--no-pca-cache", action="store_true",
+                      help="Do not cache PCA results in <output-dir>/pca_cache")
+    parser.add_argument("--pcoa", action="store_true",
+                      help="Generate PCoA ordination plot of beta-diversity distances, with PERMANOVA")
+    parser.add_argument("--distance-metric", default="braycurtis", choices=list(DISTANCE_METRICS),
+                      help="Distance metric for --pcoa (default: braycurtis)")
+    parser.add_argument("--permutations", type=int, default=999,
+                      help="PERMANOVA permutations for --pcoa (0 to skip the test; default: 999)")
+    parser.add_argument("--threads", type=int,
+                      help="Threads for distance calculations (default: all CPUs)")
     parser.add_argument("--heatmap", action="store_true",
                       help="Generate heatmap of top features")
     parser.add_argument("--barplot", action="store_true", default=True,
@@ -708,6 +920,16 @@ Common Usage:
     # Boxplot specific options
     parser.add_argument("--feature", 
                       help="Generate boxplot for a specific feature (pathway or gene)")
+    parser.add_argument("--features-from",
+                      help="Generate boxplots for the significant features of a results file (e.g. "
+                           "kruskal_wallis_pathways.csv, aldex2_results.csv) or a list with one feature per line")
+    parser.add_argument("--features-alpha", type=float, default=0.05,
+                      help="Adjusted p-value threshold for --features-from results files (default: 0.05)")
+    
+    # Rendering options
+    parser.add_argument("--render-workers", type=int,
+                      help=f"Worker processes rendering figures in parallel (default: all CPUs when "
+                           f"there are at least {PARALLEL_RENDER_MIN_TASKS} figures, otherwise 1)")
     
     # Additional options
     parser.add_argument("--log-transform", action="store_true", default=True,
@@ -743,7 +965,7 @@ def main():
     os.makedirs(args.output_dir, exist_ok=True)
     
     # Read and process data
-    abundance_df, abundance_transformed, merged_df, groups, feature_col, sample_id_col = read_and_process_data(
+    abundance_df, abundance_transformed, sample_metadata, groups, feature_col, sample_id_col = read_and_process_data(
         abundance_file=args.abundance_file,
         metadata_file=args.metadata_file,
         sample_id_col=args.sample_id_col,
@@ -756,92 +978,88 @@ def main():
         logger.error("Failed to process input data")
         return 1
     
-    # Track which visualizations were generated
-    generated_visualizations = []
+    # Wide tables plus each sample's group; statistics are computed once on
+    # first use and shared by the plots below
+    grouped = GroupedAbundance(
+        abundance_df,
+        sample_group_vector(sample_metadata, sample_id_col, args.group_col),
+        transformed=abundance_transformed,
+        log_transform=args.log_transform
+    )
     
-    # Generate requested plots
+    # Figures to render: (plot type, label, generator-specific arguments)
+    tasks = []
     if args.pca:
-        output_file = generate_pca_plot(
-            abundance_transformed=abundance_transformed,
-            metadata_df=merged_df,
-            sample_id_col=sample_id_col,
-            group_col=args.group_col,
-            shape_col=args.shape_col,
-            output_dir=args.output_dir,
-            output_format=args.format,
-            dpi=args.dpi,
-            feature_type=args.feature_type
-        )
-        if output_file:
-            generated_visualizations.append(("PCA Plot", output_file))
-    
+        tasks.append(("pca", "PCA Plot", {
+            "shape_col": args.shape_col,
+            "pca_method": args.pca_method,
+            "n_components": args.pca_components,
+            "cache_dir": None if args.no_pca_cache else os.path.join(args.output_dir, "pca_cache")
+        }))
+    if args.pcoa:
+        tasks.append(("pcoa", "PCoA Plot", {
+            "shape_col": args.shape_col,
+            "metric": args.distance_metric,
+            "permutations": args.permutations,
+            "threads": args.threads,
+            "cache_dir": os.path.join(args.output_dir, "distance_cache")
+        }))
     if args.barplot:
-        output_file = generate_barplot(
-            abundance_df=abundance_df,
-            metadata_df=merged_df,
-            sample_id_col=sample_id_col,
-            group_col=args.group_col,
-            output_dir=args.output_dir,
-            output_format=args.format,
-            dpi=args.dpi,
-            feature_type=args.feature_type,
-            top_n=args.top_n
-        )
-        if output_file:
-            generated_visualizations.append(("Barplot", output_file))
-    
+        tasks.append(("barplot", "Barplot", {"top_n": args.top_n}))
     if args.heatmap:
-        output_file = generate_heatmap(
-            abundance_transformed=abundance_transformed,
-            metadata_df=merged_df,
-            sample_id_col=sample_id_col,
-            group_col=args.group_col,
-            output_dir=args.output_dir,
-            output_format=args.format,
-            dpi=args.dpi,
-            feature_type=args.feature_type,
-            top_n=args.top_n
-        )
-        if output_file:
-            generated_visualizations.append(("Heatmap", output_file))
-    
+        tasks.append(("heatmap", "Heatmap", {"top_n": args.top_n}))
     if args.abundance_hist:
-        output_file = generate_abundance_histogram(
-            abundance_df=abundance_df,
-            metadata_df=merged_df,
-            sample_id_col=sample_id_col,
-            group_col=args.group_col,
-            output_dir=args.output_dir,
-            output_format=args.format,
-            dpi=args.dpi,
-            log_transform=args.log_transform,
-            feature_type=args.feature_type
-        )
-        if output_file:
-            generated_visualizations.append(("Abundance Histogram", output_file))
-    
-    # Handle feature boxplot if specified
-    if args.feature:
-        output_file = generate_feature_boxplot(
-            abundance_df=abundance_df,
-            metadata_df=merged_df,
-            feature=args.feature,
-            sample_id_col=sample_id_col,
-            group_col=args.group_col,
-            output_dir=args.output_dir,
-            output_format=args.format,
-            dpi=args.dpi,
-            log_transform=args.log_transform,
-            feature_type=args.feature_type
-        )
-        if output_file:
-            generated_visualizations.append(("Feature Boxplot", output_file))
+        tasks.append(("histogram", "Abundance Histogram", {"log_transform": args.log_transform}))
+    
+    # Feature boxplots, for --feature and every feature of --features-from
+    features = [args.feature] if args.feature else []
+    if args.features_from:
+        if not os.path.exists(args.features_from):
+            logger.error(f"ERROR: Features file not found: {args.features_from}")
+            return 1
+        listed = read_feature_list(args.features_from, alpha=args.features_alpha)
+        logger.info(f"Read {len(listed)} features from {args.features_from}")
+        features.extend(listed)
+    for feature in dict.fromkeys(features):
+        tasks.append(("boxplot", f"Feature Boxplot: {feature}",
+                      {"feature": feature, "log_transform": args.log_transform}))
+    
+    # Render, in worker processes sharing one copy of the table when there are many figures
+    render_workers = args.render_workers
+    if render_workers is None:
+        render_workers = (os.cpu_count() or 1) if len(tasks) >= PARALLEL_RENDER_MIN_TASKS else 1
+    context = {
+        "sample_metadata": sample_metadata,
+        "sample_groups": grouped.sample_groups,
+        "log_transform": args.log_transform,
+        "common": {
+            "sample_id_col": sample_id_col,
+            "group_col": args.group_col,
+            "output_dir": args.output_dir,
+            "output_format": args.format,
+            "dpi": args.dpi,
+            "feature_type": args.feature_type
+        }
+    }
+    if render_workers <= 1 or len(tasks) <= 1:
+        # Rendering here: share the statistics already computed
+        context["grouped"] = grouped
+    records = render_tasks(_render_plot, tasks, {"abundance": grouped.abundance}, context,
+                           max_workers=render_workers, logger=logger)
+    
+    index_file = write_render_index(records, os.path.join(args.output_dir, "visualization_index.tsv"))
+    generated_visualizations = [(record["Label"], record["File"]) for record in records
+                                if record["Status"] == "completed"]
+    for record in records:
+        if record["Status"] != "completed":
+            logger.error(f"Failed to render {record['Label']}: {record['Error']}")
     
     # Print summary of generated visualizations
     if generated_visualizations:
         logger.info("\nGenerated Visualizations:")
         for viz_type, viz_path in generated_visualizations:
             logger.info(f"  {viz_type}: {viz_path}")
+        logger.info(f"Index of outputs: {index_file}")
     else:
         logger.info("\nNo visualizations were generated. Use options like --pca, --heatmap, --feature, etc.")
     
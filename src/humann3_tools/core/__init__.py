@@ -8,21 +8,18 @@ This package contains the core functionality for the different steps of the work
 - join_unstratify.py: Join and unstratify operations
 """
 
-from src.humann3_tools.core.kneaddata import (
-    check_kneaddata_installation,
-    run_kneaddata,
-    run_kneaddata_parallel
-)
+from src.humann3_tools.utils.lazy_imports import lazy_attributes
 
-from src.humann3_tools.core.humann3 import (
-    run_full_pipeline,
-    run_preprocessing_and_analysis,
-    process_humann3_files_only,
-    analyze_existing_humann3_files,
-    run_pathway_differential_abundance,
-    run_gene_differential_abundance
-)
-
-from src.humann3_tools.core.join_unstratify import (
-    process_join_unstratify
-)
+# Re-exports are imported on first use (see utils.lazy_imports)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "check_kneaddata_installation": "src.humann3_tools.core.kneaddata",
+    "run_kneaddata": "src.humann3_tools.core.kneaddata",
+    "run_kneaddata_parallel": "src.humann3_tools.core.kneaddata",
+    "run_full_pipeline": "src.humann3_tools.core.humann3",
+    "run_preprocessing_and_analysis": "src.humann3_tools.core.humann3",
+    "process_humann3_files_only": "src.humann3_tools.core.humann3",
+    "analyze_existing_humann3_files": "src.humann3_tools.core.humann3",
+    "run_pathway_differential_abundance": "src.humann3_tools.core.humann3",
+    "run_gene_differential_abundance": "src.humann3_tools.core.humann3",
+    "process_join_unstratify": "src.humann3_tools.core.join_unstratify",
+})
@@ -17,13 +17,12 @@ from src.humann3_tools.utils.file_utils import check_file_exists_with_logger
 from src.humann3_tools.humann3.pathway_processing import process_pathway_abundance
 from src.humann3_tools.humann3.gene_processing import process_gene_families
 from src.humann3_tools.analysis.metadata import read_and_process_metadata
-from src.humann3_tools.analysis.visualizations import (
-    read_and_process_gene_families,
-    read_and_process_pathways,
-)
-from src.humann3_tools.analysis.statistical import run_statistical_tests
-from src.humann3_tools.analysis.differential_abundance import run_differential_abundance_analysis
-from src.humann3_tools.preprocessing.pipeline import run_preprocessing_pipeline
+# The plotting, statistics and differential abundance modules (matplotlib,
+# seaborn, sklearn, statsmodels, scikit-posthocs) are imported inside the
+# functions that use them, so importing this module stays fast
+from src.humann3_tools.analysis.abundance_matrix import read_abundance_matrix
+from src.humann3_tools.utils.table_cache import read_abundance_table
+from src.humann3_tools.preprocessing.pipeline import run_preprocessing_pipeline, run_preprocessing_pipeline_parallel
 
 
 def run_full_pipeline(
@@ -121,6 +120,11 @@ def run_full_pipeline(
                     log_print("Cannot proceed with downstream analysis; missing sample key", level="error")
                     success = False
                 else:
+                    from src.humann3_tools.analysis.visualizations import (
+                        read_and_process_gene_families,
+                        read_and_process_pathways,
+                    )
+                    from src.humann3_tools.analysis.statistical import run_statistical_tests
                     sample_key_df = read_and_process_metadata(sample_key, logger)
 
                     # Process gene families if available
@@ -167,7 +171,12 @@ def run_preprocessing_and_analysis(
     skip_pathway=False,
     skip_gene=False,
     skip_downstream=False,
-    log_file=None
+    log_file=None,
+    max_parallel=None,
+    pipelined=True,
+    stage_limits=None,
+    resume=False,
+    adaptive_threads=False
 ):
     """
     Run the full preprocessing and analysis pipeline:
@@ -188,6 +197,15 @@ def run_preprocessing_and_analysis(
         skip_gene: Skip gene family processing
         skip_downstream: Skip downstream analysis
         log_file: Path to log file
+        max_parallel: Maximum number of samples preprocessed in parallel
+                      (None = one sample at a time, threads per step)
+        pipelined: Start each sample's HUMAnN3 run as soon as its KneadData run ends
+                   (with max_parallel)
+        stage_limits: Dict of maximum concurrent samples per pipelined stage
+                      ("kneaddata", "prepare", "humann"; with max_parallel)
+        resume: Skip preprocessing steps that completed in a previous run
+        adaptive_threads: Give the last samples the threads left free
+                          (with max_parallel and pipelined=False)
         
     Returns:
         Tuple of (pathway_file, gene_file, success_flag)
@@ -202,16 +220,34 @@ def run_preprocessing_and_analysis(
     os.makedirs(preproc_dir, exist_ok=True)
     
     # Step 1: Run preprocessing (KneadData + HUMAnN3)
-    preprocessing_results = run_preprocessing_pipeline(
-        input_files=input_fastq,
-        output_dir=preproc_dir,
-        threads=threads,
-        kneaddata_db=kneaddata_db,
-        nucleotide_db=nucleotide_db,
-        protein_db=protein_db,
-        paired=paired,
-        logger=logger
-    )
+    if max_parallel:
+        preprocessing_results = run_preprocessing_pipeline_parallel(
+            input_files=input_fastq,
+            output_dir=preproc_dir,
+            threads_per_sample=threads,
+            max_parallel=max_parallel,
+            kneaddata_dbs=kneaddata_db,
+            nucleotide_db=nucleotide_db,
+            protein_db=protein_db,
+            paired=paired,
+            pipelined=pipelined,
+            stage_limits=stage_limits,
+            resume=resume,
+            adaptive_threads=adaptive_threads,
+            logger=logger
+        )
+    else:
+        preprocessing_results = run_preprocessing_pipeline(
+            input_files=input_fastq,
+            output_dir=preproc_dir,
+            threads=threads,
+            kneaddata_dbs=kneaddata_db,
+            nucleotide_db=nucleotide_db,
+            protein_db=protein_db,
+            paired=paired,
+            resume=resume,
+            logger=logger
+        )
     
     if not preprocessing_results:
         log_print("Preprocessing pipeline failed", level="error")
@@ -266,6 +302,11 @@ def run_preprocessing_and_analysis(
                 os.makedirs(downstream_out, exist_ok=True)
                 
                 # Read sample metadata
+                from src.humann3_tools.analysis.visualizations import (
+                    read_and_process_gene_families,
+                    read_and_process_pathways,
+                )
+                from src.humann3_tools.analysis.statistical import run_statistical_tests
                 sample_key_df = read_and_process_metadata(sample_key, logger)
                 
                 # Process gene families if available
@@ -368,6 +409,11 @@ def analyze_existing_humann3_files(
             log_print("Cannot proceed with analysis; missing sample key", level="error")
             return False
 
+        from src.humann3_tools.analysis.visualizations import (
+            read_and_process_gene_families,
+            read_and_process_pathways,
+        )
+        from src.humann3_tools.analysis.statistical import run_statistical_tests
         sample_key_df = read_and_process_metadata(sample_key, logger)
 
         # Process gene families if available
@@ -433,7 +479,7 @@ def run_pathway_differential_abundance(
         os.makedirs(diff_abund_dir, exist_ok=True)
 
         # Read data
-        pathway_df = pd.read_csv(pathway_file, sep="\t", index_col=0)
+        pathway_df = read_abundance_table(pathway_file, logger=logger)
         metadata_df = pd.read_csv(sample_key, index_col=None)
 
         # Get sample ID column (attempt common naming)
@@ -455,6 +501,7 @@ def run_pathway_differential_abundance(
         denom = "all" if include_unmapped else "unmapped_excluded"
 
         # Run differential abundance analysis
+        from src.humann3_tools.analysis.differential_abundance import run_differential_abundance_analysis
         results = run_differential_abundance_analysis(
             pathway_df,
             metadata_df,
@@ -512,8 +559,8 @@ def run_gene_differential_abundance(
         diff_abund_dir = os.path.join(output_dir, "DifferentialAbundance", "Genes")
         os.makedirs(diff_abund_dir, exist_ok=True)
 
-        # Read data
-        gene_df = pd.read_csv(gene_file, sep="\t", index_col=0)
+        # Read data (gene family tables are mostly zeros, so they are loaded sparse)
+        gene_matrix = read_abundance_matrix(gene_file, logger=logger)
         metadata_df = pd.read_csv(sample_key, index_col=None)
 
         # Get sample ID column (attempt common naming)
@@ -531,10 +578,15 @@ def run_gene_differential_abundance(
         # Set the sample ID as index
         metadata_df = metadata_df.set_index(sample_id_col)
 
+        # Only samples with metadata are densified for the tests
+        shared_samples = [sample for sample in gene_matrix.samples if sample in metadata_df.index]
+        gene_df = gene_matrix.select_samples(shared_samples).to_dataframe()
+
         # Decide how to handle unmapped features
         denom = "all" if include_unmapped else "unmapped_excluded"
 
         # Run differential abundance analysis
+        from src.humann3_tools.analysis.differential_abundance import run_differential_abundance_analysis
         results = run_differential_abundance_analysis(
             gene_df,
             metadata_df,
@@ -80,6 +80,13 @@ def process_single_sample_kneaddata(input_file, sample_id=None, output_dir=None,
         if file.endswith(".fastq") and "kneaddata_paired" in file:
             output_files.append(os.path.join(output_dir, file))
     
+    # KneadData names its outputs after the input file; when samples share an output
+    # directory, keep only this sample's files (unless a custom prefix renamed them)
+    input_stem = os.path.basename(input_file).split('.')[0]
+    own_files = [f for f in output_files if os.path.basename(f).startswith(input_stem)]
+    if own_files:
+        output_files = own_files
+    
     logger.info(f"KneadData completed for sample {sample_id} with {len(output_files)} output files")
     return output_files
 
@@ -113,7 +120,9 @@ def paired_kneaddata_wrapper(input_file, sample_id=None, paired_file=None, **kwa
 @track_peak_memory
 def run_kneaddata_parallel(input_files, output_dir, threads=1, max_parallel=None, 
                           reference_dbs=None, paired=False, additional_options=None, 
-                          logger=None):
+                          logger=None, memory_per_sample=None, memory_budget=None,
+                          checkpoint_dir=None, resume=False, metrics_file=None, history_db=None,
+                          adaptive_threads=False):
     """
     Run KneadData on multiple samples in parallel.
     
@@ -126,11 +135,26 @@ def run_kneaddata_parallel(input_files, output_dir, threads=1, max_parallel=None
         paired: Whether input is paired-end
         additional_options: Dict of additional KneadData options
         logger: Logger instance
+        memory_per_sample: Projected peak memory of one KneadData run in MB
+                           (None = predicted from the run history, or
+                           estimate_sample_memory("kneaddata") without history)
+        memory_budget: Memory in MB the concurrent runs may use together
+                       (None = memory available when the run starts)
+        checkpoint_dir: Write a completion manifest per sample here
+        resume: Skip samples whose manifest in checkpoint_dir is still valid
+        metrics_file: File for per-sample resource records
+                      (default: <output_dir>/logs/resource_metrics.jsonl)
+        history_db: Run history database the runtime and memory of each sample are
+                    predicted from and recorded in (None = run_history.run_db_path())
+        adaptive_threads: Run the samples started after the queue drained with
+                          the free threads instead of threads
         
     Returns:
         Dict mapping sample IDs to output files
     """
     from src.humann3_tools.preprocessing.parallel import run_parallel
+    from src.humann3_tools.utils.resource_utils import estimate_sample_memory, default_metrics_file
+    from src.humann3_tools.utils.run_history import RunPredictor
     
     if logger is None:
         logger = logging.getLogger('humann3_analysis')
@@ -176,9 +200,20 @@ def run_kneaddata_parallel(input_files, output_dir, threads=1, max_parallel=None
         'logger': logger
     }
     
+    predictor = RunPredictor.from_history("kneaddata", threads=threads, path=history_db, logger=logger,
+                                          default_memory=estimate_sample_memory("kneaddata"))
+    if memory_per_sample is None:
+        memory_per_sample = predictor.predict_memory
+    if metrics_file is None:
+        metrics_file = default_metrics_file(os.path.join(output_dir, "logs"))
+    
     # Run in parallel with our wrapper function (defined at module level)
     results = run_parallel(sample_list, paired_kneaddata_wrapper, 
-                          max_workers=max_parallel, **kwargs)
+                          max_workers=max_parallel, memory_per_sample=memory_per_sample,
+                          memory_budget=memory_budget, checkpoint_dir=checkpoint_dir,
+                          checkpoint_stage="kneaddata", resume=resume, metrics_file=metrics_file,
+                          runtime_per_sample=predictor.predict_runtime, history_db=history_db,
+                          adaptive_threads=adaptive_threads, **kwargs)
     
     return results
 
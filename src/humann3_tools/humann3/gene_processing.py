@@ -4,8 +4,13 @@ import logging
 
 from src.humann3_tools.logger import log_print
 from src.humann3_tools.utils.cmd_utils import run_cmd
+from src.humann3_tools.humann3.renorm import renorm_tables
+from src.humann3_tools.humann3.table_join import join_split_humann_tables
+from src.humann3_tools.utils.table_cache import write_table_caches
+from src.humann3_tools.utils.file_utils import stage_files
 
-def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, selected_columns=None, units="cpm"):
+def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, selected_columns=None, units="cpm",
+                          engine="humann", threads=1, keep_joined=False, write_cache=True):
     """
     Process gene families: copy, normalize, join, and split.
     Returns path to unstratified gene family file.
@@ -17,10 +22,18 @@ def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, se
         output_prefix: Prefix for output filenames
         selected_columns: Optional dict with sample key column selections
         units: Units for normalization (default: cpm, can be "relab")
+        engine: "humann" to run humann_renorm_table per sample and humann_join_tables,
+                or "native" to normalize in-process and join with a streaming merge
+                (falling back to the humann utilities on failure)
+        threads: Number of worker processes for native normalization and joining
+        keep_joined: With the native engine, also write the joined table (the native
+                     engine otherwise writes the split tables directly)
+        write_cache: Write a columnar sidecar next to the output tables for faster reloads
         
     Returns:
         Path to unstratified gene family file, or None if processing failed
     """
+    logger = logging.getLogger('humann3_analysis')
     log_print(f"PROCESSING GENE FAMILY FILES (using {units} units)", level='info')
     gene_families_out = os.path.join(output_dir, "genes", output_prefix)
     gene_families_norm = os.path.join(gene_families_out, "Normalized")
@@ -46,9 +59,32 @@ def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, se
     units_suffix = f"-{units}"
     
     processed_count = 0
-    for (sample, src_path) in valid_samples:
+    
+    # Native engine: renormalize straight into the Normalized directory
+    remaining_samples = valid_samples
+    if engine == "native":
+        file_pairs = [
+            (src_path, os.path.join(gene_families_norm, f"{sample}_genefamilies{units_suffix}.tsv"))
+            for (sample, src_path) in valid_samples
+        ]
+        native_results = renorm_tables(file_pairs, units=units, update_snames=True, threads=threads)
+        processed_count = sum(1 for output in native_results.values() if output)
+        remaining_samples = [(sample, src_path) for (sample, src_path) in valid_samples
+                             if not native_results.get(src_path)]
+        if remaining_samples:
+            log_print(f"Native renormalization failed for {len(remaining_samples)} samples; "
+                      f"falling back to humann_renorm_table", level='warning')
+    
+    # Link (or copy) the tables in one batch, renormalize, then move the results
+    staged = stage_files(
+        [(src_path, os.path.join(gene_families_out, f"{sample}_genefamilies.tsv"))
+         for (sample, src_path) in remaining_samples],
+        mode="link", logger=logger
+    )
+    normalized = []
+    for (sample, src_path) in remaining_samples:
         dst = os.path.join(gene_families_out, f"{sample}_genefamilies.tsv")
-        if not run_cmd(["cp", src_path, dst], exit_on_error=False):
+        if not staged.get(dst):
             continue
         
         out_norm = os.path.join(gene_families_out, f"{sample}_genefamilies{units_suffix}.tsv")
@@ -59,8 +95,10 @@ def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, se
             "--units", units,
             "--update-snames"
         ], exit_on_error=False):
-            if run_cmd(["mv", out_norm, gene_families_norm], exit_on_error=False):
-                processed_count += 1
+            normalized.append((out_norm, os.path.join(gene_families_norm, os.path.basename(out_norm))))
+    
+    moved = stage_files(normalized, mode="move", logger=logger)
+    processed_count += sum(1 for method in moved.values() if method)
     
     if processed_count == 0:
         log_print("WARNING: No gene family files processed successfully", level='warning')
@@ -72,6 +110,24 @@ def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, se
         return None
     
     joined_output = os.path.join(gene_families_out, f"{output_prefix}_genefamilies{units_suffix}.tsv")
+    # Native engine joins, splits and strips header suffixes in one streaming pass
+    if engine == "native":
+        try:
+            outputs = join_split_humann_tables(
+                gene_families_norm,
+                os.path.join(gene_families_out, f"gene_families{units_suffix}_unstratified.tsv"),
+                os.path.join(gene_families_out, f"gene_families{units_suffix}_stratified.tsv"),
+                joined_file=joined_output if keep_joined else None,
+                strip_headers=True,
+                threads=threads
+            )
+            log_print(f"Wrote unstratified gene families file: {outputs['unstratified']}", level='info')
+            if write_cache:
+                write_table_caches([outputs['unstratified'], outputs['stratified']])
+            return outputs['unstratified']
+        except Exception as e:
+            log_print(f"WARNING: Native join failed ({e}); falling back to humann_join_tables", level='warning')
+    
     run_cmd([
         "humann_join_tables",
         "-i", gene_families_norm,
@@ -144,5 +200,9 @@ def process_gene_families(valid_samples, gene_dir, output_dir, output_prefix, se
     except Exception as e:
         log_print(f"WARNING: Could not rename file: {e}", level='warning')
 
+    if write_cache:
+        stratified_file = os.path.join(gene_families_out, f"gene_families{units_suffix}_stratified.tsv")
+        write_table_caches([unstrat_file, stratified_file if os.path.exists(stratified_file) else None])
+
     return unstrat_file
     
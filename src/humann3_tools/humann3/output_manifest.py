@@ -0,0 +1,189 @@
+# humann3_tools/humann3/output_manifest.py
+"""
+Deterministic resolution of HUMAnN3 output files.
+
+HUMAnN3 names its outputs after --output-basename (or the input file name without
+its extensions), so a sample's outputs can be computed instead of searched for:
+  <output_dir>/<basename>_genefamilies.tsv
+  <output_dir>/<basename>_pathabundance.tsv
+  <output_dir>/<basename>_pathcoverage.tsv
+  <output_dir>/<basename>_humann_temp/<basename>_metaphlan_bugs_list.tsv
+
+The expected paths are checked against one scandir of the sample's output
+directory (plus its temp directory for MetaPhlAn), and the resolved outputs of a
+run are recorded in a run manifest that later steps read instead of walking the
+output tree.
+"""
+import os
+import json
+import logging
+
+RUN_MANIFEST_NAME = "humann3_run_manifest.json"
+OUTPUT_TYPES = ("genefamilies", "pathabundance", "pathcoverage", "metaphlan")
+
+def humann3_output_basename(input_file, additional_options=None):
+    """
+    Basename HUMAnN3 gives the outputs of an input file.
+    
+    Args:
+        input_file: HUMAnN3 input file
+        additional_options: Dict of HUMAnN3 options (output-basename is honoured)
+    
+    Returns:
+        Output file basename
+    """
+    if additional_options and additional_options.get("output-basename"):
+        return str(additional_options["output-basename"])
+    # Same rules as humann.py: drop .gz, then one more extension
+    basename = os.path.basename(input_file)
+    if basename.endswith(".gz"):
+        basename = basename[:-len(".gz")]
+    if "." in basename:
+        basename = basename.rsplit(".", 1)[0]
+    return basename
+
+def expected_humann3_outputs(output_dir, basename, output_format="tsv"):
+    """Paths HUMAnN3 writes for a basename, by output type."""
+    temp_dir = os.path.join(output_dir, f"{basename}_humann_temp")
+    return {
+        "genefamilies": os.path.join(output_dir, f"{basename}_genefamilies.{output_format}"),
+        "pathabundance": os.path.join(output_dir, f"{basename}_pathabundance.{output_format}"),
+        "pathcoverage": os.path.join(output_dir, f"{basename}_pathcoverage.{output_format}"),
+        "metaphlan": os.path.join(temp_dir, f"{basename}_metaphlan_bugs_list.tsv"),
+    }
+
+def _listing(directory):
+    """Names of the regular files in a directory (empty if it does not exist)."""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+def resolve_humann3_outputs(output_dir, input_file, additional_options=None, logger=None):
+    """
+    Resolve the outputs of one HUMAnN3 run.
+    
+    Args:
+        output_dir: Directory passed to humann --output
+        input_file: Input file passed to humann --input
+        additional_options: Dict of HUMAnN3 options used for the run
+        logger: Logger instance
+    
+    Returns:
+        Dict mapping each output type to its path, or None if it was not written
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    options = additional_options or {}
+    basename = humann3_output_basename(input_file, options)
+    expected = expected_humann3_outputs(output_dir, basename, options.get("output-format") or "tsv")
+    
+    # One listing per directory: the sample's output directory, and its temp
+    # directory for the MetaPhlAn profile (missing with --remove-temp-output)
+    listings = {}
+    outputs = {}
+    for output_type in OUTPUT_TYPES:
+        path = expected[output_type]
+        directory = os.path.dirname(path)
+        if directory not in listings:
+            listings[directory] = _listing(directory)
+        outputs[output_type] = path if os.path.basename(path) in listings[directory] else None
+    
+    logger.debug(f"Resolved HUMAnN3 outputs for {basename}: "
+                 f"{', '.join(t for t, p in outputs.items() if p) or 'none'}")
+    return outputs
+
+def read_run_manifest(output_dir):
+    """
+    Read the run manifest of a HUMAnN3 output directory.
+    
+    Returns:
+        Dict mapping sample IDs to {output type: path}, empty if there is no manifest
+    """
+    manifest_file = os.path.join(output_dir, RUN_MANIFEST_NAME)
+    try:
+        with open(manifest_file) as fh:
+            return json.load(fh).get("samples", {})
+    except (OSError, ValueError):
+        return {}
+
+def update_run_manifest(output_dir, sample_outputs, logger=None):
+    """
+    Add the resolved outputs of samples to the run manifest of an output directory.
+    
+    Entries of samples from earlier runs are kept; samples in sample_outputs replace
+    their old entries. Only the parent process should call this, after its workers
+    have finished.
+    
+    Args:
+        output_dir: HUMAnN3 output directory holding the manifest
+        sample_outputs: Dict mapping sample IDs to {output type: path}
+        logger: Logger instance
+    
+    Returns:
+        Path to the manifest, or None if it could not be written
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    samples = read_run_manifest(output_dir)
+    for sample_id, outputs in sample_outputs.items():
+        if isinstance(outputs, dict):
+            samples[sample_id] = {output_type: (os.path.abspath(outputs[output_type])
+                                                if outputs.get(output_type) else None)
+                                  for output_type in OUTPUT_TYPES}
+    
+    manifest_file = os.path.join(output_dir, RUN_MANIFEST_NAME)
+    tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(tmp_file, "w") as fh:
+            json.dump({"samples": samples}, fh, indent=1, sort_keys=True)
+        os.replace(tmp_file, manifest_file)
+    except OSError as e:
+        logger.warning(f"Could not write HUMAnN3 run manifest in {output_dir}: {str(e)}")
+        return None
+    logger.info(f"Recorded outputs of {len(sample_outputs)} samples in {manifest_file}")
+    return manifest_file
+
+def manifest_files(input_dir, file_type, logger=None):
+    """
+    Files of one output type in a directory, as recorded by a run manifest.
+    
+    The manifest is looked up in input_dir and its parent, so the organized
+    per-type directories (e.g. humann3_output/PathAbundance) resolve through the
+    manifest of the run that filled them: a recorded output is used if it lies in
+    input_dir or a file with the same name does.
+    
+    Args:
+        input_dir: Directory holding the per-sample tables
+        file_type: Output type ("genefamilies", "pathabundance", ...)
+        logger: Logger instance
+    
+    Returns:
+        List of paths, or None if no manifest covers the directory
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    input_dir = os.path.abspath(input_dir)
+    for manifest_dir in (input_dir, os.path.dirname(input_dir)):
+        samples = read_run_manifest(manifest_dir)
+        if not samples:
+            continue
+        
+        present = _listing(input_dir)
+        files = []
+        for sample_id in sorted(samples):
+            path = samples[sample_id].get(file_type)
+            if not path:
+                continue
+            name = os.path.basename(path)
+            if name in present:
+                files.append(os.path.join(input_dir, name))
+        if files:
+            logger.info(f"Found {len(files)} {file_type} files from the run manifest in {manifest_dir}")
+            return files
+    return None
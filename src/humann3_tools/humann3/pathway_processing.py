@@ -4,8 +4,13 @@ import logging
 
 from src.humann3_tools.logger import log_print
 from src.humann3_tools.utils.cmd_utils import run_cmd
+from src.humann3_tools.humann3.renorm import renorm_tables
+from src.humann3_tools.humann3.table_join import join_split_humann_tables
+from src.humann3_tools.utils.table_cache import write_table_caches
+from src.humann3_tools.utils.file_utils import stage_files
 
-def process_pathway_abundance(valid_samples, pathway_dir, output_dir, output_prefix, selected_columns=None, units="cpm"):
+def process_pathway_abundance(valid_samples, pathway_dir, output_dir, output_prefix, selected_columns=None, units="cpm",
+                              engine="humann", threads=1, keep_joined=False, write_cache=True):
     """
     Runs humann_renorm_table, humann_join_tables, humann_split_stratified_table, 
     then returns the path to the final unstratified pathway file (renamed to pathway_abundance.tsv).
@@ -17,6 +22,13 @@ def process_pathway_abundance(valid_samples, pathway_dir, output_dir, output_pre
         output_prefix: Prefix for output filenames
         selected_columns: Optional dict with sample key column selections
         units: Units for normalization (default: cpm, can be "relab")
+        engine: "humann" to run humann_renorm_table per sample and humann_join_tables,
+                or "native" to normalize in-process and join with a streaming merge
+                (falling back to the humann utilities on failure)
+        threads: Number of worker processes for native normalization and joining
+        keep_joined: With the native engine, also write the joined table (the native
+                     engine otherwise writes the split tables directly)
+        write_cache: Write a columnar sidecar next to the output tables for faster reloads
         
     Returns:
         Path to unstratified pathway file, or None if processing failed
@@ -47,22 +59,43 @@ def process_pathway_abundance(valid_samples, pathway_dir, output_dir, output_pre
     # Build the suffix based on the units
     units_suffix = f"-{units}"
     
-    # Copy + renormalize
-    for (sample, src_path) in valid_samples:
+    # Native engine: renormalize straight into the Normalized directory
+    remaining_samples = valid_samples
+    if engine == "native":
+        file_pairs = [
+            (src_path, os.path.join(path_abundance_norm, f"{sample}_pathabundance{units_suffix}.tsv"))
+            for (sample, src_path) in valid_samples
+        ]
+        native_results = renorm_tables(file_pairs, units=units, update_snames=True, threads=threads)
+        remaining_samples = [(sample, src_path) for (sample, src_path) in valid_samples
+                             if not native_results.get(src_path)]
+        if remaining_samples:
+            log_print(f"Native renormalization failed for {len(remaining_samples)} samples; "
+                      f"falling back to humann_renorm_table", level='warning')
+    
+    # Link (or copy) the tables in one batch, renormalize, then move the results
+    staged = stage_files(
+        [(src_path, os.path.join(path_abundance_out, f"{sample}_pathabundance.tsv"))
+         for (sample, src_path) in remaining_samples],
+        mode="link", logger=logger
+    )
+    normalized = []
+    for (sample, src_path) in remaining_samples:
         dst = os.path.join(path_abundance_out, f"{sample}_pathabundance.tsv")
-        if not run_cmd(["cp", src_path, dst], exit_on_error=False):
+        if not staged.get(dst):
             continue
         
         out_norm = os.path.join(path_abundance_out, f"{sample}_pathabundance{units_suffix}.tsv")
-        run_cmd([
+        if run_cmd([
             "humann_renorm_table",
             "--input", dst,
             "--output", out_norm,
             "--units", units,
             "--update-snames"
-        ], exit_on_error=False)
+        ], exit_on_error=False):
+            normalized.append((out_norm, os.path.join(path_abundance_norm, os.path.basename(out_norm))))
         
-        run_cmd(["mv", out_norm, path_abundance_norm], exit_on_error=False)
+    stage_files(normalized, mode="move", logger=logger)
     
     # Join
     norm_files = [f for f in os.listdir(path_abundance_norm) if f.endswith(f"{units_suffix}.tsv")]
@@ -71,6 +104,24 @@ def process_pathway_abundance(valid_samples, pathway_dir, output_dir, output_pre
         return None
     
     joined_output = os.path.join(path_abundance_out, f"{output_prefix}_pathabundance{units_suffix}.tsv")
+    # Native engine joins, splits and strips header suffixes in one streaming pass
+    if engine == "native":
+        try:
+            outputs = join_split_humann_tables(
+                path_abundance_norm,
+                os.path.join(path_abundance_out, f"pathway_abundance{units_suffix}_unstratified.tsv"),
+                os.path.join(path_abundance_out, f"pathway_abundance{units_suffix}_stratified.tsv"),
+                joined_file=joined_output if keep_joined else None,
+                strip_headers=True,
+                threads=threads
+            )
+            log_print(f"Wrote unstratified pathway file: {outputs['unstratified']}", level='info')
+            if write_cache:
+                write_table_caches([outputs['unstratified'], outputs['stratified']])
+            return outputs['unstratified']
+        except Exception as e:
+            log_print(f"WARNING: Native join failed ({e}); falling back to humann_join_tables", level='warning')
+    
     run_cmd([
         "humann_join_tables",
         "-i", path_abundance_norm,
@@ -145,5 +196,9 @@ def process_pathway_abundance(valid_samples, pathway_dir, output_dir, output_pre
     except Exception as e:
         log_print(f"WARNING: Could not rename file: {e}", level='warning')
 
+    if write_cache:
+        stratified_file = os.path.join(path_abundance_out, f"pathway_abundance{units_suffix}_stratified.tsv")
+        write_table_caches([unstrat_file, stratified_file if os.path.exists(stratified_file) else None])
+
     return unstrat_file
     
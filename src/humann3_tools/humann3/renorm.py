@@ -0,0 +1,200 @@
+# humann3_tools/humann3_tools/humann3/renorm.py
+"""
+In-process replacement for humann_renorm_table.
+
+Reads each HUMAnN table once, normalizes all samples with numpy and writes the
+normalized table directly, following the semantics of humann_renorm_table:
+community (level-1) totals by default, optional levelwise totals, and the special
+features UNMAPPED/UNINTEGRATED/UNGROUPED included unless disabled.
+"""
+import os
+import re
+import csv
+import gzip
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+STRAT_DELIM = "|"
+SPECIAL_FEATURES = ("UNMAPPED", "UNINTEGRATED", "UNGROUPED")
+DEFAULT_SUFFIX = "-RPKs"
+
+def _open_text(path, mode="rt"):
+    """Open a plain or gzip-compressed text file."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode.replace("t", ""), newline="" if "w" in mode else None)
+
+def read_humann_table(path):
+    """
+    Read a HUMAnN table in a single pass.
+    
+    The header is the last comment line ('#') before the data, or the first line
+    if the table has no comment lines, as in humann_renorm_table.
+    
+    Args:
+        path: Path to a HUMAnN output table (optionally gzipped)
+    
+    Returns:
+        Tuple of (anchor, sample_names, features, values) where values is a
+        features x samples float array
+    """
+    header_line = None
+    skip_rows = 0
+    with _open_text(path) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                header_line = line
+                skip_rows += 1
+            else:
+                if header_line is None:
+                    header_line = line
+                    skip_rows += 1
+                break
+    
+    if header_line is None:
+        raise ValueError(f"Empty HUMAnN table: {path}")
+    
+    header = header_line.rstrip("\r\n").split("\t")
+    anchor, sample_names = header[0], header[1:]
+    
+    with _open_text(path) as fh:
+        data = pd.read_csv(
+            fh, sep="\t", header=None, skiprows=skip_rows,
+            quoting=csv.QUOTE_NONE, na_filter=False, dtype={0: str}
+        )
+    
+    features = data.iloc[:, 0].to_numpy(dtype=object)
+    values = data.iloc[:, 1:].to_numpy(dtype=float)
+    if values.shape[1] != len(sample_names):
+        raise ValueError(f"Header of {path} lists {len(sample_names)} samples but rows have {values.shape[1]} values")
+    
+    return anchor, sample_names, features, values
+
+def normalize_humann_values(features, values, units="cpm", mode="community", special=True, logger=None):
+    """
+    Normalize HUMAnN abundances to CPM or relative abundance.
+    
+    Args:
+        features: Array of feature names (stratified rows contain '|')
+        values: Features x samples array of abundances
+        units: "cpm" or "relab"
+        mode: "community" to divide every row by the community totals, or
+              "levelwise" to divide each stratification level by its own totals
+        special: Keep UNMAPPED/UNINTEGRATED/UNGROUPED (and their strata) in the table
+        logger: Logger instance for warnings
+    
+    Returns:
+        Tuple of (features, normalized_values)
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    feature_index = pd.Index(features, dtype=object)
+    if not special:
+        keep = ~feature_index.str.split(STRAT_DELIM, n=1).str[0].isin(SPECIAL_FEATURES)
+        feature_index = feature_index[keep]
+        values = values[keep]
+    
+    levels = feature_index.str.count(re.escape(STRAT_DELIM)).to_numpy() + 1
+    totals_by_level = {}
+    for level in np.unique(levels):
+        totals = values[levels == level].sum(axis=0)
+        zero = totals == 0
+        if zero.any():
+            logger.warning(f"{int(zero.sum())} samples have zero sum at level {level}")
+            totals[zero] = 1
+        totals_by_level[level] = totals
+    
+    if mode != "levelwise" and len(levels) and 1 not in totals_by_level:
+        raise ValueError("Table has no community-level (unstratified) rows to normalize by")
+    
+    # Same operation order as humann_renorm_table: value / total / divisor
+    divisor = 1e-6 if units == "cpm" else 1.0
+    normalized = np.empty_like(values)
+    for level, totals in totals_by_level.items():
+        rows = levels == level
+        row_totals = totals if mode == "levelwise" else totals_by_level[1]
+        normalized[rows] = values[rows] / row_totals / divisor
+    
+    return feature_index.to_numpy(), normalized
+
+def update_sample_names(sample_names, units):
+    """Replace the -RPKs suffix (or append one) with the units, like --update-snames."""
+    suffix = "-" + units.upper()
+    pattern = re.compile(re.escape(DEFAULT_SUFFIX) + "$")
+    return [pattern.sub(suffix, name) if pattern.search(name) else name + suffix
+            for name in sample_names]
+
+def write_humann_table(path, anchor, sample_names, features, values):
+    """Write a HUMAnN table with values formatted as humann_renorm_table does (%.6g)."""
+    table = pd.DataFrame(values, index=pd.Index(features, name=anchor), columns=sample_names)
+    with _open_text(path, "wt") as fh:
+        table.to_csv(fh, sep="\t", float_format="%.6g", lineterminator="\n")
+
+def renorm_table(input_file, output_file, units="cpm", mode="community", special=True, update_snames=False):
+    """
+    Normalize one HUMAnN table and write the result.
+    
+    Args:
+        input_file: Path to the HUMAnN table
+        output_file: Path for the normalized table
+        units: "cpm" or "relab"
+        mode: "community" or "levelwise"
+        special: Include the special features UNMAPPED, UNINTEGRATED and UNGROUPED
+        update_snames: Update sample names with the units suffix
+    
+    Returns:
+        Path to the normalized table
+    """
+    anchor, sample_names, features, values = read_humann_table(input_file)
+    features, values = normalize_humann_values(features, values, units=units, mode=mode, special=special)
+    if update_snames:
+        sample_names = update_sample_names(sample_names, units)
+    write_humann_table(output_file, anchor, sample_names, features, values)
+    return output_file
+
+def renorm_tables(file_pairs, units="cpm", mode="community", special=True, update_snames=False, threads=1):
+    """
+    Normalize many HUMAnN tables, optionally in a process pool.
+    
+    Args:
+        file_pairs: List of (input_file, output_file) tuples
+        units: "cpm" or "relab"
+        mode: "community" or "levelwise"
+        special: Include the special features UNMAPPED, UNINTEGRATED and UNGROUPED
+        update_snames: Update sample names with the units suffix
+        threads: Number of worker processes
+    
+    Returns:
+        Dictionary mapping each input file to its output file, or to None if it failed
+    """
+    logger = logging.getLogger('humann3_analysis')
+    options = dict(units=units, mode=mode, special=special, update_snames=update_snames)
+    results = {}
+    
+    if threads <= 1 or len(file_pairs) <= 1:
+        for input_file, output_file in file_pairs:
+            try:
+                results[input_file] = renorm_table(input_file, output_file, **options)
+            except Exception as e:
+                logger.error(f"Error normalizing {os.path.basename(input_file)}: {str(e)}")
+                results[input_file] = None
+        return results
+    
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        future_to_input = {
+            executor.submit(renorm_table, input_file, output_file, **options): input_file
+            for input_file, output_file in file_pairs
+        }
+        for future in as_completed(future_to_input):
+            input_file = future_to_input[future]
+            try:
+                results[input_file] = future.result()
+            except Exception as e:
+                logger.error(f"Error normalizing {os.path.basename(input_file)}: {str(e)}")
+                results[input_file] = None
+    
+    return results
@@ -0,0 +1,405 @@
+# humann3_tools/humann3_tools/humann3/table_join.py
+"""
+Streaming replacement for humann_join_tables.
+
+Each per-sample table is sorted once into a spill file (in HUMAnN feature order)
+and the spill files are combined with a heap-based k-way merge, so only one row
+per input table is held in memory while joining. The merge can be split into
+feature-range shards that run in parallel; the shard outputs are concatenated
+in order. Output is byte-identical to humann_join_tables for TSV inputs.
+
+The final merge can also route rows straight into unstratified and stratified
+tables (as humann_split_stratified_table would), so a joined table never has to
+be written and re-read just to split it.
+"""
+import os
+import re
+import bz2
+import gzip
+import heapq
+import shutil
+import logging
+import tempfile
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+
+from src.humann3_tools.utils.file_utils import strip_suffixes_from_columns
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+STRAT_DELIM = "|"
+NAME_DELIM = ": "
+TABLE_DELIM = "\t"
+# Features HUMAnN always sorts to the top of joined tables, in this order
+TOP_SORT = {
+    "UNMAPPED": 0,
+    "UNGROUPED": 1,
+    "UNINTEGRATED": 2,
+    "UniRef50_unknown": 3,
+    "UniRef90_unknown": 4,
+}
+DEFAULT_TOP_SORT = 1 + max(TOP_SORT.values())
+INDEX_INTERVAL = 4096
+
+def feature_sort_key(feature):
+    """Sort key reproducing HUMAnN's fsort order (special features first, then by strata)."""
+    parts = tuple(feature.split(STRAT_DELIM))
+    code = parts[0].split(NAME_DELIM)[0]
+    return (TOP_SORT.get(code, DEFAULT_TOP_SORT), parts)
+
+def _open_table(path):
+    """Open a plain, gzip or bzip2 text table for reading."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt")
+    return open(path, "r")
+
+def list_join_inputs(input_dir, file_name=None):
+    """
+    List the tables humann_join_tables would join from a directory.
+    
+    Args:
+        input_dir: Directory of per-sample tables
+        file_name: Only include files whose name matches this regular expression
+    
+    Returns:
+        Sorted list of file paths
+    """
+    files = []
+    for name in os.listdir(input_dir):
+        if file_name:
+            if not re.search(file_name, name):
+                continue
+        elif name.startswith("."):
+            continue
+        path = os.path.join(input_dir, name)
+        if os.path.isfile(path):
+            files.append(path)
+    return sorted(files)
+
+def _spill_sorted_table(path, spill_path):
+    """
+    Read one table, merge duplicate features and write its rows in HUMAnN order.
+    
+    Values are kept as the original strings; duplicate features within a table are
+    summed as humann_join_tables does.
+    
+    Returns:
+        Dict describing the spill file: anchor, sample_names, basename, n_columns,
+        and a sparse (key, byte offset) index for seeking
+    """
+    with _open_table(path) as fh:
+        lines = (line.rstrip() for line in fh)
+        header = None
+        first_data_line = ""
+        for line in lines:
+            if line.startswith("#"):
+                header = line
+            else:
+                first_data_line = line
+                break
+        # Without a comment line the first line is used as the header
+        if header is None:
+            header, first_data_line = first_data_line, next(lines, "")
+        
+        header_info = header.split(TABLE_DELIM) if header else []
+        sample_names = header_info[1:] if header else []
+        basename = ".".join(os.path.basename(path).split(".")[:-1])
+        if not header:
+            sample_names = [basename]
+        n_columns = len(sample_names)
+        
+        rows = {}
+        for line in _chain_first(first_data_line, lines):
+            data = line.split(TABLE_DELIM)
+            feature = data[0]
+            if not feature:
+                continue
+            values = data[1:n_columns + 1]
+            if feature in rows:
+                previous = rows[feature]
+                rows[feature] = [str(float(a) + float(b)) for a, b in zip(previous, values)]
+            else:
+                rows[feature] = values
+    
+    keyed = sorted((feature_sort_key(feature), feature) for feature in rows)
+    index = []
+    with open(spill_path, "wb") as out:
+        for i, (key, feature) in enumerate(keyed):
+            if i % INDEX_INTERVAL == 0:
+                index.append((key, out.tell()))
+            out.write((feature + TABLE_DELIM + TABLE_DELIM.join(rows[feature]) + "\n").encode("utf-8"))
+    
+    return {
+        "path": spill_path,
+        "anchor": header_info[0] if header_info else "",
+        "sample_names": sample_names,
+        "basename": basename,
+        "n_columns": n_columns,
+        "index": index,
+    }
+
+def _chain_first(first, rest):
+    """Yield first, then everything from rest."""
+    yield first
+    yield from rest
+
+def _iter_spill(spill, lo=None, hi=None):
+    """
+    Iterate (key, feature, values) from a spill file for keys in [lo, hi).
+    
+    Uses the sparse index to seek close to lo instead of scanning from the start.
+    """
+    offset = 0
+    if lo is not None and spill["index"]:
+        keys = [key for key, _ in spill["index"]]
+        pos = bisect_left(keys, lo)
+        if pos > 0:
+            offset = spill["index"][pos - 1][1]
+    with open(spill["path"], "rb") as fh:
+        fh.seek(offset)
+        for raw in fh:
+            line = raw.decode("utf-8").rstrip("\n")
+            feature, _, values = line.partition(TABLE_DELIM)
+            key = feature_sort_key(feature)
+            if lo is not None and key < lo:
+                continue
+            if hi is not None and key >= hi:
+                break
+            yield key, feature, values
+
+def _tagged_rows(position, rows):
+    """Tag spill rows with the table position so heap ties break by input order."""
+    for key, feature, values in rows:
+        yield key, position, feature, values
+
+def _raise_open_file_limit(needed):
+    """Raise the soft open-file limit towards needed; return the limit now in effect."""
+    if resource is None:
+        return needed
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return needed if soft == resource.RLIM_INFINITY else soft
+
+def _merge_spills(spills, out_path, lo=None, hi=None, final=False, split_paths=None):
+    """
+    k-way merge of spill files over the key range [lo, hi).
+    
+    Features missing from a table get "0" for each of its columns. With final=True
+    rows are written in humann_join_tables' output format; otherwise the output is
+    a new spill file (with its own index) for a further merge pass.
+    
+    With split_paths=(unstratified_path, stratified_path) (final merges only) each
+    row is also written to one of the two files, using the rule of
+    humann_split_stratified_table; out_path may then be None to skip the joined output.
+    
+    Returns:
+        Spill description for the merged file (final=False) or out_path (final=True)
+    """
+    _raise_open_file_limit(len(spills) + 16)
+    zero_fill = [TABLE_DELIM.join(["0"] * spill["n_columns"]) for spill in spills]
+    streams = [_tagged_rows(i, _iter_spill(spill, lo, hi)) for i, spill in enumerate(spills)]
+    
+    index = []
+    n_rows = 0
+    handles = [open(path, "wb") if path else None for path in [out_path] + list(split_paths or [None, None])]
+    out, unstrat_out, strat_out = handles
+    try:
+        current_key = None
+        current_feature = None
+        columns = None
+        
+        def flush():
+            nonlocal n_rows
+            row = TABLE_DELIM.join(columns)
+            if final:
+                line = current_feature + TABLE_DELIM + row.rstrip(TABLE_DELIM) + "\n"
+                data = line.encode("utf-8")
+                if out is not None:
+                    out.write(data)
+                if split_paths:
+                    (strat_out if STRAT_DELIM in line else unstrat_out).write(data)
+            else:
+                if n_rows % INDEX_INTERVAL == 0:
+                    index.append((current_key, out.tell()))
+                out.write((current_feature + TABLE_DELIM + row + "\n").encode("utf-8"))
+            n_rows += 1
+        
+        for key, i, feature, values in heapq.merge(*streams):
+            if key != current_key:
+                if columns is not None:
+                    flush()
+                current_key, current_feature = key, feature
+                columns = list(zero_fill)
+            columns[i] = values
+        if columns is not None:
+            flush()
+    finally:
+        for handle in handles:
+            if handle is not None:
+                handle.close()
+    
+    if final:
+        return out_path
+    return {
+        "path": out_path,
+        "n_columns": sum(spill["n_columns"] for spill in spills),
+        "index": index,
+    }
+
+def _shard_bounds(spills, n_shards):
+    """Pick feature-key boundaries that split the merged table into about n_shards ranges."""
+    keys = sorted({key for spill in spills for key, _ in spill["index"]})
+    if n_shards <= 1 or len(keys) < 2:
+        return [(None, None)]
+    step = len(keys) / n_shards
+    cuts = sorted({keys[int(step * s)] for s in range(1, n_shards) if int(step * s) > 0})
+    bounds = [None] + cuts + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _run_tasks(function, tasks, threads):
+    """Results of function(*task) for every task, in worker processes when threads > 1."""
+    if threads <= 1 or len(tasks) <= 1:
+        return [function(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(function, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+def _stream_join(tables, joined_file=None, split_files=None, strip_headers=False, threads=1,
+                 temp_dir=None, max_open_files=None):
+    """
+    Sort, merge and write the joined and/or split tables in one streaming pass.
+    
+    Returns:
+        Number of tables joined
+    """
+    logger = logging.getLogger('humann3_analysis')
+    if isinstance(tables, str):
+        tables = list_join_inputs(tables)
+    else:
+        tables = sorted(tables)
+    if not tables:
+        raise ValueError("No tables found to join")
+    
+    threads = max(1, threads or 1)
+    first_output = joined_file or split_files[0]
+    output_dir = os.path.dirname(os.path.abspath(first_output))
+    work_dir = tempfile.mkdtemp(prefix="humann_join_", dir=temp_dir or output_dir)
+    
+    try:
+        logger.info(f"Sorting {len(tables)} tables for streaming join")
+        spill_paths = [os.path.join(work_dir, f"table_{i}.spill") for i in range(len(tables))]
+        spills = _run_tasks(_spill_sorted_table, list(zip(tables, spill_paths)), threads)
+        
+        # Header as written by humann_join_tables
+        anchor = next((spill["anchor"] for spill in spills if spill["anchor"]), "") or "# header "
+        samples = [name for spill in spills for name in spill["sample_names"]]
+        if samples and samples.count(samples[0]) == len(samples):
+            samples = [spill["basename"] for spill in spills]
+        header = [anchor] + samples
+        split_header = header
+        if split_files and strip_headers:
+            split_header, _ = strip_suffixes_from_columns(header, logger, source=split_files[0])
+        
+        # Merge groups of tables first if there are more than can be open at once
+        if max_open_files is None:
+            max_open_files = max(2, _raise_open_file_limit(len(spills) + 64) - 64)
+        merge_pass = 0
+        while len(spills) > max_open_files:
+            groups = [spills[i:i + max_open_files] for i in range(0, len(spills), max_open_files)]
+            logger.info(f"Merge pass {merge_pass + 1}: combining {len(spills)} tables into {len(groups)}")
+            out_paths = [os.path.join(work_dir, f"pass{merge_pass}_{i}.spill") for i in range(len(groups))]
+            spills = _run_tasks(_merge_spills, list(zip(groups, out_paths)), threads)
+            merge_pass += 1
+        
+        # Final merge over feature-range shards, then concatenate in order
+        shards = _shard_bounds(spills, threads * 4 if threads > 1 else 1)
+        part_paths = [os.path.join(work_dir, f"part_{i}.tsv") if joined_file else None
+                      for i in range(len(shards))]
+        split_parts = [(os.path.join(work_dir, f"part_{i}_unstratified.tsv"),
+                        os.path.join(work_dir, f"part_{i}_stratified.tsv")) if split_files else None
+                       for i in range(len(shards))]
+        logger.info(f"Merging {len(spills)} tables in {len(shards)} feature-range shards")
+        _run_tasks(_merge_spills, [(spills, part_path, lo, hi, True, split_part)
+                                   for (lo, hi), part_path, split_part in zip(shards, part_paths, split_parts)],
+                   threads)
+        
+        outputs = []
+        if joined_file:
+            outputs.append((joined_file, header, part_paths))
+        if split_files:
+            for k, split_file in enumerate(split_files):
+                outputs.append((split_file, split_header, [parts[k] for parts in split_parts]))
+        for output_file, columns, parts in outputs:
+            with open(output_file, "wb") as out:
+                out.write((TABLE_DELIM.join(columns) + "\n").encode("utf-8"))
+                for part_path in parts:
+                    with open(part_path, "rb") as part:
+                        shutil.copyfileobj(part, out)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    return len(tables)
+
+def join_humann_tables(tables, output_file, threads=1, temp_dir=None, max_open_files=None):
+    """
+    Join per-sample HUMAnN tables into one table, like humann_join_tables.
+    
+    Args:
+        tables: Directory of tables or list of table paths (joined in sorted order)
+        output_file: Path for the joined table
+        threads: Number of worker processes for sorting and for the merge shards
+                 (1 = sort and merge in this process)
+        temp_dir: Directory for spill files (default: next to output_file)
+        max_open_files: Maximum tables merged at once (default: open-file limit)
+    
+    Returns:
+        Path to the joined table
+    """
+    n_tables = _stream_join(tables, joined_file=output_file, threads=threads,
+                            temp_dir=temp_dir, max_open_files=max_open_files)
+    logging.getLogger('humann3_analysis').info(f"Joined {n_tables} tables into {output_file}")
+    return output_file
+
+def join_split_humann_tables(tables, unstratified_file, stratified_file, joined_file=None,
+                             strip_headers=False, threads=1, temp_dir=None, max_open_files=None):
+    """
+    Join per-sample HUMAnN tables and split the result into unstratified and
+    stratified tables in the same pass, like humann_join_tables followed by
+    humann_split_stratified_table (and optionally strip_suffixes_from_file_headers).
+    
+    Args:
+        tables: Directory of tables or list of table paths (joined in sorted order)
+        unstratified_file: Path for the community-level table
+        stratified_file: Path for the table of stratified ('|') rows
+        joined_file: Also write the full joined table here (default: not written)
+        strip_headers: Strip abundance suffixes from the sample names of the split tables
+        threads: Number of worker processes for sorting and for the merge shards
+                 (1 = sort and merge in this process)
+        temp_dir: Directory for spill files (default: next to unstratified_file)
+        max_open_files: Maximum tables merged at once (default: open-file limit)
+    
+    Returns:
+        Dictionary with 'unstratified', 'stratified' and 'joined' (None unless requested) paths
+    """
+    n_tables = _stream_join(tables, joined_file=joined_file,
+                            split_files=(unstratified_file, stratified_file),
+                            strip_headers=strip_headers, threads=threads,
+                            temp_dir=temp_dir, max_open_files=max_open_files)
+    logging.getLogger('humann3_analysis').info(
+        f"Joined {n_tables} tables into {unstratified_file} and {stratified_file}")
+    return {
+        'unstratified': unstratified_file,
+        'stratified': stratified_file,
+        'joined': joined_file,
+    }
@@ -2,10 +2,11 @@
 import os
 import subprocess
 import logging
-import shutil
 from src.humann3_tools.utils.cmd_utils import run_cmd
+from src.humann3_tools.utils.file_utils import stage_files
 from src.humann3_tools.logger import log_print
 from src.humann3_tools.utils.resource_utils import track_peak_memory
+from src.humann3_tools.humann3.output_manifest import resolve_humann3_outputs, update_run_manifest
 
 def check_humann3_installation():
     """Check if HUMAnN3 is installed and available."""
@@ -19,36 +20,9 @@ def check_humann3_installation():
         return False, "HUMAnN3 not found in PATH"
     
 
-def process_single_sample_humann3(input_file, sample_id=None, output_dir=None, 
-                                 threads=1, nucleotide_db=None, protein_db=None, 
-                                 additional_options=None, logger=None, pathabdirectory=None,
-                                 genedirectory=None, pathcovdirectory=None, metadirectory=None):
-    """Process a single sample with HUMAnN3."""
-    if logger is None:
-        logger = logging.getLogger('humann3_analysis')
-    
-    if sample_id is None:
-        sample_id = os.path.basename(input_file).split('.')[0]
-
-    if output_dir is None:
-        output_dir = os.path.join(os.getcwd(), "humann3_output", sample_id)
-
-    if pathabdirectory is None:
-        pathabdirectory = os.path.join(output_dir, "Pathabundance")
-
-    if genedirectory is None:
-        genedirectory = os.path.join(output_dir, "GeneFamilies")
-
-    if pathcovdirectory is None:
-        pathcovdirectory = os.path.join(output_dir, "PathCoverage")
-
-    if metadirectory is None:
-        metadirectory = os.path.join(output_dir, "MetaphlanFiles")
-
-    
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Build command
+def humann3_command(input_file, output_dir, threads=1, nucleotide_db=None, protein_db=None,
+                    additional_options=None):
+    """Build the humann command line for one input file."""
     cmd = ["humann", "--input", input_file, "--output", output_dir]
     
     # Add threads (per sample)
@@ -67,40 +41,23 @@ def process_single_sample_humann3(input_file, sample_id=None, output_dir=None,
                 cmd.append(f"--{key}")
             elif value is not None and value != "":
                 cmd.extend([f"--{key}", str(value)])
+    return cmd
     
-    # Run HUMAnN3
-    logger.info(f"Running HUMAnN3 for sample {sample_id}")
-    success = run_cmd(cmd, exit_on_error=False)
-    
-    if not success:
-        logger.error(f"HUMAnN3 run failed for sample {sample_id}")
-        return None
+def collect_humann3_outputs(sample_id, input_file, output_dir, additional_options=None, logger=None,
+                            pathabdirectory=None, genedirectory=None, pathcovdirectory=None,
+                            metadirectory=None):
+    """
+    Resolve a finished sample's outputs and link them into the per-type directories.
     
-# Now collect output file paths in one pass over the entire output_dir
-    output_files = {
-        'genefamilies': None,
-        'pathabundance': None,
-        'pathcoverage': None,
-        'metaphlan': None
-    }
+    Returns:
+        Dict mapping output types to file paths (None for missing outputs)
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
     
-    # Find the output files
-    for root, dirs, files in os.walk(output_dir):
-        for f in files:
-            f_lower = f.lower()
-            # Must be a .tsv
-            if not f_lower.endswith(".tsv"):
-                continue
-            full_path = os.path.join(root, f)
-            
-            if "genefamilies" in f_lower:
-                output_files["genefamilies"] = full_path
-            elif "pathabundance" in f_lower:
-                output_files["pathabundance"] = full_path
-            elif "pathcoverage" in f_lower:
-                output_files["pathcoverage"] = full_path
-            elif "metaphlan_bugs_list" in f_lower:
-                output_files["metaphlan"] = full_path
+    # HUMAnN3 names its outputs after the input file, so look them up directly
+    # instead of walking the (possibly shared) output directory
+    output_files = resolve_humann3_outputs(output_dir, input_file, additional_options, logger=logger)
     
     # Log which files were found and which are missing
     found_files = [k for k, v in output_files.items() if v is not None]
@@ -112,61 +69,68 @@ def process_single_sample_humann3(input_file, sample_id=None, output_dir=None,
     
     logger.info(f"HUMAnN3 completed for sample {sample_id}")
 
-    # Send to respective directories
-    pathabundance_dir = pathabdirectory
-    genefamilies_dir = genedirectory
-    pathcoverage_dir = pathcovdirectory
-    metaphlan_dir = metadirectory
-
-    # Create target directories if they do not exist
-    os.makedirs(pathabundance_dir, exist_ok=True)
-    os.makedirs(genefamilies_dir, exist_ok=True)
-    
-    if pathcoverage_dir:
-        os.makedirs(pathcoverage_dir, exist_ok=True)
-    if metaphlan_dir:
-        os.makedirs(metaphlan_dir, exist_ok=True)
-
-    # Process the output files
-    try:
-        path_file = output_files.get("pathabundance")
-        if path_file and os.path.isfile(path_file):
-            new_location = os.path.join(pathabundance_dir, os.path.basename(path_file))
-            shutil.copy(path_file, new_location)
-            logger.info(f"Copied pathabundance for {sample_id} to {new_location}")
-
-        gene_file = output_files.get("genefamilies")
-        if gene_file and os.path.isfile(gene_file):
-            new_location = os.path.join(genefamilies_dir, os.path.basename(gene_file))
-            shutil.copy(gene_file, new_location)
-            logger.info(f"Copied genefamilies for {sample_id} to {new_location}")
-
-        path_coverage_file = output_files.get("pathcoverage")
-        if pathcoverage_dir and path_coverage_file and os.path.isfile(path_coverage_file):
-            new_location = os.path.join(pathcoverage_dir, os.path.basename(path_coverage_file))
-            shutil.copy(path_coverage_file, new_location)
-            logger.info(f"Copied pathcoverage for {sample_id} to {new_location}")
-
-        metaphlan_file = output_files.get("metaphlan")
-        if metaphlan_dir and metaphlan_file and os.path.isfile(metaphlan_file):
-            new_location = os.path.join(metaphlan_dir, os.path.basename(metaphlan_file))
-            shutil.copy(metaphlan_file, new_location)
-            logger.info(f"Copied metaphlan for {sample_id} to {new_location}")
-    except Exception as e:
-        logger.error(f"Error processing output files for sample {sample_id}: {str(e)}")
-        logger.debug(f"output_files content: {output_files}")
+    # Link (or copy) the outputs into the per-type directories
+    target_dirs = {
+        'pathabundance': pathabdirectory or os.path.join(output_dir, "Pathabundance"),
+        'genefamilies': genedirectory or os.path.join(output_dir, "GeneFamilies"),
+        'pathcoverage': pathcovdirectory or os.path.join(output_dir, "PathCoverage"),
+        'metaphlan': metadirectory or os.path.join(output_dir, "MetaphlanFiles"),
+    }
+    file_pairs = [(output_files[file_type], os.path.join(target_dir, os.path.basename(output_files[file_type])))
+                  for file_type, target_dir in target_dirs.items() if output_files.get(file_type)]
+    stage_files(file_pairs, mode="link", logger=logger)
 
     return output_files
 
+def process_single_sample_humann3(input_file, sample_id=None, output_dir=None, 
+                                 threads=1, nucleotide_db=None, protein_db=None, 
+                                 additional_options=None, logger=None, pathabdirectory=None,
+                                 genedirectory=None, pathcovdirectory=None, metadirectory=None,
+                                 timeout=None, log_dir=None):
+    """Process a single sample with HUMAnN3."""
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    if sample_id is None:
+        sample_id = os.path.basename(input_file).split('.')[0]
+    
+    if output_dir is None:
+        output_dir = os.path.join(os.getcwd(), "humann3_output", sample_id)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    cmd = humann3_command(input_file, output_dir, threads=threads, nucleotide_db=nucleotide_db,
+                          protein_db=protein_db, additional_options=additional_options)
+    
+    # Run HUMAnN3
+    logger.info(f"Running HUMAnN3 for sample {sample_id}")
+    log_file = os.path.join(log_dir, f"{sample_id}.log") if log_dir else None
+    success = run_cmd(cmd, exit_on_error=False, timeout=timeout, log_file=log_file)
+    
+    if not success:
+        logger.error(f"HUMAnN3 run failed for sample {sample_id}")
+        return None
+    
+    return collect_humann3_outputs(sample_id, input_file, output_dir, additional_options, logger=logger,
+                                   pathabdirectory=pathabdirectory, genedirectory=genedirectory,
+                                   pathcovdirectory=pathcovdirectory, metadirectory=metadirectory)
+
 
 # Add support for parallel processing
 @track_peak_memory
 def run_humann3_parallel(input_files, output_dir, threads=1, max_parallel=None,
                         nucleotide_db=None, protein_db=None, additional_options=None, 
-                        logger=None):
+                        logger=None, memory_per_sample=None, memory_budget=None,
+                        checkpoint_dir=None, resume=False, timeout=None, log_dir=None,
+                        metrics_file=None, history_db=None, adaptive_threads=False):
     """
     Run HUMAnN3 on multiple samples in parallel.
     
+    All runs are child processes driven from one event loop (see
+    run_commands_parallel), so no worker process sits blocked on each run.
+    Each sample's runtime and memory are predicted from earlier HUMAnN3 runs in
+    the run history database, so the slowest samples start first.
+    
     Args:
         input_files: List of input FASTQ files from KneadData
         output_dir: Base directory for outputs
@@ -176,11 +140,29 @@ def run_humann3_parallel(input_files, output_dir, threads=1, max_parallel=None,
         protein_db: Path to protein database
         additional_options: Dict of additional HUMAnN3 options
         logger: Logger instance
+        memory_per_sample: Projected peak memory of one HUMAnN3 run in MB
+                           (None = predicted from the run history, or
+                           estimate_sample_memory("humann3") without history)
+        memory_budget: Memory in MB the concurrent runs may use together
+                       (None = memory available when the run starts)
+        checkpoint_dir: Write a completion manifest per sample here
+        resume: Skip samples whose manifest in checkpoint_dir is still valid
+        timeout: Wall-clock limit per sample in seconds; a run that exceeds it is
+                 stopped with all of its child processes (None = no limit)
+        log_dir: Directory for each sample's HUMAnN3 output log
+                 (default: <output_dir>/logs)
+        metrics_file: File for per-sample resource records of each run's process
+                      tree (default: <log_dir>/resource_metrics.jsonl)
+        history_db: Run history database (None = run_history.run_db_path())
+        adaptive_threads: Run the samples started after the queue drained with
+                          the free threads instead of threads
         
     Returns:
         Dict mapping sample IDs to output files
     """
-    from src.humann3_tools.preprocessing.parallel import run_parallel
+    from src.humann3_tools.preprocessing.parallel import run_commands_parallel
+    from src.humann3_tools.utils.resource_utils import estimate_sample_memory, default_metrics_file
+    from src.humann3_tools.utils.run_history import RunPredictor
     
     if logger is None:
         logger = logging.getLogger('humann3_analysis')
@@ -192,8 +174,8 @@ def run_humann3_parallel(input_files, output_dir, threads=1, max_parallel=None,
         sample_name = os.path.basename(file).split('_')[0]
         sample_list.append((sample_name, file))
     
-    # Prepare common arguments for all samples
-    kwargs = {
+    # Parameters recorded in the checkpoints, as process_single_sample_humann3 receives them
+    params = {
         'output_dir': output_dir,
         'threads': threads,
         'nucleotide_db': nucleotide_db,
@@ -202,22 +184,36 @@ def run_humann3_parallel(input_files, output_dir, threads=1, max_parallel=None,
         'logger': logger
     }
     
-    # Run in parallel
-    results = run_parallel(sample_list, process_single_sample_humann3, 
-                          max_workers=max_parallel, **kwargs)
+    predictor = RunPredictor.from_history("humann", threads=threads, path=history_db, logger=logger,
+                                          default_memory=estimate_sample_memory("humann3"))
+    if memory_per_sample is None:
+        memory_per_sample = predictor.predict_memory
+    if log_dir is None:
+        log_dir = os.path.join(output_dir, "logs")
+    if metrics_file is None:
+        metrics_file = default_metrics_file(log_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    def build_command(sample_tuple, sample_threads):
+        return humann3_command(sample_tuple[1], output_dir, threads=sample_threads, nucleotide_db=nucleotide_db,
+                               protein_db=protein_db, additional_options=additional_options)
     
-    # Post-process to ensure we found metaphlan files
-    for sample_id, sample_outputs in results.items():
-        # If we didn't find the metaphlan file in the main function, try to find it now
-        if isinstance(sample_outputs, dict) and sample_outputs.get('metaphlan') is None:
-            sample_dir = os.path.join(output_dir, sample_id)
-            if os.path.exists(sample_dir):
-                for root, dirs, files in os.walk(sample_dir):
-                    for file in files:
-                        if "metaphlan_bugs_list" in file.lower() and file.endswith(".tsv"):
-                            sample_outputs['metaphlan'] = os.path.join(root, file)
-                            logger.info(f"Post-process: Found MetaPhlAn output for {sample_id}: {file}")
-                            break
+    def collect(sample_tuple):
+        return collect_humann3_outputs(sample_tuple[0], sample_tuple[1], output_dir, additional_options,
+                                       logger=logger)
+    
+    # Run in parallel, admitting samples only while their projected memory fits
+    results = run_commands_parallel(sample_list, build_command, collect=collect,
+                                    max_workers=max_parallel, memory_per_sample=memory_per_sample,
+                                    memory_budget=memory_budget, threads=threads, timeout=timeout,
+                                    log_dir=log_dir, checkpoint_dir=checkpoint_dir,
+                                    checkpoint_stage="humann", checkpoint_params=params,
+                                    resume=resume, metrics_file=metrics_file,
+                                    runtime_per_sample=predictor.predict_runtime, history_db=history_db,
+                                    adaptive_threads=adaptive_threads, logger=logger)
+    
+    # Record where every sample's outputs are so joining and organizing need not search
+    update_run_manifest(output_dir, results, logger=logger)
     return results
 
 def run_humann3(input_files, output_dir, threads=1, nucleotide_db=None, 
@@ -251,26 +247,8 @@ def run_humann3(input_files, output_dir, threads=1, nucleotide_db=None,
         sample_output_dir = os.path.join(output_dir, sample_name)
         os.makedirs(sample_output_dir, exist_ok=True)
         
-        # Basic command
-        cmd = ["humann", "--input", input_file, "--output", sample_output_dir]
-        
-        # Add threads - ensure it's a string
-        cmd.extend(["--threads", str(threads)])
-        
-        # Add database paths if provided
-        if nucleotide_db:
-            cmd.extend(["--nucleotide-database", str(nucleotide_db)])
-        if protein_db:
-            cmd.extend(["--protein-database", str(protein_db)])
-        
-        # Add any additional options
-        if additional_options:
-            for key, value in additional_options.items():
-                if value is True:
-                    cmd.append(f"--{key}")
-                elif value is not None:
-                    # Convert value to string to ensure it's not a complex object
-                    cmd.extend([f"--{key}", str(value)])
+        cmd = humann3_command(input_file, sample_output_dir, threads=threads, nucleotide_db=nucleotide_db,
+                              protein_db=protein_db, additional_options=additional_options)
         
         # Ensure all command elements are strings before joining
         str_cmd = [str(item) for item in cmd]
@@ -283,30 +261,9 @@ def run_humann3(input_files, output_dir, threads=1, nucleotide_db=None,
             logger.error(f"HUMAnN3 run failed for sample {sample_name}")
             continue
         
-    # Now collect output file paths in one pass over the entire output_dir
-        sample_outputs = {
-            'genefamilies': None,
-            'pathabundance': None,
-            'pathcoverage': None,
-            'metaphlan': None
-        }
-        
-        # Use os.walk to find the output files
-        for root, dirs, files in os.walk(output_dir):
-            for f in files:
-                f_lower = f.lower()
-                if not f_lower.endswith(".tsv"):
-                    continue
-                full_path = os.path.join(root, f)
-                
-                if "genefamilies" in f_lower:
-                    sample_outputs["genefamilies"] = full_path
-                elif "pathabundance" in f_lower:
-                    sample_outputs["pathabundance"] = full_path
-                elif "pathcoverage" in f_lower:
-                    sample_outputs["pathcoverage"] = full_path
-                elif "metaphlan_bugs_list" in f_lower:
-                    sample_outputs["metaphlan"] = full_path
+        # Look up this sample's outputs in its own directory only
+        sample_outputs = resolve_humann3_outputs(sample_output_dir, input_file, additional_options,
+                                                 logger=logger)
         
         # Log which files were found and which are missing
         found_files = [k for k, v in sample_outputs.items() if v is not None]
@@ -318,55 +275,22 @@ def run_humann3(input_files, output_dir, threads=1, nucleotide_db=None,
             
         output_files[sample_name] = sample_outputs
 
-    # Send to respective directories
-        pathabundance_dir = pathabdirectory
-        genefamilies_dir = genedirectory
-        pathcoverage_dir = pathcovdirectory
-        metaphlan_dir = metadirectory
-    
-        # Create target directories if they do not exist
-        os.makedirs(pathabundance_dir, exist_ok=True)
-        os.makedirs(genefamilies_dir, exist_ok=True)
-
-        for sample_id, file_paths in sample_outputs.items():
-
-
-            if pathabdirectory is None:
-                pathabdirectory = os.path.join(output_dir, "PathwayAbundance")
-
-            if genedirectory is None:
-                genedirectory = os.path.join(output_dir, "GeneFamilies")
-
-            if pathcovdirectory is None:
-                pathcovdirectory = os.path.join(output_dir, "PathwayCoverage")
-
-            if metadirectory is None:
-                metadirectory = os.path.join(output_dir, "MetaphlanFiles")
-
-            path_file = file_paths.get("pathabundance")
-            if path_file and os.path.isfile(path_file):
-                new_location = os.path.join(pathabundance_dir, os.path.basename(path_file))
-                shutil.copy(path_file, new_location)
-                print(f"Copied pathabundance for {sample_id} to {new_location}")
-
-    
-            gene_file = file_paths.get("genefamilies")
-            if gene_file and os.path.isfile(gene_file):
-                new_location = os.path.join(genefamilies_dir, os.path.basename(gene_file))
-                shutil.copy(gene_file, new_location)
-                print(f"Copied genefamilies for {sample_id} to {new_location}")
-
-            path_coverage_file = file_paths.get("pathcoverage")
-            if path_coverage_file and os.path.isfile(path_coverage_file):
-                new_location = os.path.join(pathcoverage_dir, os.path.basename(path_coverage_file))
-                shutil.copy(path_coverage_file, new_location)
-                print(f"Copied pathcoverage for {sample_id} to {new_location}")
+    # Link (or copy) the outputs into the per-type directories in one batch
+    target_dirs = {
+        'pathabundance': pathabdirectory or os.path.join(output_dir, "PathwayAbundance"),
+        'genefamilies': genedirectory or os.path.join(output_dir, "GeneFamilies"),
+        'pathcoverage': pathcovdirectory or os.path.join(output_dir, "PathwayCoverage"),
+        'metaphlan': metadirectory or os.path.join(output_dir, "MetaphlanFiles"),
+    }
+    file_pairs = []
+    for sample_id, file_paths in output_files.items():
+        for file_type, target_dir in target_dirs.items():
+            source = file_paths.get(file_type)
+            if source:
+                file_pairs.append((source, os.path.join(target_dir, os.path.basename(source))))
+    stage_files(file_pairs, mode="link", logger=logger)
 
-            metaphlan_file = file_paths.get("metaphlan")
-            if metaphlan_file and os.path.isfile(metaphlan_file):
-                new_location = os.path.join(metaphlan_dir, os.path.basename(metaphlan_file))
-                shutil.copy(metaphlan_file, new_location)
-                print(f"Copied metaphlan for {sample_id} to {new_location}")
+    update_run_manifest(output_dir, output_files, logger=logger)
         
     logger.info(f"HUMAnN3 completed for {len(output_files)} samples")
     return output_files
\ No newline at end of file
@@ -1,9 +1,27 @@
 # humann3_tools/preprocessing/parallel.py
 import os
 import time
+import signal
+import asyncio
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import psutil
 from tqdm import tqdm
+from src.humann3_tools.utils.cmd_utils import sigkilled_command_count, run_cmd_async, is_sigkill
+from src.humann3_tools.utils.resource_utils import (
+    check_resource_availability, ProcessTreeMonitor, RESOURCE_SAMPLE_INTERVAL,
+    resource_record, write_resource_record
+)
+from src.humann3_tools.utils.checkpoint import CheckpointedStep, read_stage_manifest, write_stage_manifest
+from src.humann3_tools.utils.run_history import record_runs, sample_input_bytes
+
+# Growth of a sample's memory estimate each time it is requeued after running out of memory
+OOM_RETRY_FACTOR = 1.5
+
+# Queue on which a _run_packed worker reports (sample_id, pid) as it starts a sample
+_STARTED_SAMPLES = None
 
 def process_sample_parallel(sample_tuple, function, **kwargs):
     """
@@ -58,27 +76,162 @@ def process_sample_parallel(sample_tuple, function, **kwargs):
         logger.error(f"Invalid sample tuple format: {sample_tuple}")
         return sample_id, None
 
-def run_parallel(sample_list, function, max_workers=None, **kwargs):
+def process_sample_tracked(sample_tuple, function, monitor_interval=None, **kwargs):
+    """
+    Process a single sample and report whether it ran out of memory.
+    
+    Args:
+        sample_tuple: Sample tuple as for process_sample_parallel
+        function: Function to run on the sample
+        monitor_interval: Sample the worker's process tree (the worker and the
+                          tools it starts) at this interval in seconds (None = off)
+        **kwargs: Additional arguments to pass to the function
+    
+    Returns:
+        Tuple of (sample_id, result, out_of_memory, usage) with usage the
+        ProcessTreeMonitor.usage() of the sample, or None when not monitored
+    """
+    if _STARTED_SAMPLES is not None:
+        _STARTED_SAMPLES.put((sample_tuple[0], os.getpid()))
+    monitor = ProcessTreeMonitor(os.getpid(), interval=monitor_interval).start() if monitor_interval else None
+    killed_before = sigkilled_command_count()
+    try:
+        sample_id, result = process_sample_parallel(sample_tuple, function, **kwargs)
+    except MemoryError:
+        return sample_tuple[0], None, True, monitor.stop() if monitor else None
+    usage = monitor.stop() if monitor else None
+    return sample_id, result, sigkilled_command_count() > killed_before, usage
+
+def _init_packed_worker(started_samples):
+    global _STARTED_SAMPLES
+    _STARTED_SAMPLES = started_samples
+
+def _packed_pool(max_workers):
+    """A process pool whose workers report the samples they start, and its queue."""
+    # A fresh queue per pool: a worker killed while writing may leave the old one locked
+    started_samples = multiprocessing.SimpleQueue()
+    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_packed_worker,
+                                   initargs=(started_samples,))
+    return executor, started_samples
+
+def _killed_job(executor, started_samples, jobs):
+    """
+    The job whose worker died and broke the pool.
+    
+    The pool SIGTERMs its other workers once one dies, so the dead worker is the
+    one with any other exit status (SIGKILL from the OOM killer). When it cannot
+    be identified, the job with the largest projected memory is blamed.
+    """
+    sample_pids = {}
+    while not started_samples.empty():
+        sample_id, pid = started_samples.get()
+        sample_pids[sample_id] = pid
+    # ProcessPoolExecutor keeps its worker processes (pid -> Process) here until shutdown
+    processes = getattr(executor, '_processes', None) or {}
+    dead_pids = {pid for pid, process in processes.items()
+                 if process.exitcode not in (None, 0, -signal.SIGTERM)}
+    for job in jobs:
+        if sample_pids.get(job['sample'][0]) in dead_pids:
+            return job
+    return max(jobs, key=lambda job: job['memory'])
+
+def _skip_completed(sample_list, checkpoint_dir, stage, params, logger):
+    """Split samples into those still to run and the stored results of completed ones."""
+    remaining = []
+    completed = {}
+    for sample_tuple in sample_list:
+        manifest = None
+        if len(sample_tuple) >= 2:
+            manifest = read_stage_manifest(checkpoint_dir, stage, sample_tuple[0], list(sample_tuple[1:]),
+                                           params, logger=logger)
+        if manifest is None:
+            remaining.append(sample_tuple)
+        else:
+            completed[sample_tuple[0]] = manifest["result"]
+    if completed:
+        logger.info(f"Resuming {stage}: {len(completed)} of {len(sample_list)} samples already completed")
+    return remaining, completed
+
+def run_parallel(sample_list, function, max_workers=None, memory_per_sample=None,
+                 memory_budget=None, thread_budget=None, max_retries=1,
+                 checkpoint_dir=None, checkpoint_stage=None, resume=False, metrics_file=None,
+                 monitor_interval=RESOURCE_SAMPLE_INTERVAL, runtime_per_sample=None,
+                 history_db=None, adaptive_threads=False, **kwargs):
     """
     Run a function on multiple samples in parallel with progress bar.
     
+    Without memory_per_sample, memory_budget, thread_budget or adaptive_threads
+    every sample is submitted at once, largest input first, and max_workers alone
+    limits concurrency. With any of them, samples are packed by projected memory
+    instead (see _run_packed), longest projected runtime first when
+    runtime_per_sample is given.
+    
     Args:
         sample_list: List of tuples with sample information (could be 2 or 3 elements)
         function: Function to run on each sample
         max_workers: Maximum number of parallel processes (None = CPU count)
+        memory_per_sample: Projected peak memory per sample in MB, or a function
+                           of the sample tuple returning it
+        memory_budget: Memory in MB the running samples may use together
+                       (None = memory available when the run starts)
+        thread_budget: Threads the running samples may use together, counting
+                       kwargs['threads'] per sample (None = CPU count)
+        max_retries: Times a sample that ran out of memory is requeued
+        checkpoint_dir: Write a completion manifest for every successful sample here
+        checkpoint_stage: Stage name of the manifests (default: the function name)
+        resume: Reuse the results of samples whose manifest is still valid
+        metrics_file: Append a resource record per sample (peak RSS, CPU time and
+                      I/O of the sample's process tree) to this file; used with
+                      memory packing only
+        monitor_interval: Seconds between resource samples for metrics_file
+        runtime_per_sample: Function of the sample tuple returning its projected
+                            wall time in seconds (or None); used with memory packing only
+        history_db: Run history database the resource records are also stored in
+                    (None = run_history.run_db_path())
+        adaptive_threads: Once every waiting sample can start, give the last
+                          samples the free threads (raising kwargs['threads'])
+                          instead of leaving them idle at the end of the run
         **kwargs: Additional arguments to pass to the function
         
     Returns:
         Dictionary mapping sample_ids to results
     """
     logger = logging.getLogger('humann3_analysis')
+    
+    if checkpoint_dir is not None:
+        stage = checkpoint_stage or function.__name__
+        completed = {}
+        if resume:
+            sample_list, completed = _skip_completed(sample_list, checkpoint_dir, stage, kwargs, logger)
+            if not sample_list:
+                return completed
+        results = run_parallel(sample_list, CheckpointedStep(function, checkpoint_dir, stage),
+                               max_workers=max_workers, memory_per_sample=memory_per_sample,
+                               memory_budget=memory_budget, thread_budget=thread_budget,
+                               max_retries=max_retries, checkpoint_stage=stage, metrics_file=metrics_file,
+                               monitor_interval=monitor_interval, runtime_per_sample=runtime_per_sample,
+                               history_db=history_db, adaptive_threads=adaptive_threads, **kwargs)
+        completed.update(results)
+        return completed
+    
+    if (memory_per_sample is not None or memory_budget is not None or thread_budget is not None
+            or adaptive_threads):
+        metrics = None
+        if metrics_file is not None:
+            metrics = (metrics_file, checkpoint_stage or function.__name__, monitor_interval, history_db)
+        return _run_packed(sample_list, function, max_workers, memory_per_sample,
+                           memory_budget, thread_budget, max_retries, metrics,
+                           runtime_per_sample=runtime_per_sample, adaptive_threads=adaptive_threads,
+                           **kwargs)
+    
     logger.info(f"Starting parallel processing of {len(sample_list)} samples with {max_workers} workers")
     
     results = {}
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        # Submit tasks with proper handling for different tuple formats
+        # Submit tasks with proper handling for different tuple formats; the pool
+        # starts them in submission order, so the largest inputs go first
         future_to_sample = {}
-        for sample_tuple in sample_list:
+        for sample_tuple in sorted(sample_list, key=sample_input_bytes, reverse=True):
             # Extract sample_id which should always be the first element
             if len(sample_tuple) >= 1:
                 sample_id = sample_tuple[0]
@@ -105,3 +258,444 @@ def run_parallel(sample_list, function, max_workers=None, **kwargs):
     logger.info(f"Completed parallel processing. Successfully processed {len(results)} of {len(sample_list)} samples")
     return results
 
+
+
+class _ThreadUtilization:
+    """
+    Thread-seconds allocated to running samples over a run, for the end-of-run report.
+    
+    Call update() whenever the running set or the queue changes; the tail is the
+    time after the queue drained, when free threads can no longer be filled.
+    """
+    
+    def __init__(self, thread_budget):
+        self.thread_budget = thread_budget
+        self.start_time = time.time()
+        self.thread_seconds = 0.0
+        self.tail_idle = 0.0
+        self._last = self.start_time
+        self._threads = 0
+        self._pending = True
+    
+    def update(self, reserved_threads, pending):
+        now = time.time()
+        elapsed = now - self._last
+        self.thread_seconds += self._threads * elapsed
+        if not self._pending:
+            self.tail_idle += max(self.thread_budget - self._threads, 0) * elapsed
+        self._last = now
+        self._threads = reserved_threads
+        self._pending = bool(pending)
+    
+    def report(self, logger):
+        self.update(0, False)
+        capacity = self.thread_budget * (self._last - self.start_time)
+        if capacity <= 0:
+            return
+        logger.info(f"Thread utilization {100 * self.thread_seconds / capacity:.0f}% "
+                    f"({self.thread_seconds:.0f} of {capacity:.0f} thread-seconds); "
+                    f"{self.tail_idle:.0f} thread-seconds idle after the queue drained")
+
+def _job_threads(threads, adaptive_threads, reserved_threads, thread_budget, pending, free_slots):
+    """
+    Threads for a job being started.
+    
+    In adaptive mode, once the queue is short enough that every waiting job can
+    start now, the free threads are shared among them instead of sitting idle.
+    """
+    waiting = len(pending) + 1
+    if not adaptive_threads or waiting > free_slots:
+        return threads
+    return max(threads, (thread_budget - reserved_threads) // waiting)
+
+def _memory_jobs(sample_list, memory_per_sample, logger, runtime_per_sample=None):
+    """Pending-job records (sample tuple, projected memory and runtime, attempts) for the packers."""
+    jobs = []
+    for sample_tuple in sample_list:
+        if len(sample_tuple) < 1:
+            logger.error(f"Invalid sample tuple format: {sample_tuple}")
+            continue
+        if callable(memory_per_sample):
+            memory = memory_per_sample(sample_tuple)
+        else:
+            memory = memory_per_sample or 0
+        runtime = runtime_per_sample(sample_tuple) if runtime_per_sample is not None else None
+        jobs.append({'sample': sample_tuple, 'memory': float(memory), 'runtime': runtime,
+                     'input_bytes': sample_input_bytes(sample_tuple), 'attempts': 0})
+    if any(job['runtime'] is not None for job in jobs):
+        longest = max(jobs, key=lambda job: job['runtime'] or 0)
+        logger.info(f"Starting samples longest first (longest projected: sample {longest['sample'][0]}, "
+                    f"{longest['runtime'] or 0:.0f} seconds)")
+    return jobs
+
+def _next_admissible(pending, anything_running, reserved_memory, memory_budget,
+                     threads_after, thread_budget, threads, logger):
+    """
+    Remove and return the largest pending job that fits the budgets, or None.
+    
+    Jobs are ranked by projected runtime, then memory, then input size, so the
+    longest jobs start first and the run does not end waiting on one slow
+    sample. A job too large for the budget on its own is admitted when nothing
+    else runs.
+    """
+    pending.sort(key=lambda job: (job.get('runtime') or 0, job['memory'], job.get('input_bytes', 0)),
+                 reverse=True)
+    for job in pending:
+        fits = reserved_memory + job['memory'] <= memory_budget and threads_after <= thread_budget
+        if anything_running and fits:
+            # The budget only counts projections; also check what is really free now
+            memory_ok, _, _, _ = check_resource_availability(job['memory'], threads)
+            fits = memory_ok
+        elif not anything_running and not fits:
+            logger.warning(f"Sample {job['sample'][0]} needs about {job['memory']:.0f} MB, more than "
+                           f"the {memory_budget:.0f} MB budget; running it on its own")
+            fits = True
+        if fits:
+            pending.remove(job)
+            return job
+    return None
+
+def _run_packed(sample_list, function, max_workers, memory_per_sample, memory_budget,
+                thread_budget, max_retries, metrics=None, runtime_per_sample=None,
+                adaptive_threads=False, **kwargs):
+    """
+    Admit samples only while their projected memory and threads fit the budgets.
+    
+    Waiting samples are kept longest-first (by projected runtime, then memory) and
+    each free slot goes to the first one that still fits (first-fit decreasing),
+    so big samples are not starved by a stream of small ones and small samples
+    fill the gaps next to big ones. A
+    sample that runs out of memory is requeued with a larger estimate and the
+    number of concurrent samples is lowered. A worker killed outright breaks the
+    whole pool: only its sample counts as out of memory, the other samples that
+    were running are requeued as they were, and concurrency drops once. A sample too large for the budget
+    on its own runs when nothing else is running. With adaptive_threads, samples
+    started once the queue has drained share the free threads (see _job_threads).
+    
+    metrics is None or a tuple (metrics_file, tool, monitor_interval, history_db);
+    each finished attempt then appends the resource record of its worker's process
+    tree, and the records are stored in the run history database at the end.
+    """
+    # kwargs may carry the sample function's own logger, so don't take one as a parameter
+    logger = logging.getLogger('humann3_analysis')
+    cpu_count = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = cpu_count
+    if thread_budget is None:
+        thread_budget = cpu_count
+    if memory_budget is None:
+        memory_budget = psutil.virtual_memory().available / (1024 * 1024)
+    threads = kwargs.get('threads') or 1
+    adaptive_threads = adaptive_threads and 'threads' in kwargs
+    
+    pending = _memory_jobs(sample_list, memory_per_sample, logger, runtime_per_sample)
+    records = []
+    utilization = _ThreadUtilization(thread_budget)
+    
+    logger.info(f"Starting memory-aware parallel processing of {len(pending)} samples "
+                f"(memory budget {memory_budget:.0f} MB, {thread_budget} threads, "
+                f"{threads} threads and up to {max_workers} processes per run)")
+    
+    results = {}
+    concurrency = max_workers
+    running = {}
+    reserved_memory = 0.0
+    reserved_threads = 0
+    executor, started_samples = _packed_pool(max_workers)
+    progress = tqdm(total=len(pending), desc="Processing samples", unit="sample")
+    
+    try:
+        while pending or running:
+            while len(running) < concurrency:
+                job = _next_admissible(pending, bool(running), reserved_memory, memory_budget,
+                                       reserved_threads + threads, thread_budget, threads, logger)
+                if job is None:
+                    break
+                job['threads'] = _job_threads(threads, adaptive_threads, reserved_threads, thread_budget,
+                                              pending, concurrency - len(running))
+                job_kwargs = dict(kwargs, threads=job['threads']) if adaptive_threads else kwargs
+                future = executor.submit(process_sample_tracked, job['sample'], function,
+                                         monitor_interval=metrics[2] if metrics else None, **job_kwargs)
+                running[future] = job
+                reserved_memory += job['memory']
+                reserved_threads += job['threads']
+                logger.debug(f"Admitted sample {job['sample'][0]} ({job['memory']:.0f} MB projected, "
+                             f"{reserved_memory:.0f} MB reserved, {job['threads']} threads)")
+                if job['threads'] > threads:
+                    logger.info(f"Queue drained: running sample {job['sample'][0]} with "
+                                f"{job['threads']} threads instead of {threads}")
+            utilization.update(reserved_threads, pending)
+            
+            if not running:
+                break
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # Every future of a broken pool fails; settle them all as one event
+                done, _ = wait(running)
+            broken_jobs = []
+            for future in done:
+                job = running.pop(future)
+                sample_id = job['sample'][0]
+                reserved_memory -= job['memory']
+                reserved_threads -= job['threads']
+                
+                out_of_memory = False
+                result = None
+                usage = None
+                try:
+                    sample_id, result, out_of_memory, usage = future.result()
+                except BrokenProcessPool:
+                    # A worker was killed outright, which takes the whole pool down
+                    broken_jobs.append(job)
+                    continue
+                except Exception as e:
+                    logger.error(f"Error processing sample {sample_id}: {str(e)}")
+                    logger.debug(f"Error details:", exc_info=True)
+                
+                if metrics and usage is not None:
+                    status = "out_of_memory" if out_of_memory else ("completed" if result is not None else "failed")
+                    record = resource_record(job['sample'], metrics[1], usage, status, threads=job['threads'],
+                                             memory_estimate=job['memory'], attempt=job['attempts'])
+                    write_resource_record(metrics[0], record, logger=logger)
+                    records.append(record)
+                
+                if out_of_memory and job['attempts'] < max_retries:
+                    job['attempts'] += 1
+                    job['memory'] = max(job['memory'], 1.0) * OOM_RETRY_FACTOR
+                    concurrency = max(1, min(concurrency, len(running) + 1) - 1)
+                    logger.warning(f"Sample {sample_id} ran out of memory; requeued with a "
+                                   f"{job['memory']:.0f} MB estimate and at most {concurrency} concurrent samples")
+                    pending.append(job)
+                    continue
+                
+                progress.update(1)
+                if result is not None:
+                    results[sample_id] = result
+                    logger.info(f"Successfully processed sample {sample_id}")
+                elif out_of_memory:
+                    logger.error(f"Failed to process sample {sample_id}: out of memory after {job['attempts']} retries")
+                else:
+                    logger.error(f"Failed to process sample {sample_id}")
+            
+            if broken_jobs:
+                killed = _killed_job(executor, started_samples, broken_jobs)
+                concurrency = max(1, min(concurrency, len(broken_jobs)) - 1)
+                for job in broken_jobs:
+                    if job is not killed:
+                        # Collateral of the broken pool: start again without using up a retry
+                        logger.info(f"Sample {job['sample'][0]} requeued after another sample's worker was killed")
+                        pending.append(job)
+                    elif job['attempts'] < max_retries:
+                        job['attempts'] += 1
+                        job['memory'] = max(job['memory'], 1.0) * OOM_RETRY_FACTOR
+                        logger.warning(f"Sample {job['sample'][0]} ran out of memory (worker killed); requeued "
+                                       f"with a {job['memory']:.0f} MB estimate and at most {concurrency} "
+                                       f"concurrent samples")
+                        pending.append(job)
+                    else:
+                        progress.update(1)
+                        logger.error(f"Failed to process sample {job['sample'][0]}: out of memory after "
+                                     f"{job['attempts']} retries")
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor, started_samples = _packed_pool(max_workers)
+            utilization.update(reserved_threads, pending)
+    finally:
+        progress.close()
+        executor.shutdown(wait=True)
+        if records:
+            record_runs(records, path=metrics[3], logger=logger)
+    
+    logger.info(f"Completed parallel processing. Successfully processed {len(results)} of {len(sample_list)} samples")
+    utilization.report(logger)
+    return results
+
+def run_commands_parallel(sample_list, build_command, collect=None, max_workers=None,
+                          memory_per_sample=None, memory_budget=None, thread_budget=None,
+                          threads=1, max_retries=1, timeout=None, log_dir=None,
+                          checkpoint_dir=None, checkpoint_stage=None, checkpoint_params=None,
+                          resume=False, metrics_file=None, monitor_interval=RESOURCE_SAMPLE_INTERVAL,
+                          runtime_per_sample=None, history_db=None, adaptive_threads=False, logger=None):
+    """
+    Run one external command per sample, driving every command from one event loop.
+    
+    Unlike run_parallel, no worker process is started per sample: the commands are
+    child processes of this one, their output is streamed to the logger (and to
+    <log_dir>/<sample_id>.log), and a command that exceeds the timeout has its
+    whole process group stopped. Samples are admitted with the same memory and
+    thread packing as _run_packed, and a command killed with SIGKILL is requeued
+    with a larger memory estimate. While a command runs, its process tree is
+    sampled every monitor_interval seconds and each finished attempt appends a
+    resource record (peak RSS, CPU time, I/O) to metrics_file; the records are
+    also stored in the run history database that runtime_per_sample and
+    memory_per_sample predictions are usually fitted on.
+    
+    Args:
+        sample_list: List of sample tuples (sample_id, file, ...)
+        build_command: Function of a sample tuple and its thread count returning
+                       the command as a list
+        collect: Function of a sample tuple called after its command succeeded,
+                 returning the sample's result (None marks it failed); default True
+        max_workers: Maximum number of concurrent commands (None = CPU count)
+        memory_per_sample: Projected peak memory per command in MB, or a function
+                           of the sample tuple returning it
+        memory_budget: Memory in MB the running commands may use together
+                       (None = memory available when the run starts)
+        thread_budget: Threads the running commands may use together (None = CPU count)
+        threads: Threads each command uses (the base allocation with adaptive_threads)
+        max_retries: Times a command killed for lack of memory is requeued
+        timeout: Wall-clock limit per command in seconds (None = no limit)
+        log_dir: Directory for per-sample command logs
+        checkpoint_dir: Write a completion manifest for every successful sample here
+        checkpoint_stage: Stage name of the manifests
+        checkpoint_params: Dict of parameters recorded in (and checked against) the manifests
+        resume: Reuse the results of samples whose manifest is still valid
+        metrics_file: Append a resource record per sample attempt to this file
+        monitor_interval: Seconds between resource samples of each running command
+        runtime_per_sample: Function of the sample tuple returning its projected
+                            wall time in seconds (or None); longer samples start first
+        history_db: Run history database the resource records are also stored in
+                    (None = run_history.run_db_path())
+        adaptive_threads: Once every waiting sample can start, give the last
+                          commands the free threads instead of leaving them idle
+        logger: Logger instance
+    
+    Returns:
+        Dictionary mapping sample_ids to results
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    completed = {}
+    if checkpoint_dir is not None and resume:
+        sample_list, completed = _skip_completed(sample_list, checkpoint_dir, checkpoint_stage,
+                                                 checkpoint_params, logger)
+    
+    cpu_count = os.cpu_count() or 1
+    max_workers = max_workers or cpu_count
+    thread_budget = thread_budget or cpu_count
+    if memory_budget is None:
+        memory_budget = psutil.virtual_memory().available / (1024 * 1024)
+    
+    pending = _memory_jobs(sample_list, memory_per_sample, logger, runtime_per_sample)
+    records = []
+    logger.info(f"Starting {len(pending)} commands from one event loop "
+                f"(up to {max_workers} at once, memory budget {memory_budget:.0f} MB, "
+                f"{threads} of {thread_budget} threads each"
+                f"{f', {timeout} s limit' if timeout else ''})")
+    
+    async def drive():
+        results = {}
+        concurrency = max_workers
+        running = {}
+        reserved_memory = 0.0
+        reserved_threads = 0
+        monitors = {}
+        utilization = _ThreadUtilization(thread_budget)
+        progress = tqdm(total=len(pending), desc="Processing samples", unit="sample")
+        
+        async def sample_running():
+            # One sampler for every running command instead of a thread per command
+            while True:
+                await asyncio.sleep(monitor_interval)
+                for monitor in list(monitors.values()):
+                    monitor.sample()
+        
+        sampler = asyncio.ensure_future(sample_running()) if metrics_file else None
+        try:
+            while pending or running:
+                while len(running) < concurrency:
+                    job = _next_admissible(pending, bool(running), reserved_memory, memory_budget,
+                                           reserved_threads + threads, thread_budget, threads, logger)
+                    if job is None:
+                        break
+                    sample_id = job['sample'][0]
+                    log_file = os.path.join(log_dir, f"{sample_id}.log") if log_dir else None
+                    job['threads'] = _job_threads(threads, adaptive_threads, reserved_threads, thread_budget,
+                                                  pending, concurrency - len(running))
+                    command = build_command(job['sample'], job['threads'])
+                    
+                    def start_monitor(process, key=id(job)):
+                        monitors[key] = ProcessTreeMonitor(process.pid, interval=monitor_interval)
+                        monitors[key].sample()
+                    
+                    task = asyncio.ensure_future(run_cmd_async(command, timeout=timeout, log_file=log_file,
+                                                               logger=logger, on_start=start_monitor))
+                    job['tool'] = os.path.basename(str(command[0]))
+                    running[task] = (job, time.time())
+                    reserved_memory += job['memory']
+                    reserved_threads += job['threads']
+                    if job['threads'] > threads:
+                        logger.info(f"Started processing sample {sample_id} with {job['threads']} threads "
+                                    f"(queue drained)")
+                    else:
+                        logger.info(f"Started processing sample {sample_id}")
+                utilization.update(reserved_threads, pending)
+                
+                if not running:
+                    break
+                
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job, start_time = running.pop(task)
+                    sample_id = job['sample'][0]
+                    reserved_memory -= job['memory']
+                    reserved_threads -= job['threads']
+                    returncode = task.result()
+                    
+                    monitor = monitors.pop(id(job), None)
+                    if metrics_file and monitor is not None:
+                        if returncode == 0:
+                            status = "completed"
+                        elif returncode is None:
+                            status = "timeout"
+                        else:
+                            status = "out_of_memory" if is_sigkill(returncode) else "failed"
+                        record = resource_record(job['sample'], checkpoint_stage or job['tool'], monitor.stop(),
+                                                 status, threads=job['threads'], memory_estimate=job['memory'],
+                                                 attempt=job['attempts'])
+                        write_resource_record(metrics_file, record, logger=logger)
+                        records.append(record)
+                    
+                    if is_sigkill(returncode) and job['attempts'] < max_retries:
+                        job['attempts'] += 1
+                        job['memory'] = max(job['memory'], 1.0) * OOM_RETRY_FACTOR
+                        concurrency = max(1, min(concurrency, len(running) + 1) - 1)
+                        logger.warning(f"Sample {sample_id} ran out of memory; requeued with a "
+                                       f"{job['memory']:.0f} MB estimate and at most {concurrency} concurrent samples")
+                        pending.append(job)
+                        continue
+                    
+                    progress.update(1)
+                    result = None
+                    if returncode == 0:
+                        try:
+                            result = collect(job['sample']) if collect is not None else True
+                        except Exception as e:
+                            logger.error(f"Error collecting results of sample {sample_id}: {str(e)}")
+                            logger.debug("Error details:", exc_info=True)
+                    if result is not None:
+                        results[sample_id] = result
+                        logger.info(f"Finished processing sample {sample_id} in {time.time() - start_time:.2f} seconds")
+                        if checkpoint_dir is not None:
+                            write_stage_manifest(checkpoint_dir, checkpoint_stage, sample_id, list(job['sample'][1:]),
+                                                 checkpoint_params, result, logger=logger)
+                    elif returncode is None:
+                        logger.error(f"Failed to process sample {sample_id}: timed out after {timeout} seconds")
+                    else:
+                        logger.error(f"Failed to process sample {sample_id}")
+                utilization.update(reserved_threads, pending)
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+            progress.close()
+            if records:
+                record_runs(records, path=history_db, logger=logger)
+        utilization.report(logger)
+        return results
+    
+    # Interrupting the run cancels the tasks, which stops every command's process group
+    results = asyncio.run(drive())
+    logger.info(f"Completed parallel processing. Successfully processed {len(results)} of {len(sample_list)} samples")
+    completed.update(results)
+    return completed
@@ -1,13 +1,24 @@
 # humann3_tools/preprocessing/pipeline.py
 import os
+import re
 import logging
-from src.humann3_tools.preprocessing.kneaddata import run_kneaddata, check_kneaddata_installation, run_kneaddata_parallel
-from src.humann3_tools.preprocessing.humann3_run import run_humann3, check_humann3_installation, run_humann3_parallel
+from src.humann3_tools.core.kneaddata import (
+    run_kneaddata, check_kneaddata_installation, run_kneaddata_parallel, paired_kneaddata_wrapper
+)
+from src.humann3_tools.preprocessing.humann3_run import (
+    run_humann3, check_humann3_installation, run_humann3_parallel, process_single_sample_humann3
+)
+from src.humann3_tools.humann3.output_manifest import update_run_manifest
+from src.humann3_tools.preprocessing.stage_pipeline import Stage, run_stage_pipeline
+from src.humann3_tools.utils.checkpoint import default_checkpoint_dir, run_checkpointed
+from src.humann3_tools.utils.file_utils import concatenate_files, paired_concat_path
 from src.humann3_tools.logger import log_print
+from src.humann3_tools.utils.run_history import RunPredictor
 from src.humann3_tools.utils.resource_utils import (
     track_peak_memory, 
     monitor_memory_usage, 
-    stop_memory_monitoring
+    stop_memory_monitoring,
+    default_metrics_file
 )
 from src.humann3_tools.humann3.join_unstratify import process_join_unstratify, join_unstratify_humann_output
 
@@ -26,6 +37,7 @@ def run_preprocessing_pipeline(
     skip_kneaddata=False,
     kneaddata_output_files=None,
     kneaddata_output_pattern=None,
+    resume=False,
     logger=None
 ):
     """
@@ -51,6 +63,8 @@ def run_preprocessing_pipeline(
         skip_kneaddata: Whether to skip KneadData processing
         kneaddata_output_files: List of existing KneadData output files to use
         kneaddata_output_pattern: Pattern to find KneadData output files
+        resume: Skip KneadData/HUMAnN3 runs whose completion manifest in
+                <output_dir>/checkpoints is still valid
         logger: Logger instance
 
     Returns:
@@ -94,6 +108,10 @@ def run_preprocessing_pipeline(
     logger.info(f"Using KneadData output directory: {kneaddata_output_dir}")
     logger.info(f"Using HUMAnN3 output directory: {humann3_output_dir}")
 
+    # Every completed sample/step is recorded so an interrupted run can resume
+    checkpoint_dir = default_checkpoint_dir(output_dir)
+    kneaddata_params = {'reference_dbs': kneaddata_dbs, 'additional_options': kneaddata_options}
+
     # 3. Handle KneadData step
     kneaddata_files = []
     
@@ -163,14 +181,19 @@ def run_preprocessing_pipeline(
                 os.makedirs(sample_outdir, exist_ok=True)
 
                 logger.info(f"KneadData on paired files for sample {sample_name}")
-                results = run_kneaddata(
-                    input_files=pair,
-                    output_dir=sample_outdir,
-                    threads=threads,
-                    reference_dbs=kneaddata_dbs,
-                    paired=True,
-                    additional_options=kneaddata_options,
-                    logger=logger,
+                results = run_checkpointed(
+                    checkpoint_dir, "kneaddata", sample_name, pair,
+                    dict(kneaddata_params, output_dir=sample_outdir, paired=True),
+                    lambda: run_kneaddata(
+                        input_files=pair,
+                        output_dir=sample_outdir,
+                        threads=threads,
+                        reference_dbs=kneaddata_dbs,
+                        paired=True,
+                        additional_options=kneaddata_options,
+                        logger=logger,
+                    ),
+                    resume=resume, logger=logger
                 )
                 if results:
                     kneaddata_files.extend(results)
@@ -185,14 +208,19 @@ def run_preprocessing_pipeline(
                 os.makedirs(sample_outdir, exist_ok=True)
 
                 logger.info(f"KneadData on single-end file for sample {sample_name}")
-                results = run_kneaddata(
-                    input_files=[f],
-                    output_dir=sample_outdir,
-                    threads=threads,
-                    reference_dbs=kneaddata_dbs,
-                    paired=False,
-                    additional_options=kneaddata_options,
-                    logger=logger,
+                results = run_checkpointed(
+                    checkpoint_dir, "kneaddata", sample_name, [f],
+                    dict(kneaddata_params, output_dir=sample_outdir, paired=False),
+                    lambda: run_kneaddata(
+                        input_files=[f],
+                        output_dir=sample_outdir,
+                        threads=threads,
+                        reference_dbs=kneaddata_dbs,
+                        paired=False,
+                        additional_options=kneaddata_options,
+                        logger=logger,
+                    ),
+                    resume=resume, logger=logger
                 )
                 if results:
                     kneaddata_files.extend(results)
@@ -261,17 +289,10 @@ def run_preprocessing_pipeline(
                 f"Concatenating R1 and R2 for sample {sample_name} -> single HUMAnN3 input"
             )
             out_dir = os.path.dirname(r1)
-            concat_file = os.path.join(out_dir, f"{sample_name}_paired_concat.fastq")
+            concat_file = paired_concat_path(out_dir, sample_name, [r1, r2])
 
             try:
-                with open(concat_file, "w") as outfile:
-                    for rf in (r1, r2):
-                        size = os.path.getsize(rf)
-                        logger.debug(f"  Adding {os.path.basename(rf)} ({size} bytes)")
-                        with open(rf, "r") as infile:
-                            outfile.write(infile.read())
-
-                if os.path.getsize(concat_file) > 0:
+                if concatenate_files([r1, r2], concat_file, logger=logger) > 0:
                     logger.info(f"Created {os.path.basename(concat_file)} for {sample_name}")
                     humann3_input_files.append(concat_file)
                 else:
@@ -289,23 +310,37 @@ def run_preprocessing_pipeline(
         logger.error("No valid input files after KneadData processing; cannot run HUMAnN3.")
         return None
 
-    # 6. Run HUMAnN3
+    # 6. Run HUMAnN3, one sample at a time so each one is checkpointed
     logger.info("Starting HUMAnN3...")
-    humann3_results = run_humann3(
-        input_files=humann3_input_files,
-        output_dir=humann3_output_dir,
-        threads=threads,
-        nucleotide_db=nucleotide_db,
-        protein_db=protein_db,
-        additional_options=humann3_options,
-        logger=logger
-    )
+    humann3_params = {'output_dir': humann3_output_dir, 'nucleotide_db': nucleotide_db,
+                      'protein_db': protein_db, 'additional_options': humann3_options}
+    humann3_results = {}
+    for input_file in humann3_input_files:
+        # Same sample name as run_humann3 derives
+        sample_name = os.path.basename(input_file).split("_")[0]
+        sample_outputs = run_checkpointed(
+            checkpoint_dir, "humann", sample_name, [input_file], humann3_params,
+            lambda: run_humann3(
+                input_files=[input_file],
+                output_dir=humann3_output_dir,
+                threads=threads,
+                nucleotide_db=nucleotide_db,
+                protein_db=protein_db,
+                additional_options=humann3_options,
+                logger=logger
+            ).get(sample_name),
+            resume=resume, logger=logger
+        )
+        if sample_outputs:
+            humann3_results[sample_name] = sample_outputs
     
     if not humann3_results:
         logger.error("HUMAnN3 step failed.")
         return None
 
     logger.info(f"HUMAnN3 completed for {len(humann3_results)} samples.")
+    # Resumed samples did not run, so refresh their entries in the run manifest too
+    update_run_manifest(humann3_output_dir, humann3_results, logger=logger)
 
     if humann3_results:
         for sample_id, files in humann3_results.items():
@@ -318,13 +353,197 @@ def run_preprocessing_pipeline(
         "humann3_results": humann3_results,
     }
 
+def prepare_humann3_input(sample_id, files, logger=None):
+    """
+    Concatenate a sample's KneadData paired outputs into a single HUMAnN3 input.
+    
+    Args:
+        sample_id: Sample identifier (must appear in the paired file names)
+        files: KneadData output files for the sample
+        logger: Logger instance
+        
+    Returns:
+        Path to the concatenated FASTQ file, or None if it could not be created
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    # First, strictly filter to only paired output files that belong to THIS sample
+    # The sample ID must appear as a whole token, so S1 does not match S10's files
+    sample_pattern = re.compile(rf"(?<![A-Za-z0-9]){re.escape(sample_id)}(?![A-Za-z0-9])")
+    paired_files = []
+    for file in files:
+        filename = os.path.basename(file)
+        # Only include files that match both the pattern AND belong to this sample
+        if sample_pattern.search(filename) and ("_paired_1.fastq" in filename or "_paired_2.fastq" in filename):
+            paired_files.append(file)
+            logger.debug(f"Found paired file for {sample_id}: {filename}")
+    
+    # Skip samples without exactly 2 paired files
+    if len(paired_files) != 2:
+        logger.warning(f"Sample {sample_id} has {len(paired_files)} paired files (expected 2). Skipping.")
+        return None
+    
+    # Sort to ensure R1 comes before R2
+    paired_files.sort()
+    
+    # Verify we have proper paired files
+    file1 = os.path.basename(paired_files[0])
+    file2 = os.path.basename(paired_files[1])
+    
+    if "_paired_1.fastq" not in file1 or "_paired_2.fastq" not in file2:
+        logger.warning(f"Files for sample {sample_id} don't match expected pattern: {file1}, {file2}. Skipping.")
+        return None
+    
+    # Create concatenated file for HUMAnN3
+    concat_dir = os.path.dirname(paired_files[0])
+    concatenated_file = paired_concat_path(concat_dir, sample_id, paired_files)
+    logger.info(f"Concatenating paired files for sample {sample_id} to {os.path.basename(concatenated_file)}")
+    
+    try:
+        # Stream the reads into the concatenated file without loading them
+        concatenate_files(paired_files, concatenated_file, logger=logger)
+        
+        # Verify the concatenated file
+        if os.path.exists(concatenated_file) and os.path.getsize(concatenated_file) > 0:
+            logger.info(f"Successfully created concatenated file: {os.path.basename(concatenated_file)} "
+                     f"(Size: {os.path.getsize(concatenated_file)} bytes)")
+            return concatenated_file
+        logger.error(f"Failed to create valid concatenated file for {sample_id}.")
+    except Exception as e:
+        logger.error(f"Error concatenating files for sample {sample_id}: {str(e)}")
+    return None
+
+def pair_input_files(input_files, paired=False, logger=None):
+    """
+    Group raw input files by sample.
+    
+    Args:
+        input_files: List of FASTQ files (R1, R2, R1, R2, ... in paired mode)
+        paired: Whether input files are paired
+        logger: Logger instance
+        
+    Returns:
+        Dict mapping sample IDs to a tuple of their input files
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    samples = {}
+    if paired:
+        if len(input_files) % 2 != 0:
+            logger.error("Paired mode requires an even number of input files")
+            return {}
+        
+        for i in range(0, len(input_files), 2):
+            r1_file, r2_file = input_files[i], input_files[i+1]
+            sample_name = os.path.basename(r1_file)
+            # Strip off common suffixes to get the base sample name
+            for suffix in ["_R1.fastq", "_R1.fastq.gz", "_1.fastq", "_1.fastq.gz"]:
+                if sample_name.endswith(suffix):
+                    sample_name = sample_name[:-len(suffix)]
+                    break
+            samples[sample_name] = (r1_file, r2_file)
+    else:
+        for file in input_files:
+            samples[os.path.basename(file).split('.')[0]] = (file,)
+    
+    return samples
+
+# Stage functions for the pipelined run; they run in worker processes, so they
+# live at module level and take (sample_id, upstream result, **kwargs)
+def _kneaddata_stage(sample_id, sample_files, **kwargs):
+    paired_file = sample_files[1] if len(sample_files) > 1 else None
+    return paired_kneaddata_wrapper(sample_files[0], sample_id=sample_id, paired_file=paired_file, **kwargs)
+
+def _prepare_stage(sample_id, kneaddata_files, logger=None):
+    return prepare_humann3_input(sample_id, kneaddata_files or [], logger)
+
+def _humann3_stage(sample_id, input_file, output_dir, **kwargs):
+    # Each sample runs in its own directory so output discovery cannot pick up
+    # another sample's files; the collected outputs still share the top-level dirs
+    return process_single_sample_humann3(
+        input_file,
+        sample_id=sample_id,
+        output_dir=os.path.join(output_dir, sample_id),
+        pathabdirectory=os.path.join(output_dir, "Pathabundance"),
+        genedirectory=os.path.join(output_dir, "GeneFamilies"),
+        pathcovdirectory=os.path.join(output_dir, "PathCoverage"),
+        metadirectory=os.path.join(output_dir, "MetaphlanFiles"),
+        **kwargs
+    )
+
+def _run_pipelined(input_files, kneaddata_output, humann3_output, threads_per_sample, max_parallel,
+                   kneaddata_dbs, nucleotide_db, protein_db, kneaddata_options, humann3_options,
+                   paired, stage_limits, checkpoint_dir, resume, logger):
+    """Run KneadData -> input preparation -> HUMAnN3 per sample on one shared pool."""
+    samples = pair_input_files(input_files, paired=paired, logger=logger)
+    if not samples:
+        logger.error("No input samples to process")
+        return None
+    
+    # Both tools' runtimes grow with the raw input size, so their summed
+    # predictions rank the samples even though HUMAnN3 sees the cleaned reads
+    predictors = [RunPredictor.from_history(tool, threads=threads_per_sample, logger=logger)
+                  for tool in ("kneaddata", "humann")]
+    
+    def runtime_per_sample(sample_files):
+        runtimes = [predictor.predict_runtime((None, *sample_files)) for predictor in predictors]
+        runtimes = [runtime for runtime in runtimes if runtime is not None]
+        return sum(runtimes) if runtimes else None
+    
+    stage_limits = stage_limits or {}
+    stages = [
+        Stage("kneaddata", _kneaddata_stage, {
+            'output_dir': kneaddata_output,
+            'threads': threads_per_sample,
+            'reference_dbs': kneaddata_dbs,
+            'additional_options': kneaddata_options,
+            'logger': logger
+        }, max_concurrent=stage_limits.get("kneaddata")),
+        Stage("prepare", _prepare_stage, {'logger': logger},
+              max_concurrent=stage_limits.get("prepare")),
+        Stage("humann", _humann3_stage, {
+            'output_dir': humann3_output,
+            'threads': threads_per_sample,
+            'nucleotide_db': nucleotide_db,
+            'protein_db': protein_db,
+            'additional_options': humann3_options,
+            'logger': logger
+        }, max_concurrent=stage_limits.get("humann")),
+    ]
+    
+    logger.info(f"Starting pipelined KneadData -> HUMAnN3 processing of {len(samples)} samples")
+    humann3_results, status = run_stage_pipeline(samples, stages, max_workers=max_parallel,
+                                                 checkpoint_dir=checkpoint_dir, resume=resume,
+                                                 runtime_per_sample=runtime_per_sample,
+                                                 metrics_file=default_metrics_file(os.path.join(humann3_output, "logs")),
+                                                 logger=logger)
+    
+    if not humann3_results:
+        logger.error("No samples completed the KneadData -> HUMAnN3 pipeline")
+        return None
+    
+    logger.info(f"HUMAnN3 completed for {len(humann3_results)} samples")
+    update_run_manifest(humann3_output, humann3_results, logger=logger)
+    
+    # The HUMAnN3 inputs are the concatenated files the prepare stage produced
+    kneaddata_files = [status[sample_id]['results']['prepare'] for sample_id in humann3_results]
+    
+    return {
+        'kneaddata_files': kneaddata_files,
+        'humann3_results': humann3_results
+    }
+
 def run_preprocessing_pipeline_parallel(input_files, output_dir, threads_per_sample=1, 
                                        max_parallel=None, kneaddata_dbs=None, 
                                        nucleotide_db=None, protein_db=None,
                                        kneaddata_options=None, humann3_options=None, 
                                        paired=False, kneaddata_output_dir=None, humann3_output_dir=None,
                                        skip_kneaddata=False, kneaddata_output_files=None, 
-                                       kneaddata_output_pattern="kneaddata_paired", logger=None):
+                                       kneaddata_output_pattern="kneaddata_paired", pipelined=True,
+                                       stage_limits=None, resume=False, adaptive_threads=False,
+                                       logger=None):
     """
     Run the full preprocessing pipeline in parallel: KneadData → HUMAnN3.
     
@@ -344,6 +563,14 @@ def run_preprocessing_pipeline_parallel(input_files, output_dir, threads_per_sam
         skip_kneaddata: Whether to skip KneadData processing
         kneaddata_output_files: List of existing KneadData output files to use
         kneaddata_output_pattern: Pattern to find KneadData output files
+        pipelined: Start each sample's HUMAnN3 run as soon as its own KneadData run
+                   finishes instead of waiting for all samples
+        stage_limits: Dict of maximum concurrent samples per stage ("kneaddata",
+                      "prepare", "humann") within the max_parallel pool
+        resume: Skip per-sample steps whose completion manifest in
+                <output_dir>/checkpoints is still valid
+        adaptive_threads: When pipelined=False, run the last samples of each step
+                          with the threads the drained queue leaves free
         logger: Logger instance
         
     Returns:
@@ -513,53 +740,15 @@ def run_preprocessing_pipeline_parallel(input_files, output_dir, threads_per_sam
         for sample_id, files in sample_files.items():
             logger.info(f"Processing KneadData output for sample {sample_id}")
             
-            # First, strictly filter to only paired output files that belong to THIS sample
-            paired_files = []
-            for file in files:
-                filename = os.path.basename(file)
-                # Only include files that match both the pattern AND belong to this sample
-                if (f"{sample_id}" in filename) and ("_paired_1.fastq" in filename or "_paired_2.fastq" in filename):
-                    paired_files.append(file)
-                    logger.debug(f"Found paired file for {sample_id}: {filename}")
-            
-            # Skip samples without exactly 2 paired files
-            if len(paired_files) != 2:
-                logger.warning(f"Sample {sample_id} has {len(paired_files)} paired files (expected 2). Skipping.")
-                continue
-            
-            # Sort to ensure R1 comes before R2
-            paired_files.sort()
-            
-            # Verify we have proper paired files
-            file1 = os.path.basename(paired_files[0])
-            file2 = os.path.basename(paired_files[1])
-            
-            if "_paired_1.fastq" not in file1 or "_paired_2.fastq" not in file2:
-                logger.warning(f"Files for sample {sample_id} don't match expected pattern: {file1}, {file2}. Skipping.")
-                continue
-            
-            # Create concatenated file for HUMAnN3
-            concat_dir = os.path.dirname(paired_files[0])
-            concatenated_file = os.path.join(concat_dir, f"{sample_id}_paired_concat.fastq")
-            logger.info(f"Concatenating paired files for sample {sample_id} to {os.path.basename(concatenated_file)}")
-            
-            try:
-                # Create concatenated file
-                with open(concatenated_file, 'w') as outfile:
-                    for file in paired_files:
-                        logger.debug(f"  Adding file: {os.path.basename(file)} (Size: {os.path.getsize(file)} bytes)")
-                        with open(file, 'r') as infile:
-                            outfile.write(infile.read())
-                
-                # Verify the concatenated file
-                if os.path.exists(concatenated_file) and os.path.getsize(concatenated_file) > 0:
-                    logger.info(f"Successfully created concatenated file: {os.path.basename(concatenated_file)} "
-                             f"(Size: {os.path.getsize(concatenated_file)} bytes)")
-                    humann3_input_files.append(concatenated_file)
-                else:
-                    logger.error(f"Failed to create valid concatenated file for {sample_id}.")
-            except Exception as e:
-                logger.error(f"Error concatenating files for sample {sample_id}: {str(e)}")
+            concatenated_file = prepare_humann3_input(sample_id, files, logger)
+            if concatenated_file:
+                humann3_input_files.append(concatenated_file)
+    elif pipelined:
+        return _run_pipelined(
+            input_files, kneaddata_output, humann3_output, threads_per_sample, max_parallel,
+            kneaddata_dbs, nucleotide_db, protein_db, kneaddata_options, humann3_options,
+            paired, stage_limits, default_checkpoint_dir(output_dir), resume, logger
+        )
     else:
         # Run KneadData normally
         logger.info("Starting KneadData step in parallel...")
@@ -571,7 +760,10 @@ def run_preprocessing_pipeline_parallel(input_files, output_dir, threads_per_sam
             reference_dbs=kneaddata_dbs,
             paired=paired,
             additional_options=kneaddata_options,
-            logger=logger
+            logger=logger,
+            checkpoint_dir=default_checkpoint_dir(output_dir),
+            resume=resume,
+            adaptive_threads=adaptive_threads
         )
         
         if not kneaddata_results:
@@ -591,53 +783,9 @@ def run_preprocessing_pipeline_parallel(input_files, output_dir, threads_per_sam
                 logger.warning(f"No KneadData output files found for sample {sample_id}")
                 continue
                 
-            # First, strictly filter to only paired output files that belong to THIS sample
-            paired_files = []
-            for file in files:
-                filename = os.path.basename(file)
-                # Only include files that match both the pattern AND belong to this sample
-                if (f"{sample_id}" in filename) and ("_paired_1.fastq" in filename or "_paired_2.fastq" in filename):
-                    paired_files.append(file)
-                    logger.debug(f"Found paired file for {sample_id}: {filename}")
-            
-            # Skip samples without exactly 2 paired files
-            if len(paired_files) != 2:
-                logger.warning(f"Sample {sample_id} has {len(paired_files)} paired files (expected 2). Skipping.")
-                continue
-            
-            # Sort to ensure R1 comes before R2
-            paired_files.sort()
-            
-            # Verify we have proper paired files
-            file1 = os.path.basename(paired_files[0])
-            file2 = os.path.basename(paired_files[1])
-            
-            if "_paired_1.fastq" not in file1 or "_paired_2.fastq" not in file2:
-                logger.warning(f"Files for sample {sample_id} don't match expected pattern: {file1}, {file2}. Skipping.")
-                continue
-            
-            # Create concatenated file for HUMAnN3
-            concat_dir = os.path.dirname(paired_files[0])
-            concatenated_file = os.path.join(concat_dir, f"{sample_id}_paired_concat.fastq")
-            logger.info(f"Concatenating paired files for sample {sample_id} to {os.path.basename(concatenated_file)}")
-            
-            try:
-                # Create concatenated file
-                with open(concatenated_file, 'w') as outfile:
-                    for file in paired_files:
-                        logger.debug(f"  Adding file: {os.path.basename(file)} (Size: {os.path.getsize(file)} bytes)")
-                        with open(file, 'r') as infile:
-                            outfile.write(infile.read())
-                
-                # Verify the concatenated file
-                if os.path.exists(concatenated_file) and os.path.getsize(concatenated_file) > 0:
-                    logger.info(f"Successfully created concatenated file: {os.path.basename(concatenated_file)} "
-                             f"(Size: {os.path.getsize(concatenated_file)} bytes)")
-                    humann3_input_files.append(concatenated_file)
-                else:
-                    logger.error(f"Failed to create valid concatenated file for {sample_id}.")
-            except Exception as e:
-                logger.error(f"Error concatenating files for sample {sample_id}: {str(e)}")
+            concatenated_file = prepare_humann3_input(sample_id, files, logger)
+            if concatenated_file:
+                humann3_input_files.append(concatenated_file)
 
     logger.info(f"Prepared {len(humann3_input_files)} input files for HUMAnN3")
 
@@ -656,7 +804,10 @@ def run_preprocessing_pipeline_parallel(input_files, output_dir, threads_per_sam
         nucleotide_db=nucleotide_db,
         protein_db=protein_db,
         additional_options=humann3_options,
-        logger=logger
+        logger=logger,
+        checkpoint_dir=default_checkpoint_dir(output_dir),
+        resume=resume,
+        adaptive_threads=adaptive_threads
     )
     
     if not humann3_results:
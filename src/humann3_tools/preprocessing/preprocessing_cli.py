@@ -35,10 +35,24 @@ import logging
 import glob
 from typing import List, Dict, Optional, Union, Tuple
 
+# Import internal modules
+try:
+    from src.humann3_tools.utils.file_utils import concatenate_files, paired_concat_path, stage_files
+    from src.humann3_tools.humann3.output_manifest import resolve_humann3_outputs
+    from src.humann3_tools.preprocessing.pipeline import run_preprocessing_pipeline_parallel
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+    from src.humann3_tools.utils.file_utils import concatenate_files, paired_concat_path, stage_files
+    from src.humann3_tools.humann3.output_manifest import resolve_humann3_outputs
+    from src.humann3_tools.preprocessing.pipeline import run_preprocessing_pipeline_parallel
+
 # Set up logging
 logger = logging.getLogger('humann3_preprocessing')
 logger.setLevel(logging.INFO)
 
+# Stages of the pipelined run that --stage-limit can cap
+PIPELINE_STAGES = ("kneaddata", "prepare", "humann")
+
 def setup_logger(log_file=None, log_level=logging.INFO):
     """Set up the logger with console and optional file output."""
     # Remove any existing handlers to avoid duplication
@@ -322,16 +336,11 @@ def prepare_humann3_input(kneaddata_outputs, paired=False):
             
             # Create concatenated file
             out_dir = os.path.dirname(r1_file)
-            concat_file = os.path.join(out_dir, f"{sample_id}_paired_concat.fastq")
+            concat_file = paired_concat_path(out_dir, sample_id, [r1_file, r2_file])
             
             try:
-                with open(concat_file, 'w') as outfile:
-                    logger.info(f"Concatenating files for {sample_id}: {os.path.basename(r1_file)} + {os.path.basename(r2_file)}")
-                    for input_file in [r1_file, r2_file]:
-                        with open(input_file, 'r') as infile:
-                            outfile.write(infile.read())
-                
-                if os.path.getsize(concat_file) > 0:
+                logger.info(f"Concatenating files for {sample_id}: {os.path.basename(r1_file)} + {os.path.basename(r2_file)}")
+                if concatenate_files([r1_file, r2_file], concat_file, logger=logger) > 0:
                     humann3_inputs[sample_id] = concat_file
                     logger.info(f"Created concatenated file for HUMAnN3: {concat_file}")
                 else:
@@ -548,45 +557,17 @@ def run_humann3(input_files, output_dir, threads=1, nucleotide_db=None, protein_
             logger.error(f"HUMAnN3 failed for sample {sample_id}")
             continue
         
-        # Find output files
-        sample_outputs = {
-            'genefamilies': None,
-            'pathabundance': None,
-            'pathcoverage': None,
-            'metaphlan': None
+        # Outputs are named after the input file; link them into the per-type directories
+        sample_outputs = resolve_humann3_outputs(sample_outdir, input_file, additional_options, logger=logger)
+        target_dirs = {
+            'genefamilies': genefamilies_dir,
+            'pathabundance': pathabundance_dir,
+            'pathcoverage': pathcoverage_dir,
+            'metaphlan': metaphlan_dir,
         }
-        
-        # Look for output files in sample output directory
-        for root, _, files in os.walk(sample_outdir):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                
-                if not filename.endswith(".tsv"):
-                    continue
-                
-                if "genefamilies" in filename.lower():
-                    sample_outputs['genefamilies'] = filepath
-                    # Copy to genefamilies directory
-                    dest_path = os.path.join(genefamilies_dir, filename)
-                    run_cmd(["cp", filepath, dest_path], exit_on_error=False)
-                
-                elif "pathabundance" in filename.lower():
-                    sample_outputs['pathabundance'] = filepath
-                    # Copy to pathabundance directory
-                    dest_path = os.path.join(pathabundance_dir, filename)
-                    run_cmd(["cp", filepath, dest_path], exit_on_error=False)
-                
-                elif "pathcoverage" in filename.lower():
-                    sample_outputs['pathcoverage'] = filepath
-                    # Copy to pathcoverage directory
-                    dest_path = os.path.join(pathcoverage_dir, filename)
-                    run_cmd(["cp", filepath, dest_path], exit_on_error=False)
-                
-                elif "metaphlan_bugs_list" in filename.lower():
-                    sample_outputs['metaphlan'] = filepath
-                    # Copy to metaphlan directory
-                    dest_path = os.path.join(metaphlan_dir, filename)
-                    run_cmd(["cp", filepath, dest_path], exit_on_error=False)
+        stage_files([(path, os.path.join(target_dirs[file_type], os.path.basename(path)))
+                     for file_type, path in sample_outputs.items() if path],
+                    mode="link", logger=logger)
         
         # Log which files were found
         found_files = [k for k, v in sample_outputs.items() if v is not None]
@@ -746,6 +727,51 @@ def run_preprocessing_pipeline(input_files, output_dir, threads=1,
         "humann3_results": humann3_results
     }
 
+def run_scheduled_pipeline(args, kneaddata_options, humann3_options):
+    """
+    Run the pipeline through preprocessing.pipeline, which checkpoints every
+    sample and runs samples in parallel.
+    
+    Args:
+        args: Parsed command line arguments
+        kneaddata_options: Dict of additional KneadData options
+        humann3_options: Dict of additional HUMAnN3 options
+        
+    Returns:
+        Dict with preprocessing results as run_preprocessing_pipeline returns
+        them (the KneadData results are the HUMAnN3 input file of each sample),
+        or None if the pipeline failed
+    """
+    results = run_preprocessing_pipeline_parallel(
+        input_files=args.input_fastq,
+        output_dir=args.output_dir,
+        threads_per_sample=args.threads,
+        max_parallel=args.max_parallel or 1,
+        kneaddata_dbs=args.kneaddata_dbs,
+        nucleotide_db=args.humann3_nucleotide_db,
+        protein_db=args.humann3_protein_db,
+        kneaddata_options=kneaddata_options,
+        humann3_options=humann3_options,
+        paired=args.paired,
+        kneaddata_output_dir=args.kneaddata_output_dir,
+        humann3_output_dir=args.humann3_output_dir,
+        skip_kneaddata=args.skip_kneaddata,
+        kneaddata_output_files=args.kneaddata_output_files,
+        kneaddata_output_pattern=args.kneaddata_output_pattern or "kneaddata_paired",
+        pipelined=args.pipelined,
+        stage_limits=dict(args.stage_limit or []),
+        resume=args.resume,
+        adaptive_threads=args.adaptive_threads,
+        logger=logger
+    )
+    if not results:
+        return None
+    
+    return {
+        "kneaddata_results": results["kneaddata_files"],
+        "humann3_results": results["humann3_results"]
+    }
+
 def main():
     """Main function to run the preprocessing pipeline."""
     # Parse arguments
@@ -787,21 +813,28 @@ def main():
         humann3_options["bypass-translated-search"] = True
     
     # Run the preprocessing pipeline
-    results = run_preprocessing_pipeline(
-        input_files=args.input_fastq,
-        output_dir=args.output_dir,
-        threads=args.threads,
-        kneaddata_dbs=args.kneaddata_dbs,
-        nucleotide_db=args.humann3_nucleotide_db,
-        protein_db=args.humann3_protein_db,
-        paired=args.paired,
-        kneaddata_options=kneaddata_options,
-        humann3_options=humann3_options,
-        skip_kneaddata=args.skip_kneaddata,
-        kneaddata_output_files=args.kneaddata_output_files,
-        kneaddata_output_pattern=args.kneaddata_output_pattern,
-        kneaddata_output_dir=args.kneaddata_output_dir
-    )
+    if (args.max_parallel is not None or args.resume or args.adaptive_threads
+            or args.stage_limit or not args.pipelined):
+        results = run_scheduled_pipeline(args, kneaddata_options, humann3_options)
+        if results is None:
+            log_print("ERROR: Preprocessing pipeline failed", level="error")
+            return 1
+    else:
+        results = run_preprocessing_pipeline(
+            input_files=args.input_fastq,
+            output_dir=args.output_dir,
+            threads=args.threads,
+            kneaddata_dbs=args.kneaddata_dbs,
+            nucleotide_db=args.humann3_nucleotide_db,
+            protein_db=args.humann3_protein_db,
+            paired=args.paired,
+            kneaddata_options=kneaddata_options,
+            humann3_options=humann3_options,
+            skip_kneaddata=args.skip_kneaddata,
+            kneaddata_output_files=args.kneaddata_output_files,
+            kneaddata_output_pattern=args.kneaddata_output_pattern,
+            kneaddata_output_dir=args.kneaddata_output_dir
+        )
     
     # Generate a summary of results
     log_print("\nPreprocessing Pipeline Summary:", level="info")
@@ -860,8 +893,14 @@ def main():
     
     return 0
 
-if __name__ == "__main__":
-    sys.exit(main())
+def parse_stage_limit(value):
+    """Parse a STAGE=N --stage-limit value into a (stage, limit) tuple."""
+    stage, _, limit = value.partition("=")
+    if stage not in PIPELINE_STAGES or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError(
+            f"expected STAGE=N with STAGE one of {', '.join(PIPELINE_STAGES)} and N >= 1, got '{value}'"
+        )
+    return stage, int(limit)
 
 def parse_args():
     """Parse command line arguments."""
@@ -912,11 +951,31 @@ def parse_args():
     parser.add_argument("--paired", action="store_true",
                       help="Input files are paired-end reads")
     parser.add_argument("--threads", type=int, default=1,
-                      help="Number of threads to use")
+                      help="Number of threads to use (per sample)")
+    
+    # Scheduling options; any of them runs the checkpointed per-sample pipeline
+    scheduling_group = parser.add_argument_group("Scheduling Options")
+    scheduling_group.add_argument("--max-parallel", type=int,
+                                help="Maximum number of samples to process in parallel")
+    scheduling_group.add_argument("--no-pipelined", dest="pipelined", action="store_false",
+                                help="Run KneadData for every sample before starting HUMAnN3, "
+                                     "instead of starting each sample's HUMAnN3 run as soon as its KneadData run ends")
+    scheduling_group.add_argument("--stage-limit", nargs="+", type=parse_stage_limit, metavar="STAGE=N",
+                                help="Maximum concurrent samples per pipelined stage "
+                                     "(kneaddata, prepare, humann), e.g. --stage-limit humann=2")
+    scheduling_group.add_argument("--adaptive-threads", action="store_true",
+                                help="Give the last samples the threads left free once no samples are waiting "
+                                     "(with --no-pipelined)")
+    scheduling_group.add_argument("--resume", action="store_true",
+                                help="Skip samples/steps that completed in a previous run with the same "
+                                     "inputs and options (checkpoints in <output-dir>/checkpoints)")
     parser.add_argument("--log-file",
                       help="Path to log file")
     parser.add_argument("--log-level", default="INFO",
                       choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                       help="Logging level")
     
-    return parser.parse_args()
\ No newline at end of file
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    sys.exit(main())
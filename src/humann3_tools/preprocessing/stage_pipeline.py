@@ -0,0 +1,222 @@
+# humann3_tools/preprocessing/stage_pipeline.py
+"""
+Per-sample stage pipelining for the preprocessing workflow.
+
+Instead of running one step for every sample and waiting for the slowest sample
+before the next step starts, each sample moves through an ordered list of stages
+(kneaddata -> prepare -> humann) as soon as its own previous stage finishes. All
+stages share one process pool; each stage can additionally be capped so that, for
+example, memory-hungry HUMAnN3 runs do not take every slot.
+"""
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+from src.humann3_tools.utils.checkpoint import read_stage_manifest, write_stage_manifest, result_paths
+from src.humann3_tools.utils.resource_utils import (
+    ProcessTreeMonitor, RESOURCE_SAMPLE_INTERVAL, resource_record, write_resource_record
+)
+from src.humann3_tools.utils.run_history import record_runs
+
+class Stage:
+    """
+    One step of the per-sample pipeline.
+    
+    Attributes:
+        name: Stage name used in progress reports and stage_limits
+        function: Module-level function called as function(sample_id, upstream, **kwargs);
+                  upstream is the sample input for the first stage and the previous
+                  stage's result otherwise. Returning None marks the sample as failed.
+        kwargs: Additional keyword arguments for the function
+        max_concurrent: Maximum number of samples in this stage at once (None = pool size)
+    """
+    
+    def __init__(self, name, function, kwargs=None, max_concurrent=None):
+        self.name = name
+        self.function = function
+        self.kwargs = kwargs or {}
+        self.max_concurrent = max_concurrent
+
+def _run_stage(function, sample_id, upstream, kwargs, checkpoint=None, monitor_interval=None):
+    """Run one stage for one sample in a worker process; returns (result, seconds, usage)."""
+    start_time = time.time()
+    monitor = ProcessTreeMonitor(os.getpid(), interval=monitor_interval).start() if monitor_interval else None
+    try:
+        result = function(sample_id, upstream, **kwargs)
+    finally:
+        usage = monitor.stop() if monitor else None
+    if checkpoint is not None and result is not None:
+        checkpoint_dir, stage_name = checkpoint
+        write_stage_manifest(checkpoint_dir, stage_name, sample_id, result_paths(upstream), kwargs, result,
+                             logger=kwargs.get('logger'))
+    return result, time.time() - start_time, usage
+
+def _progress_postfix(stages, running, queued):
+    """Short 'stage: running+queued' summary for the progress bar."""
+    parts = []
+    for index, stage in enumerate(stages):
+        if running[index] or queued[index]:
+            parts.append(f"{stage.name}: {running[index]}+{len(queued[index])}")
+    return ", ".join(parts) or "idle"
+
+def run_stage_pipeline(samples, stages, max_workers=None, checkpoint_dir=None, resume=False,
+                       runtime_per_sample=None, metrics_file=None, history_db=None,
+                       monitor_interval=RESOURCE_SAMPLE_INTERVAL, logger=None):
+    """
+    Stream samples through an ordered list of stages on one shared worker pool.
+    
+    A sample is submitted to its next stage the moment its previous stage finishes.
+    When several samples are ready, later stages are started first so samples run
+    to completion instead of piling up between stages. With runtime_per_sample,
+    samples enter the first stage longest projected runtime first.
+    
+    Args:
+        samples: Dict mapping sample IDs to the input of the first stage
+        stages: List of Stage objects in execution order
+        max_workers: Size of the shared process pool (None = CPU count)
+        checkpoint_dir: Write a completion manifest for every finished stage here
+        resume: Skip stages whose manifest is still valid, reusing their stored results
+        runtime_per_sample: Function of a sample's first-stage input returning its
+                            projected wall time over all stages in seconds (or None)
+        metrics_file: Append a resource record per sample and stage (the stage
+                      name as tool) to this file
+        history_db: Run history database the resource records are also stored in
+                    (None = run_history.run_db_path())
+        monitor_interval: Seconds between resource samples for metrics_file
+        logger: Logger instance
+    
+    Returns:
+        Tuple of (results, status) where results maps sample IDs that completed
+        every stage to the last stage's result, and status maps every sample ID to
+        a dict with the last stage reached, its state, per-stage timings and
+        per-stage results
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    limits = [min(stage.max_concurrent or max_workers, max_workers) for stage in stages]
+    
+    logger.info(f"Starting pipelined processing of {len(samples)} samples through "
+                f"{' -> '.join(stage.name for stage in stages)} with {max_workers} workers")
+    for stage, limit in zip(stages, limits):
+        logger.info(f"  {stage.name}: up to {limit} concurrent samples")
+    
+    status = {
+        sample_id: {'stage': None, 'state': 'queued', 'timings': {}, 'results': {}}
+        for sample_id in samples
+    }
+    results = {}
+    queued = [deque() for _ in stages]
+    running = [0] * len(stages)
+    order = list(samples)
+    if runtime_per_sample is not None:
+        order.sort(key=lambda sample_id: runtime_per_sample(samples[sample_id]) or 0, reverse=True)
+    if stages:
+        for sample_id in order:
+            queued[0].append((sample_id, samples[sample_id]))
+    records = []
+    
+    start_time = time.time()
+    future_to_task = {}
+    progress = tqdm(total=len(samples) * len(stages), desc="Pipeline", unit="step")
+    
+    def finish(sample_id, index, result, elapsed, resumed=False):
+        """Record a finished stage and queue the sample for the next one."""
+        stage = stages[index]
+        if elapsed is not None:
+            status[sample_id]['timings'][stage.name] = elapsed
+        
+        if result is None:
+            status[sample_id]['state'] = 'failed'
+            logger.error(f"Sample {sample_id}: {stage.name} failed, skipping remaining stages")
+            # Count the skipped stages so the bar still reaches its total
+            progress.update(len(stages) - index)
+            return
+        
+        progress.update(1)
+        status[sample_id]['results'][stage.name] = result
+        if resumed:
+            logger.info(f"Sample {sample_id}: {stage.name} already completed, reusing checkpoint "
+                        f"(stage {index + 1}/{len(stages)})")
+        else:
+            logger.info(f"Sample {sample_id}: {stage.name} finished in {elapsed:.2f} seconds "
+                        f"(stage {index + 1}/{len(stages)})")
+        
+        if index + 1 < len(stages):
+            status[sample_id]['state'] = 'queued'
+            queued[index + 1].append((sample_id, result))
+        else:
+            status[sample_id]['state'] = 'completed'
+            results[sample_id] = result
+            total = sum(status[sample_id]['timings'].values())
+            logger.info(f"Sample {sample_id}: all stages completed ({total:.2f} seconds of processing)")
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while future_to_task or any(queued):
+            # Fill free slots, most downstream stage first
+            for index in reversed(range(len(stages))):
+                stage = stages[index]
+                while (queued[index] and len(future_to_task) < max_workers
+                       and running[index] < limits[index]):
+                    sample_id, upstream = queued[index].popleft()
+                    status[sample_id]['stage'] = stage.name
+                    
+                    if resume and checkpoint_dir is not None:
+                        manifest = read_stage_manifest(checkpoint_dir, stage.name, sample_id,
+                                                       result_paths(upstream), stage.kwargs, logger=logger)
+                        if manifest is not None:
+                            finish(sample_id, index, manifest["result"], None, resumed=True)
+                            continue
+                    
+                    checkpoint = (checkpoint_dir, stage.name) if checkpoint_dir is not None else None
+                    future = executor.submit(_run_stage, stage.function, sample_id, upstream,
+                                             stage.kwargs, checkpoint,
+                                             monitor_interval if metrics_file else None)
+                    future_to_task[future] = (sample_id, index, upstream)
+                    running[index] += 1
+                    status[sample_id]['state'] = 'running'
+                    logger.debug(f"Sample {sample_id}: started {stage.name}")
+            progress.set_postfix_str(_progress_postfix(stages, running, queued))
+            
+            if not future_to_task:
+                # Resumed stages may have queued samples for stages already visited
+                continue
+            
+            done, _ = wait(future_to_task, return_when=FIRST_COMPLETED)
+            for future in done:
+                sample_id, index, upstream = future_to_task.pop(future)
+                running[index] -= 1
+                
+                usage = None
+                try:
+                    result, elapsed, usage = future.result()
+                except Exception as e:
+                    logger.error(f"Sample {sample_id}: {stages[index].name} raised an error: {str(e)}")
+                    logger.debug("Error details:", exc_info=True)
+                    result, elapsed = None, None
+                
+                if usage is not None:
+                    record = resource_record((sample_id, *result_paths(upstream)), stages[index].name, usage,
+                                             "completed" if result is not None else "failed",
+                                             threads=stages[index].kwargs.get('threads'))
+                    write_resource_record(metrics_file, record, logger=logger)
+                    records.append(record)
+                
+                finish(sample_id, index, result, elapsed)
+    
+    progress.close()
+    if records:
+        record_runs(records, path=history_db, logger=logger)
+    
+    elapsed = time.time() - start_time
+    failed = [sample_id for sample_id, info in status.items() if info['state'] == 'failed']
+    logger.info(f"Completed pipelined processing in {elapsed:.2f} seconds. "
+                f"Successfully processed {len(results)} of {len(samples)} samples")
+    for sample_id in failed:
+        logger.warning(f"Sample {sample_id} failed at stage {status[sample_id]['stage']}")
+    
+    return results, status
@@ -0,0 +1,222 @@
+# humann3_tools/utils/checkpoint.py
+"""
+Per-sample stage completion manifests for resumable runs.
+
+After a sample finishes a stage (kneaddata, prepare, humann), a JSON manifest is
+written atomically to <checkpoint_dir>/<stage>/<sample_id>.json with:
+- the fingerprint of every input file (size and a hash of its first and last
+  megabyte, as for the table caches)
+- a digest of the stage parameters (threads and loggers excluded)
+- the stage result and the size of every output file it names
+
+A resumed run reuses a stage's stored result only while the inputs and
+parameters still match and every output file is still there at the recorded
+size; anything else is recomputed.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+from src.humann3_tools.utils.table_cache import table_fingerprint
+
+CHECKPOINT_DIRNAME = "checkpoints"
+MANIFEST_VERSION = 1
+
+# Parameters that change how fast a stage runs but not what it produces
+IGNORED_PARAMS = ("logger", "threads")
+
+def default_checkpoint_dir(output_dir):
+    """Checkpoint directory used by the pipelines for an output directory."""
+    return os.path.join(output_dir, CHECKPOINT_DIRNAME)
+
+def manifest_path(checkpoint_dir, stage, sample_id):
+    """Path of the completion manifest for one sample and stage."""
+    return os.path.join(checkpoint_dir, stage, f"{sample_id}.json")
+
+def params_digest(params):
+    """Stable digest of stage parameters."""
+    params = {key: value for key, value in (params or {}).items() if key not in IGNORED_PARAMS}
+    encoded = json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+def result_paths(result):
+    """Existing file paths named anywhere in a stage result (str, list, tuple or dict)."""
+    if isinstance(result, str):
+        return [result] if os.path.isfile(result) else []
+    if isinstance(result, dict):
+        result = list(result.values())
+    paths = []
+    if isinstance(result, (list, tuple)):
+        for item in result:
+            paths.extend(result_paths(item))
+    return paths
+
+def _describe_inputs(input_files):
+    inputs = []
+    for path in input_files:
+        fingerprint = table_fingerprint(path)
+        inputs.append({"path": os.path.abspath(path), "size": fingerprint["size"],
+                       "hash": fingerprint["hash"]})
+    return inputs
+
+def write_stage_manifest(checkpoint_dir, stage, sample_id, input_files, params, result, logger=None):
+    """
+    Record that a sample completed a stage.
+    
+    Args:
+        checkpoint_dir: Directory holding the manifests
+        stage: Stage name
+        sample_id: Sample identifier
+        input_files: Files the stage read
+        params: Dict of stage parameters
+        result: JSON-serializable stage result
+        logger: Logger instance
+    
+    Returns:
+        Path to the manifest, or None if it could not be written
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    target = manifest_path(checkpoint_dir, stage, sample_id)
+    try:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "stage": stage,
+            "sample_id": sample_id,
+            "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "inputs": _describe_inputs(input_files),
+            "params": params_digest(params),
+            "outputs": [{"path": os.path.abspath(path), "size": os.path.getsize(path)}
+                        for path in result_paths(result)],
+            "result": result,
+        }
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_file = f"{target}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as fh:
+            json.dump(manifest, fh, indent=1)
+            fh.flush()
+            os.fsync(fh.fileno())
+        # Rename last so a crash never leaves a partial manifest behind
+        os.replace(tmp_file, target)
+        return target
+    except Exception as e:
+        logger.warning(f"Could not write {stage} checkpoint for sample {sample_id}: {str(e)}")
+        return None
+
+def read_stage_manifest(checkpoint_dir, stage, sample_id, input_files, params, logger=None):
+    """
+    Load the manifest of a completed stage if it is still valid.
+    
+    Args:
+        checkpoint_dir: Directory holding the manifests
+        stage: Stage name
+        sample_id: Sample identifier
+        input_files: Files the stage would read now
+        params: Dict of stage parameters for this run
+        logger: Logger instance
+    
+    Returns:
+        The manifest dict (its "result" is the stored stage result), or None if the
+        stage has to run again
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    target = manifest_path(checkpoint_dir, stage, sample_id)
+    if not os.path.isfile(target):
+        return None
+    try:
+        with open(target) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        logger.warning(f"Ignoring unreadable {stage} checkpoint for sample {sample_id}")
+        return None
+    
+    def invalid(reason):
+        logger.info(f"Rerunning {stage} for sample {sample_id}: {reason}")
+        return None
+    
+    if manifest.get("version") != MANIFEST_VERSION:
+        return invalid("checkpoint was written by another version")
+    if manifest.get("params") != params_digest(params):
+        return invalid("parameters changed")
+    
+    recorded = {item["path"]: item for item in manifest.get("inputs", [])}
+    current = [os.path.abspath(path) for path in input_files]
+    if sorted(recorded) != sorted(current):
+        return invalid("input files changed")
+    for path in current:
+        if not os.path.isfile(path):
+            return invalid(f"input {os.path.basename(path)} is missing")
+        fingerprint = table_fingerprint(path)
+        if (fingerprint["size"], fingerprint["hash"]) != (recorded[path]["size"], recorded[path]["hash"]):
+            return invalid(f"input {os.path.basename(path)} changed")
+    
+    for output in manifest.get("outputs", []):
+        if not os.path.isfile(output["path"]):
+            return invalid(f"output {os.path.basename(output['path'])} is missing")
+        if os.path.getsize(output["path"]) != output["size"]:
+            return invalid(f"output {os.path.basename(output['path'])} changed size")
+    
+    return manifest
+
+def run_checkpointed(checkpoint_dir, stage, sample_id, input_files, params, function,
+                     resume=False, logger=None):
+    """
+    Run one sample's stage unless a valid manifest says it already completed.
+    
+    Args:
+        checkpoint_dir: Directory holding the manifests
+        stage: Stage name
+        sample_id: Sample identifier
+        input_files: Files the stage reads
+        params: Dict of stage parameters
+        function: Callable without arguments that runs the stage and returns its result
+        resume: Reuse the stored result of a valid manifest
+        logger: Logger instance
+    
+    Returns:
+        The stage result (stored or freshly computed)
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    if resume:
+        manifest = read_stage_manifest(checkpoint_dir, stage, sample_id, input_files, params, logger=logger)
+        if manifest is not None:
+            logger.info(f"Skipping {stage} for sample {sample_id}: completed {manifest['completed']}")
+            return manifest["result"]
+    
+    result = function()
+    if result:
+        write_stage_manifest(checkpoint_dir, stage, sample_id, input_files, params, result, logger=logger)
+    return result
+
+class CheckpointedStep:
+    """
+    Wrap a per-sample function so that successful runs write a stage manifest.
+    
+    The wrapper keeps the process_sample_parallel calling convention
+    (input_file, sample_id=..., paired_file=..., **kwargs) and is picklable as
+    long as the wrapped function is defined at module level.
+    """
+    
+    def __init__(self, function, checkpoint_dir, stage):
+        self.function = function
+        self.checkpoint_dir = checkpoint_dir
+        self.stage = stage
+    
+    def __call__(self, input_file, sample_id=None, paired_file=None, **kwargs):
+        input_files = [input_file]
+        if paired_file is not None:
+            input_files.append(paired_file)
+            result = self.function(input_file, sample_id=sample_id, paired_file=paired_file, **kwargs)
+        else:
+            result = self.function(input_file, sample_id=sample_id, **kwargs)
+        if result is not None:
+            write_stage_manifest(self.checkpoint_dir, self.stage, sample_id, input_files, kwargs, result,
+                                 logger=kwargs.get('logger'))
+        return result
@@ -1,26 +1,165 @@
 
 import os
 import sys
-import subprocess
+import signal
+import asyncio
 import logging
+from collections import deque
 
-def run_cmd(cmd, exit_on_error=True, verbose=True):
+# Commands in this process that were killed with SIGKILL, which for our tools
+# almost always means the kernel's out-of-memory killer
+_sigkilled_commands = 0
+
+# Seconds a stopped command gets to exit after SIGTERM before its process group is killed
+KILL_GRACE_SECONDS = 10
+# Lines of stderr repeated in the log when a command fails
+STDERR_TAIL_LINES = 20
+# Longest output line read in one piece (bowtie2/diamond can print long lines)
+STREAM_LINE_LIMIT = 1 << 20
+
+def sigkilled_command_count():
+    """Number of commands run by this process that were killed with SIGKILL."""
+    return _sigkilled_commands
+
+def is_sigkill(returncode):
+    """Whether a command's return code means it was killed with SIGKILL."""
+    return returncode in (-signal.SIGKILL, 128 + signal.SIGKILL)
+
+def _signal_process_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def _stop_process_group(process):
+    """Stop a command and every process it started (it leads its own process group)."""
+    _signal_process_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        _signal_process_group(process, signal.SIGKILL)
+        await process.wait()
+    # Children that ignored SIGTERM may outlive the group leader
+    _signal_process_group(process, signal.SIGKILL)
+
+async def _stream_lines(stream, name, label, logger, log_fh, tail=None):
+    """Forward a command's output to the logger and log file as it arrives."""
+    while True:
+        try:
+            raw = await stream.readline()
+        except ValueError:
+            # Line longer than the stream limit; take what is buffered
+            raw = await stream.read(STREAM_LINE_LIMIT)
+        if not raw:
+            break
+        line = raw.decode('utf-8', errors='replace').rstrip('\n')
+        logger.debug(f"[{label} {name}] {line}")
+        if log_fh is not None:
+            log_fh.write(f"[{name}] {line}\n")
+        if tail is not None:
+            tail.append(line)
+
+async def run_cmd_async(cmd, timeout=None, log_file=None, verbose=True, logger=None, on_start=None):
+    """
+    Run a command without blocking the event loop.
+    
+    stdout and stderr are streamed line by line to the logger (debug level) and,
+    if given, appended to log_file, instead of being held in memory until the
+    command exits. The command runs in its own process group; on timeout or
+    cancellation the whole group (e.g. humann and its bowtie2/diamond children)
+    is terminated, then killed after KILL_GRACE_SECONDS.
+    
+    Args:
+        cmd: Command to run as a list of strings
+        timeout: Wall-clock limit in seconds (None = no limit)
+        log_file: File the command's output is appended to
+        verbose: Log the command being run
+        logger: Logger instance
+        on_start: Function called with the process once it has started
+    
+    Returns:
+        The command's return code, or None if it timed out
+    """
+    global _sigkilled_commands
+    
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    cmd = [str(item) for item in cmd]
+    label = os.path.basename(cmd[0])
+    if verbose:
+        logger.info(f"Running: {' '.join(cmd)}")
+    
+    log_fh = None
+    if log_file:
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        log_fh = open(log_file, 'a', buffering=1)
+        log_fh.write(f"$ {' '.join(cmd)}\n")
+    
+    try:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True, limit=STREAM_LINE_LIMIT
+            )
+        except OSError as e:
+            logger.error(f"ERROR: Could not start {label}: {str(e)}")
+            return 127
+        if on_start is not None:
+            on_start(process)
+        
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        readers = asyncio.gather(
+            _stream_lines(process.stdout, "stdout", label, logger, log_fh),
+            _stream_lines(process.stderr, "stderr", label, logger, log_fh, stderr_tail)
+        )
+        try:
+            await asyncio.wait_for(asyncio.shield(readers), timeout)
+            returncode = await process.wait()
+        except asyncio.TimeoutError:
+            logger.error(f"ERROR: {label} exceeded its {timeout} second time limit; stopping it")
+            await _stop_process_group(process)
+            await readers
+            return None
+        except asyncio.CancelledError:
+            logger.warning(f"Cancelled {label}; stopping its process group")
+            await asyncio.shield(_stop_process_group(process))
+            readers.cancel()
+            raise
+        
+        if returncode != 0:
+            logger.error(f"ERROR: Command failed with exit code {returncode}")
+            if is_sigkill(returncode):
+                _sigkilled_commands += 1
+                logger.error("Command was killed with SIGKILL, most likely by the out-of-memory killer")
+            if stderr_tail:
+                logger.error("Error message: " + "\n".join(stderr_tail))
+            logger.error(f"Failed command: {' '.join(cmd)}")
+        return returncode
+    finally:
+        if log_fh is not None:
+            log_fh.close()
+
+
+def run_cmd(cmd, exit_on_error=True, verbose=True, timeout=None, log_file=None):
     """
     Utility function to run a shell command with subprocess.
     
+    The command's output is streamed to the logger as it runs (see run_cmd_async).
+    
     Args:
         cmd (list): Command to run as a list of strings
         exit_on_error (bool): Whether to exit the program if the command fails
         verbose (bool): Whether to print/log the command being run
+        timeout (float): Wall-clock limit in seconds after which the command's
+            process group is stopped (None = no limit)
+        log_file (str): File the command's output is appended to
         
     Returns:
         bool: True if command executed successfully, False otherwise
     """
     logger = logging.getLogger('humann3_analysis')
     
-    if verbose:
-        logger.info(f"Running: {' '.join(cmd)}")
-    
     # Additional check for 'cp' commands
     if cmd[0] == "cp" and len(cmd) >= 3:
         src = cmd[1]
@@ -35,20 +174,10 @@ def run_cmd(cmd, exit_on_error=True, verbose=True):
             logger.info(f"Creating directory: {dst_dir}")
             os.makedirs(dst_dir, exist_ok=True)
     
-    try:
-        process = subprocess.run(cmd, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout = process.stdout.decode('utf-8', errors='replace')
-        stderr = process.stderr.decode('utf-8', errors='replace')
-        if stdout.strip():
-            logger.debug(f"Command stdout: {stdout}")
-        if stderr.strip():
-            logger.debug(f"Command stderr: {stderr}")
+    returncode = asyncio.run(run_cmd_async(cmd, timeout=timeout, log_file=log_file,
+                                           verbose=verbose, logger=logger))
+    if returncode == 0:
         return True
-    except subprocess.CalledProcessError as e:
-        error_msg = e.stderr.decode('utf-8', errors='replace')
-        logger.error(f"ERROR: Command failed with exit code {e.returncode}")
-        logger.error(f"Error message: {error_msg}")
-        logger.error(f"Failed command: {' '.join(cmd)}")
-        if exit_on_error:
-            sys.exit(1)
-        return False
\ No newline at end of file
+    if exit_on_error:
+        sys.exit(1)
+    return False
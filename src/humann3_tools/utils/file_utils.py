@@ -72,6 +72,67 @@ def strip_suffix(col):
     # No match found
     return col
 
+def strip_suffixes_from_columns(cols, logger=None, source="header"):
+    """
+    Remove HUMAnN3 abundance suffixes from a list of table columns.
+    Applies the same safety checks as strip_suffixes_from_file_headers.
+    
+    Args:
+        cols: Header columns; the first (feature ID) column is left unchanged
+        logger: Optional logger for messages
+        source: Name used in log messages (e.g. the file path)
+        
+    Returns:
+        Tuple of (new_cols, change_count); new_cols is cols unchanged when the
+        columns are not suitable for suffix stripping
+    """
+    if logger is None:
+        import logging
+        logger = logging.getLogger('humann3_analysis')
+    
+    # Check if this is a typical HUMAnN3 output file with named sample columns
+    # First check if we have at least a feature column and one sample column
+    if len(cols) < 2:
+        logger.warning(f"File has fewer than 2 columns, cannot process: {source}")
+        return cols, 0
+    
+    # Check if columns appear to be numeric IDs rather than sample names with suffixes
+    numeric_cols = sum(1 for col in cols[1:] if col.isdigit())
+    if numeric_cols > 0 and numeric_cols / (len(cols) - 1) > 0.5:  # If >50% are numeric
+        logger.info(f"File appears to have numeric column headers, skipping suffix stripping: {source}")
+        return cols, 0
+    
+    # Check if any of the columns have a recognizable suffix pattern
+    has_suffix_pattern = False
+    for col in cols[1:]:  # Skip first column (feature ID)
+        # Check for common patterns we expect in HUMAnN3 output
+        if any(suffix in col.lower() for suffix in ['abundance', 'cpm', 'relab']):
+            has_suffix_pattern = True
+            break
+        
+        # Check for patterns with separators
+        for sep in ['.', '_', '-']:
+            if sep in col and any(unit in col.lower().split(sep)[-1] for unit in ['cpm', 'relab']):
+                has_suffix_pattern = True
+                break
+    
+    if not has_suffix_pattern:
+        logger.info(f"No recognizable suffix patterns found in column headers: {source}")
+        return cols, 0
+    
+    # Apply strip_suffix to each column except the first one (which is usually the feature ID)
+    new_cols = [cols[0]]
+    change_count = 0
+    
+    for col in cols[1:]:
+        new_col = strip_suffix(col)
+        new_cols.append(new_col)
+        if new_col != col:
+            change_count += 1
+            logger.debug(f"Stripped suffix: '{col}' -> '{new_col}'")
+    
+    return new_cols, change_count
+
 def strip_suffixes_from_file_headers(file_path, logger=None):
     """
     Remove HUMAnN3 abundance suffixes from column headers in a file.
@@ -97,62 +158,28 @@ def strip_suffixes_from_file_headers(file_path, logger=None):
             logger.warning(f"Empty file: {file_path}")
             return False
         
-        # Find the first non-comment line (header line)
+        # The header is the last leading comment line (HUMAnN tables start with
+        # "# Pathway" or "# Gene Family"), or the first line if there are none
         header_index = 0
         for i, line in enumerate(lines):
             if not line.startswith('#'):
-                header_index = i
                 break
+            header_index = i
         
         # Get the header line and split it
         header = lines[header_index].strip()
         cols = header.split('\t')
         
-        # Check if this is a typical HUMAnN3 output file with named sample columns
-        # First check if we have at least a feature column and one sample column
         if len(cols) < 2:
             logger.warning(f"File has fewer than 2 columns, cannot process: {file_path}")
             return False
         
-        # Check if columns appear to be numeric IDs rather than sample names with suffixes
-        numeric_cols = sum(1 for col in cols[1:] if col.isdigit())
-        if numeric_cols > 0 and numeric_cols / (len(cols) - 1) > 0.5:  # If >50% are numeric
-            logger.info(f"File appears to have numeric column headers, skipping suffix stripping: {file_path}")
-            return True
-        
-        # Check if any of the columns have a recognizable suffix pattern
-        has_suffix_pattern = False
-        for col in cols[1:]:  # Skip first column (feature ID)
-            # Check for common patterns we expect in HUMAnN3 output
-            if any(suffix in col.lower() for suffix in ['abundance', 'cpm', 'relab']):
-                has_suffix_pattern = True
-                break
-            
-            # Check for patterns with separators
-            for sep in ['.', '_', '-']:
-                if sep in col and any(unit in col.lower().split(sep)[-1] for unit in ['cpm', 'relab']):
-                    has_suffix_pattern = True
-                    break
-        
-        if not has_suffix_pattern:
-            logger.info(f"No recognizable suffix patterns found in column headers: {file_path}")
-            return True
-        
-        # Now we've confirmed this is a suitable file for suffix stripping
-        # Apply strip_suffix to each column except the first one (which is usually the feature ID)
-        new_cols = [cols[0]]
-        change_count = 0
-        
-        for col in cols[1:]:
-            new_col = strip_suffix(col)
-            new_cols.append(new_col)
-            if new_col != col:
-                change_count += 1
-                logger.debug(f"Stripped suffix: '{col}' -> '{new_col}'")
+        new_cols, change_count = strip_suffixes_from_columns(cols, logger, source=file_path)
         
         # Only update the file if we actually made changes
         if change_count == 0:
-            logger.info(f"No columns were modified in: {file_path}")
+            if new_cols is not cols:
+                logger.info(f"No columns were modified in: {file_path}")
             return True
         
         # Update the header line
@@ -168,3 +195,216 @@ def strip_suffixes_from_file_headers(file_path, logger=None):
         if logger:
             logger.error(f"Error stripping suffixes from headers in {file_path}: {str(e)}")
         return False
+
+GZIP_MAGIC = b"\x1f\x8b"
+COPY_CHUNK_BYTES = 1 << 24
+
+def is_gzip_file(file_path):
+    """Check the gzip magic bytes rather than trusting the extension."""
+    with open(file_path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+def _kernel_copy(src, dst):
+    """
+    Append the whole of src to dst (both open binary files) inside the kernel.
+    
+    Tries copy_file_range (which can share extents on copy-on-write filesystems),
+    then sendfile. Returns False if neither is usable for this pair of files, in
+    which case nothing has been written.
+    """
+    size = os.fstat(src.fileno()).st_size
+    for name in ("copy_file_range", "sendfile"):
+        copy = getattr(os, name, None)
+        if copy is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if name == "copy_file_range":
+                    copied = copy(src.fileno(), dst.fileno(), min(COPY_CHUNK_BYTES, size - offset), offset)
+                else:
+                    copied = copy(dst.fileno(), src.fileno(), offset, min(COPY_CHUNK_BYTES, size - offset))
+                if copied == 0:
+                    break
+                offset += copied
+            return True
+        except OSError:
+            # Unsupported for these files (e.g. across filesystems on older kernels);
+            # only fall through if nothing was copied yet
+            if offset:
+                raise
+    return False
+
+def concatenate_files(input_files, output_file, logger=None):
+    """
+    Concatenate files without loading them into memory.
+    
+    Plain inputs are copied by the kernel where possible, with a buffered copy
+    as fallback. Gzip inputs are handled by content:
+    - output ending in .gz: gzip inputs are appended as-is (concatenated gzip
+      members are a valid gzip file) and plain inputs are compressed
+    - plain output: gzip inputs are decompressed while streaming
+    
+    Args:
+        input_files: Files to concatenate, in order
+        output_file: Path of the concatenated file
+        logger: Logger instance
+    
+    Returns:
+        Number of bytes in the output file
+    """
+    import gzip
+    import shutil
+    
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    compress_output = output_file.endswith(".gz")
+    with open(output_file, 'wb') as outfile:
+        for input_file in input_files:
+            gzipped = is_gzip_file(input_file)
+            logger.debug(f"  Adding file: {os.path.basename(input_file)} "
+                         f"(Size: {os.path.getsize(input_file)} bytes{', gzip' if gzipped else ''})")
+            
+            if gzipped == compress_output:
+                with open(input_file, 'rb') as infile:
+                    outfile.flush()
+                    if _kernel_copy(infile, outfile):
+                        # The kernel moved the file offset; resync the buffered writer
+                        outfile.seek(0, os.SEEK_END)
+                    else:
+                        shutil.copyfileobj(infile, outfile, COPY_CHUNK_BYTES)
+            elif gzipped:
+                with gzip.open(input_file, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, COPY_CHUNK_BYTES)
+            else:
+                with open(input_file, 'rb') as infile, \
+                        gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=6) as gz_out:
+                    shutil.copyfileobj(infile, gz_out, COPY_CHUNK_BYTES)
+    
+    return os.path.getsize(output_file)
+
+def paired_concat_path(directory, sample_id, input_files):
+    """
+    Path for a sample's concatenated reads.
+    
+    The file stays gzip-compressed (.fastq.gz) when every input is, so the reads
+    are copied without decompressing them; HUMAnN3 accepts gzipped FASTQ.
+    """
+    if input_files and all(is_gzip_file(f) for f in input_files):
+        return os.path.join(directory, f"{sample_id}_paired_concat.fastq.gz")
+    return os.path.join(directory, f"{sample_id}_paired_concat.fastq")
+
+# ioctl request that clones a whole file's extents (Linux FICLONE)
+FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    """Create dst as a copy-on-write clone of src; False if the filesystem can't."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+def stage_file(src, dst, mode="link"):
+    """
+    Place src at dst as cheaply as the filesystem allows.
+    
+    Modes:
+    - "link": hardlink, else reflink, else copy. The destination shares its data
+      with the source, so staged files must be treated as read-only.
+    - "copy": reflink, else copy (the destination is independent of the source)
+    - "move": rename, else copy and remove the source
+    
+    An existing dst is replaced atomically.
+    
+    Returns:
+        How the file was placed: "linked", "reflinked", "copied", "moved" or
+        "existing" (dst already is src)
+    """
+    import shutil
+    
+    if mode not in ("link", "copy", "move"):
+        raise ValueError(f"Unknown staging mode: {mode}")
+    
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return "existing"
+    
+    if mode == "move":
+        try:
+            os.replace(src, dst)
+            return "moved"
+        except OSError:
+            # Different filesystem: copy, then drop the source
+            method = stage_file(src, dst, mode="copy")
+            os.remove(src)
+            return method
+    
+    # Build the new file next to dst and swap it in, so readers never see a partial file
+    tmp_dst = f"{dst}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_dst):
+        os.remove(tmp_dst)
+    try:
+        if mode == "link":
+            try:
+                os.link(src, tmp_dst)
+                method = "linked"
+            except OSError:
+                method = None
+        else:
+            method = None
+        if method is None:
+            method = "reflinked" if _reflink(src, tmp_dst) else None
+        if method is None:
+            shutil.copy2(src, tmp_dst)
+            method = "copied"
+        os.replace(tmp_dst, dst)
+    finally:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+    return method
+
+def stage_files(file_pairs, mode="link", logger=None):
+    """
+    Stage many files in one pass, without a subprocess per file.
+    
+    Args:
+        file_pairs: Iterable of (source, destination) paths
+        mode: "link", "copy" or "move" (see stage_file)
+        logger: Logger instance
+    
+    Returns:
+        Dict mapping each destination to how it was placed, or None if staging
+        that file failed
+    """
+    from collections import Counter
+    
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    file_pairs = list(file_pairs)
+    created_dirs = set()
+    results = {}
+    for src, dst in file_pairs:
+        target_dir = os.path.dirname(dst)
+        if target_dir and target_dir not in created_dirs:
+            os.makedirs(target_dir, exist_ok=True)
+            created_dirs.add(target_dir)
+        try:
+            results[dst] = stage_file(src, dst, mode=mode)
+        except OSError as e:
+            logger.warning(f"Could not stage {src} to {dst}: {str(e)}")
+            results[dst] = None
+    
+    if file_pairs:
+        counts = Counter(method or "failed" for method in results.values())
+        logger.info(f"Staged {len(file_pairs)} files: "
+                    f"{', '.join(f'{count} {method}' for method, count in sorted(counts.items()))}")
+    return results
@@ -0,0 +1,40 @@
+# humann3_tools/utils/lazy_imports.py
+"""
+Lazy package attributes, so that importing a package does not import its modules.
+
+Package __init__ files re-export functions from modules that pull in
+matplotlib, seaborn, sklearn, statsmodels and scikit-posthocs. Importing any
+submodule (e.g. a CLI) imports the package first, so eager re-exports made
+every command pay for those libraries at start-up. With lazy_attributes a
+package exposes the same names but imports the defining module on first access
+(PEP 562 module __getattr__).
+"""
+import importlib
+
+def lazy_attributes(package_name, attributes):
+    """
+    Module-level __getattr__ and __dir__ for lazily imported package attributes.
+    
+    Usage in a package __init__:
+        __getattr__, __dir__ = lazy_attributes(__name__, {"name": "package.module", ...})
+    
+    Args:
+        package_name: __name__ of the package
+        attributes: Dictionary of attribute name -> module defining it
+    
+    Returns:
+        (__getattr__, __dir__) functions for the package
+    """
+    def __getattr__(name):
+        module_name = attributes.get(name)
+        if module_name is None:
+            raise AttributeError(f"module {package_name!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module(module_name), name)
+        # Cache on the package so later lookups skip __getattr__
+        setattr(importlib.import_module(package_name), name, value)
+        return value
+    
+    def __dir__():
+        return sorted(set(vars(importlib.import_module(package_name))) | set(attributes))
+    
+    return __getattr__, __dir__
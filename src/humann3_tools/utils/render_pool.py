@@ -0,0 +1,221 @@
+# humann3_tools/utils/render_pool.py
+"""
+Process pool for rendering many matplotlib figures from one abundance table.
+
+The tables the figures are drawn from are copied once into shared memory
+(a single float block for a dense DataFrame; only the CSR arrays and offsets
+for a sparse AbundanceMatrix) and attached without copying by every worker.
+Workers are spawned rather than forked, so they start without the parent's
+pyplot state, and render with the Agg backend. Every task yields a record
+(plot type, label, output file, seconds, status) for the output index.
+"""
+import os
+import sys
+import csv
+import time
+import logging
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.humann3_tools.analysis.abundance_matrix import AbundanceMatrix
+
+INDEX_COLUMNS = ("Type", "Label", "File", "Seconds", "Status", "Error")
+
+# State of a worker process: render task, attached tables and context
+_WORKER = {}
+
+def _share_array(array, blocks):
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+    return {"name": block.name, "shape": array.shape, "dtype": array.dtype.str}
+
+def _attach_array(spec, blocks):
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(name=spec["name"], track=False)
+    else:
+        block = shared_memory.SharedMemory(name=spec["name"])
+    blocks.append(block)
+    return np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=block.buf)
+
+class SharedTables:
+    """
+    Features x samples tables published in shared memory for worker processes.
+    
+    Attributes:
+        specs: Picklable description of every table, for attach_tables()
+    """
+    
+    def __init__(self, tables):
+        """
+        Args:
+            tables: Dictionary of name -> DataFrame or AbundanceMatrix
+        """
+        self._blocks = []
+        self.specs = {}
+        try:
+            for name, table in tables.items():
+                self.specs[name] = self._share(table)
+        except Exception:
+            self.close()
+            raise
+    
+    def _share(self, table):
+        spec = {"index": list(table.index), "columns": list(table.columns)}
+        if isinstance(table, AbundanceMatrix):
+            matrix = table.matrix
+            spec.update({
+                "kind": "sparse",
+                "shape": matrix.shape,
+                "index_name": table.index_name,
+                "data": _share_array(matrix.data, self._blocks),
+                "indices": _share_array(matrix.indices, self._blocks),
+                "indptr": _share_array(matrix.indptr, self._blocks),
+                "offset": _share_array(table.offset, self._blocks),
+            })
+        else:
+            spec.update({
+                "kind": "dense",
+                "index_name": table.index.name,
+                "values": _share_array(table.to_numpy(dtype=float), self._blocks),
+            })
+        return spec
+    
+    def close(self):
+        """Release and remove the shared memory blocks."""
+        for block in self._blocks:
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        self._blocks = []
+
+def attach_tables(specs, blocks):
+    """
+    Tables from SharedTables.specs, as views on the shared memory.
+    
+    Args:
+        specs: SharedTables.specs
+        blocks: List that receives the attached blocks (keep it alive while the
+                tables are used)
+    
+    Returns:
+        Dictionary of name -> DataFrame or AbundanceMatrix
+    """
+    tables = {}
+    for name, spec in specs.items():
+        if spec["kind"] == "sparse":
+            matrix = sparse.csr_matrix(
+                (_attach_array(spec["data"], blocks), _attach_array(spec["indices"], blocks),
+                 _attach_array(spec["indptr"], blocks)),
+                shape=spec["shape"]
+            )
+            tables[name] = AbundanceMatrix(matrix, spec["index"], spec["columns"],
+                                           offset=_attach_array(spec["offset"], blocks),
+                                           index_name=spec["index_name"])
+        else:
+            tables[name] = pd.DataFrame(_attach_array(spec["values"], blocks),
+                                        index=pd.Index(spec["index"], name=spec["index_name"]),
+                                        columns=spec["columns"], copy=False)
+    return tables
+
+def _init_worker(render_task, specs, context, log_level):
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    # Workers only report problems; the parent logs the outcome of every figure
+    for name in (None, 'humann3_tools', 'humann3_analysis'):
+        logging.getLogger(name).setLevel(log_level)
+    blocks = []
+    _WORKER.update({"render_task": render_task, "tables": attach_tables(specs, blocks),
+                    "context": context, "blocks": blocks})
+
+def _run_task(render_task, tables, context, task):
+    """Render one (type, label, kwargs) task into an index record."""
+    plot_type, label, kwargs = task
+    start_time = time.time()
+    record = {"Type": plot_type, "Label": label, "File": "", "Status": "failed", "Error": ""}
+    try:
+        output_file = render_task(tables, context, plot_type, kwargs)
+        if output_file:
+            record.update({"File": output_file, "Status": "completed"})
+        else:
+            record["Error"] = "no output"
+    except Exception as e:
+        record["Error"] = f"{type(e).__name__}: {str(e)}"
+        logging.getLogger('humann3_tools').debug(traceback.format_exc())
+    record["Seconds"] = round(time.time() - start_time, 3)
+    return record
+
+def _run_worker_task(task):
+    return _run_task(_WORKER["render_task"], _WORKER["tables"], _WORKER["context"], task)
+
+def render_tasks(render_task, tasks, tables, context=None, max_workers=1, logger=None):
+    """
+    Render figures, in parallel worker processes when max_workers > 1.
+    
+    Args:
+        render_task: Module-level function (tables, context, plot_type, kwargs)
+                     returning the output file (falsy if nothing was written)
+        tasks: List of (plot_type, label, kwargs) tuples; larger figures first
+        tables: Dictionary of name -> DataFrame or AbundanceMatrix passed to
+                render_task (through shared memory in parallel mode)
+        context: Picklable dictionary passed to render_task (one copy per worker)
+        max_workers: Worker processes (1 = render in this process)
+        logger: Logger instance
+    
+    Returns:
+        List of index records, in task order
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_tools')
+    context = {} if context is None else context
+    
+    if max_workers <= 1 or len(tasks) <= 1:
+        return [_run_task(render_task, tables, context, task) for task in tasks]
+    
+    max_workers = min(max_workers, len(tasks))
+    logger.info(f"Rendering {len(tasks)} figures with {max_workers} worker processes")
+    shared = SharedTables(tables)
+    records = [None] * len(tasks)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(render_task, shared.specs, context, logging.WARNING)) as executor:
+            futures = {executor.submit(_run_worker_task, task): i for i, task in enumerate(tasks)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    records[i] = future.result()
+                except Exception as e:
+                    plot_type, label, _ = tasks[i]
+                    records[i] = {"Type": plot_type, "Label": label, "File": "", "Seconds": 0.0,
+                                  "Status": "failed", "Error": f"{type(e).__name__}: {str(e)}"}
+    finally:
+        shared.close()
+    return records
+
+def write_render_index(records, index_file):
+    """
+    Write the index of rendered figures as a TSV file.
+    
+    Args:
+        records: Records from render_tasks()
+        index_file: Output path
+    
+    Returns:
+        Path to the index file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    with open(index_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+    return index_file
@@ -1,5 +1,6 @@
 # humann3_tools/utils/resource_utils.py
 
+import json
 import logging
 import os
 import multiprocessing
@@ -8,14 +9,238 @@ import resource
 import threading
 import time
 from functools import wraps
+from src.humann3_tools.utils.run_history import sample_input_bytes, estimate_read_count
 
-def get_memory_usage():
+# Seconds between resource samples of a running job's process tree
+RESOURCE_SAMPLE_INTERVAL = 1.0
+# Per-sample resource records, one JSON object per line, next to a run's logs
+METRICS_FILENAME = "resource_metrics.jsonl"
+
+def get_memory_usage(include_children=False):
     """
     Get current memory usage in MB for the current process.
+    
+    Args:
+        include_children: Add the RSS of every descendant process (tool
+                          subprocesses, pool workers and their children)
     """
+    if include_children:
+        return ProcessTreeMonitor(os.getpid()).sample()
     process = psutil.Process(os.getpid())
     return process.memory_info().rss / (1024 * 1024)  # Convert bytes to MB
 
+class ProcessTreeMonitor:
+    """
+    Resource usage of a process and all of its descendants.
+    
+    Each sample() walks the process tree and adds up the RSS of every live
+    process; CPU time and I/O bytes are kept per process as last seen, so a child
+    that has exited still counts with its totals from the last sample before it
+    exited (processes shorter than the interval may be missed). Usage from before
+    the first sample is not counted. Sampling runs in a
+    background thread after start(), or can be driven by the caller.
+    
+    Attributes:
+        pid: Root process ID
+        interval: Seconds between samples in the background thread
+        peak_rss_mb: Highest combined RSS seen, in MB
+        peak_processes: Most processes seen in the tree at once
+        samples: Number of samples taken
+    """
+    
+    def __init__(self, pid=None, interval=RESOURCE_SAMPLE_INTERVAL):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.peak_processes = 0
+        self.samples = 0
+        self._totals = {}
+        self._baseline = None
+        self._start_time = None
+        self._end_time = None
+        self._thread = None
+        self._stop_event = None
+        try:
+            self._root = psutil.Process(self.pid)
+        except psutil.Error:
+            self._root = None
+    
+    def sample(self):
+        """Take one sample; returns the tree's combined RSS in MB."""
+        if self._start_time is None:
+            self._start_time = time.time()
+        if self._root is None:
+            return 0.0
+        try:
+            processes = [self._root] + self._root.children(recursive=True)
+        except psutil.Error:
+            return 0.0
+        
+        rss = 0
+        live = 0
+        for proc in processes:
+            try:
+                with proc.oneshot():
+                    memory = proc.memory_info().rss
+                    cpu = proc.cpu_times()
+                    try:
+                        io = proc.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError, NotImplementedError):
+                        read_bytes = write_bytes = 0
+                    key = (proc.pid, proc.create_time())
+            except psutil.Error:
+                # Exited between listing and reading
+                continue
+            rss += memory
+            live += 1
+            self._totals[key] = (cpu.user + cpu.system, read_bytes, write_bytes)
+        
+        rss_mb = rss / (1024 * 1024)
+        if self._baseline is None:
+            # What the tree had used before monitoring started is not this job's
+            self._baseline = dict(self._totals)
+        self.samples += 1
+        self.peak_rss_mb = max(self.peak_rss_mb, rss_mb)
+        self.peak_processes = max(self.peak_processes, live)
+        return rss_mb
+    
+    def usage(self):
+        """
+        Aggregated usage so far.
+        
+        Returns:
+            Dictionary with wall_seconds, peak_rss_mb, cpu_seconds, read_bytes,
+            write_bytes, peak_processes and samples
+        """
+        end_time = self._end_time or time.time()
+        baseline = self._baseline or {}
+        used = [tuple(value - start for value, start in zip(totals, baseline.get(key, (0, 0, 0))))
+                for key, totals in self._totals.items()]
+        return {
+            'wall_seconds': round(end_time - (self._start_time or end_time), 3),
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'cpu_seconds': round(sum(cpu for cpu, _, _ in used), 2),
+            'read_bytes': sum(read for _, read, _ in used),
+            'write_bytes': sum(write for _, _, write in used),
+            'peak_processes': self.peak_processes,
+            'samples': self.samples,
+        }
+    
+    def start(self):
+        """Sample in a background thread until stop()."""
+        self._stop_event = threading.Event()
+        self.sample()
+        
+        def sample_loop():
+            while not self._stop_event.wait(self.interval):
+                self.sample()
+        
+        self._thread = threading.Thread(target=sample_loop, daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        """Stop sampling (taking a last sample if the root still runs) and return usage()."""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join(timeout=max(1.0, self.interval))
+            self._thread = None
+        self.sample()
+        self._end_time = time.time()
+        return self.usage()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+def default_metrics_file(log_dir):
+    """Metrics file the parallel runners write per-sample resource records to."""
+    return os.path.join(log_dir, METRICS_FILENAME)
+
+def write_resource_record(metrics_file, record, logger=None):
+    """
+    Append one job's resource record to a metrics file (JSON lines).
+    
+    Args:
+        metrics_file: Path to the metrics file
+        record: Dictionary describing the job (sample_id, tool, ...) and its usage
+        logger: Logger instance
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(metrics_file)), exist_ok=True)
+        # One write per record in append mode, so concurrent writers don't interleave lines
+        with open(metrics_file, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + "\n")
+    except OSError as e:
+        logger.warning(f"Could not write resource record to {metrics_file}: {str(e)}")
+
+def resource_record(sample_tuple, tool, usage, status, threads=None, memory_estimate=None, attempt=0):
+    """
+    Per-sample resource record as written to the metrics file.
+    
+    Args:
+        sample_tuple: Sample tuple (sample_id, file, ...); the input size and
+                      estimated read count are totals over its files
+        tool: Tool or stage name
+        usage: ProcessTreeMonitor.usage() of the job
+        status: "completed", "failed", "timeout" or "out_of_memory"
+        threads: Threads the job was given
+        memory_estimate: Memory in MB the scheduler projected for the job
+        attempt: Retry number (0 for the first run)
+    
+    Returns:
+        Record dictionary
+    """
+    read_count = None
+    for path in sample_tuple[1:]:
+        if isinstance(path, str) and os.path.isfile(path):
+            reads = estimate_read_count(path)
+            if reads is not None:
+                read_count = (read_count or 0) + reads
+    record = {
+        'sample_id': sample_tuple[0],
+        'tool': tool,
+        'status': status,
+        'finished': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'threads': threads,
+        'input_bytes': sample_input_bytes(sample_tuple),
+        'read_count': read_count,
+        'memory_estimate_mb': memory_estimate,
+        'attempt': attempt,
+    }
+    record.update(usage)
+    return record
+
+def read_resource_records(metrics_file, tool=None):
+    """
+    Read the resource records of a metrics file.
+    
+    Args:
+        metrics_file: Path to the metrics file
+        tool: Only return records of this tool
+    
+    Returns:
+        List of record dictionaries (unreadable lines are skipped)
+    """
+    records = []
+    if not os.path.isfile(metrics_file):
+        return records
+    with open(metrics_file) as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if tool is None or record.get('tool') == tool:
+                records.append(record)
+    return records
+
 def monitor_memory_usage(logger, threshold_mb=1000, interval=60):
     """
     Start a background thread to monitor memory usage and log warnings 
@@ -33,7 +258,7 @@ def monitor_memory_usage(logger, threshold_mb=1000, interval=60):
 
     def monitoring_worker():
         while not stop_event.is_set():
-            mem_usage = get_memory_usage()
+            mem_usage = get_memory_usage(include_children=True)
             if mem_usage > threshold_mb:
                 logger.warning(
                     f"High memory usage detected: {mem_usage:.2f} MB "
@@ -58,15 +283,26 @@ def stop_memory_monitoring(thread_data):
         stop_event.set()
         thread.join(timeout=1)
 
-def track_peak_memory(func):
+def track_peak_memory(func=None, interval=RESOURCE_SAMPLE_INTERVAL):
     """
     Decorator to track peak memory usage during function execution.
     
+    Memory, CPU time and I/O are summed over the whole process tree, so the
+    tool subprocesses and worker processes started by the function are counted,
+    not just the Python process itself.
+    
     Usage:
         @track_peak_memory
         def my_function(logger, ...):
             # function code
+        
+        @track_peak_memory(interval=5)
+        def my_other_function(logger, ...):
+            # sampled every 5 seconds
     """
+    if func is None:
+        return lambda f: track_peak_memory(f, interval=interval)
+    
     @wraps(func)
     def wrapper(*args, **kwargs):
         # Find logger in args or kwargs
@@ -81,41 +317,24 @@ def track_peak_memory(func):
             logger = logging.getLogger('humann3_analysis')
 
         # Record starting memory
-        start_mem = get_memory_usage()
+        monitor = ProcessTreeMonitor(os.getpid(), interval=interval)
+        start_mem = monitor.sample()
         logger.info(f"Starting memory: {start_mem:.2f} MB")
-
-        # Track peak memory
-        peak_mem = start_mem
-        
-        def memory_checker():
-            nonlocal peak_mem
-            current = get_memory_usage()
-            if current > peak_mem:
-                peak_mem = current
-
-        stop_event = threading.Event()
-
-        def check_loop():
-            while not stop_event.is_set():
-                memory_checker()
-                time.sleep(1)
-
-        monitor_thread = threading.Thread(target=check_loop, daemon=True)
-        monitor_thread.start()
+        monitor.start()
 
         try:
             result = func(*args, **kwargs)  # Run the decorated function
             return result
         finally:
-            # Stop monitoring
-            stop_event.set()
-            monitor_thread.join(timeout=1)
-            
-            # Log results
-            end_mem = get_memory_usage()
+            usage = monitor.stop()
+            end_mem = get_memory_usage(include_children=True)
             logger.info(
                 f"Memory usage: start={start_mem:.2f} MB, "
-                f"peak={peak_mem:.2f} MB, end={end_mem:.2f} MB"
+                f"peak={usage['peak_rss_mb']:.2f} MB, end={end_mem:.2f} MB "
+                f"(process tree, up to {usage['peak_processes']} processes); "
+                f"CPU time {usage['cpu_seconds']:.1f} s, "
+                f"I/O read {usage['read_bytes'] / (1024 * 1024):.1f} MB, "
+                f"written {usage['write_bytes'] / (1024 * 1024):.1f} MB"
             )
     return wrapper
 
@@ -140,7 +359,8 @@ def limit_memory_usage(max_memory_mb=None):
     except (ImportError, ValueError, OSError, resource.error):
         return False
 
-def calculate_optimal_resources(available_threads, num_samples, min_threads_per_sample=1):
+def calculate_optimal_resources(available_threads, num_samples, min_threads_per_sample=1,
+                                memory_per_sample=None, available_memory=None):
     """
     Calculate optimal thread allocation between samples and processes.
     
@@ -148,6 +368,8 @@ def calculate_optimal_resources(available_threads, num_samples, min_threads_per_
         available_threads: Total available CPU threads.
         num_samples: Number of samples to process.
         min_threads_per_sample: Minimum threads to allocate per sample.
+        memory_per_sample: Projected peak memory of one sample in MB (None = ignore memory).
+        available_memory: Memory budget in MB (None = currently available system memory).
         
     Returns:
         A tuple (threads_per_sample, max_parallel_samples).
@@ -156,11 +378,18 @@ def calculate_optimal_resources(available_threads, num_samples, min_threads_per_
         available_threads = multiprocessing.cpu_count()
     
     # Start with maximum parallelism
-    max_parallel = min(num_samples, available_threads)
+    max_parallel = max(1, min(num_samples, available_threads))
+    
+    # Never plan more concurrent samples than fit in memory
+    if memory_per_sample:
+        if available_memory is None:
+            available_memory = psutil.virtual_memory().available / (1024 * 1024)
+        max_parallel = max(1, min(max_parallel, int(available_memory // memory_per_sample)))
+    
     threads_per_sample = max(min_threads_per_sample, available_threads // max_parallel)
     
     # Recalculate max_parallel based on threads_per_sample
-    max_parallel = min(max_parallel, available_threads // threads_per_sample)
+    max_parallel = max(1, min(max_parallel, available_threads // threads_per_sample))
     
     return threads_per_sample, max_parallel
 
@@ -203,6 +432,21 @@ def estimate_memory_requirements(num_samples, tool="humann3"):
         # Generic estimate if tool is unrecognized
         return 4000 + (1000 * num_samples)
 
+def estimate_sample_memory(tool="humann3"):
+    """
+    Projected peak memory of a single sample's run of a tool.
+    
+    Parallel samples run as separate processes, so each one pays the tool's
+    base cost rather than sharing it.
+    
+    Args:
+        tool: Tool name ("kneaddata" or "humann3").
+        
+    Returns:
+        Estimated memory in MB for one sample.
+    """
+    return estimate_memory_requirements(1, tool)
+
 def check_resource_availability(required_memory, required_threads):
     """
     Check if the system has enough memory and CPU threads available.
@@ -0,0 +1,226 @@
+# humann3_tools/utils/run_history.py
+"""
+Run history database and runtime/memory predictor for the schedulers.
+
+Every per-sample resource record the parallel runners produce (see
+resource_utils.resource_record) is also stored in a local SQLite database,
+by default ~/.humann3_tools/run_history.sqlite (HUMANN3_TOOLS_RUN_DB overrides
+the location). RunPredictor fits wall time and peak memory against input size
+per tool from that history, so the schedulers can start the longest samples
+first and admit samples by their own projected memory instead of a flat
+per-tool estimate.
+"""
+import os
+import zlib
+import sqlite3
+import logging
+
+import numpy as np
+
+RUN_DB_ENV = "HUMANN3_TOOLS_RUN_DB"
+DEFAULT_RUN_DB = os.path.join(os.path.expanduser("~"), ".humann3_tools", "run_history.sqlite")
+
+# Fewest completed runs of a tool before sizes are fitted (fewer: median of the history)
+MIN_FIT_RUNS = 5
+# Most recent runs of a tool used for fitting
+MAX_FIT_RUNS = 500
+# Quantile of the memory residuals added to a fitted estimate, so few samples overshoot
+MEMORY_RESIDUAL_QUANTILE = 0.9
+# Bytes of a FASTQ file read to estimate its read count
+READ_COUNT_SAMPLE_BYTES = 1 << 20
+
+COLUMNS = ("sample_id", "tool", "status", "finished", "threads", "input_bytes", "read_count",
+           "memory_estimate_mb", "attempt", "wall_seconds", "peak_rss_mb", "cpu_seconds",
+           "read_bytes", "write_bytes", "peak_processes")
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sample_id TEXT, tool TEXT, status TEXT, finished TEXT, threads INTEGER,
+    input_bytes INTEGER, read_count INTEGER, memory_estimate_mb REAL, attempt INTEGER,
+    wall_seconds REAL, peak_rss_mb REAL, cpu_seconds REAL, read_bytes INTEGER,
+    write_bytes INTEGER, peak_processes INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_tool ON runs (tool, status);
+"""
+
+def run_db_path(path=None):
+    """Location of the run history database."""
+    return path or os.environ.get(RUN_DB_ENV) or DEFAULT_RUN_DB
+
+def _connect(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
+
+def estimate_read_count(fastq_file):
+    """
+    Estimate the number of reads in a (possibly gzipped) FASTQ file.
+    
+    Counts the records in the first megabyte and scales by the file size, using
+    the compressed bytes consumed for gzip files.
+    
+    Returns:
+        Estimated read count, or None if the file could not be read
+    """
+    try:
+        size = os.path.getsize(fastq_file)
+        with open(fastq_file, 'rb') as raw:
+            if raw.read(2) == b"\x1f\x8b":
+                raw.seek(0)
+                # Decompress only as far as needed, counting the compressed bytes used
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                chunk = b""
+                consumed = 0
+                while len(chunk) < READ_COUNT_SAMPLE_BYTES:
+                    block = raw.read(1 << 16)
+                    if not block:
+                        break
+                    chunk += decompressor.decompress(block, READ_COUNT_SAMPLE_BYTES - len(chunk))
+                    consumed += len(block) - len(decompressor.unconsumed_tail)
+            else:
+                raw.seek(0)
+                chunk = raw.read(READ_COUNT_SAMPLE_BYTES)
+                consumed = len(chunk)
+    except (OSError, zlib.error):
+        return None
+    if not chunk or not consumed:
+        return 0
+    records = chunk.count(b"\n") / 4
+    return int(round(records * size / consumed))
+
+def record_runs(records, path=None, logger=None):
+    """
+    Store resource records in the run history database.
+    
+    Args:
+        records: Iterable of record dictionaries (see resource_utils.resource_record)
+        path: Database file (default: run_db_path())
+        logger: Logger instance
+    
+    Returns:
+        Number of records stored
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    rows = [tuple(record.get(column) for column in COLUMNS) for record in records]
+    if not rows:
+        return 0
+    try:
+        connection = _connect(run_db_path(path))
+        try:
+            with connection:
+                connection.executemany(
+                    f"INSERT INTO runs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows
+                )
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not store run history in {run_db_path(path)}: {str(e)}")
+        return 0
+    return len(rows)
+
+def load_runs(tool, path=None, limit=MAX_FIT_RUNS):
+    """
+    Most recent completed runs of a tool.
+    
+    Returns:
+        List of record dictionaries, newest first
+    """
+    path = run_db_path(path)
+    if not os.path.isfile(path):
+        return []
+    try:
+        connection = _connect(path)
+        try:
+            cursor = connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM runs WHERE tool = ? AND status = 'completed' "
+                f"ORDER BY id DESC LIMIT ?", (tool, limit)
+            )
+            return [dict(zip(COLUMNS, row)) for row in cursor.fetchall()]
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return []
+
+def sample_input_bytes(sample_tuple):
+    """Total size of the existing input files of a sample tuple (sample_id, file, ...)."""
+    total = 0
+    for path in sample_tuple[1:]:
+        if isinstance(path, str) and os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total
+
+class RunPredictor:
+    """
+    Wall-time and peak-memory predictions for one tool, fitted on its run history.
+    
+    With at least MIN_FIT_RUNS completed runs, both are fitted as a linear
+    function of input size (wall time only on runs with the same thread count
+    when there are enough of them); memory gets the 90th percentile residual on
+    top so that most samples stay below their estimate. With fewer runs the
+    history median is used, and without history the default memory and no
+    runtime (so the schedulers fall back to ordering by memory).
+    
+    Attributes:
+        tool: Tool name as recorded in the history ("humann", "kneaddata", ...)
+        default_memory: Memory in MB predicted without history
+        runs: Number of history runs the predictions are based on
+    """
+    
+    def __init__(self, tool, runs, threads=None, default_memory=None):
+        self.tool = tool
+        self.default_memory = default_memory
+        self.runs = len(runs)
+        self._memory = self._fit(runs, "peak_rss_mb", MEMORY_RESIDUAL_QUANTILE)
+        same_threads = [run for run in runs if run.get("threads") == threads]
+        self._runtime = self._fit(same_threads if len(same_threads) >= MIN_FIT_RUNS else runs,
+                                  "wall_seconds", None)
+    
+    @classmethod
+    def from_history(cls, tool, threads=None, default_memory=None, path=None, logger=None):
+        """Predictor fitted on the run history database."""
+        if logger is None:
+            logger = logging.getLogger('humann3_analysis')
+        predictor = cls(tool, load_runs(tool, path=path), threads=threads, default_memory=default_memory)
+        if predictor.runs:
+            logger.info(f"Predicting {tool} runtime and memory from {predictor.runs} earlier runs")
+        return predictor
+    
+    @staticmethod
+    def _fit(runs, field, residual_quantile):
+        """(slope, intercept, margin) of field against input size, or None without data."""
+        points = [(run.get("input_bytes") or 0, run[field]) for run in runs if run.get(field) is not None]
+        if not points:
+            return None
+        sizes = np.array([size for size, _ in points], dtype=float)
+        values = np.array([value for _, value in points], dtype=float)
+        if len(points) < MIN_FIT_RUNS or np.ptp(sizes) == 0:
+            return 0.0, float(np.median(values)), 0.0
+        slope, intercept = np.polyfit(sizes, values, 1)
+        slope = max(float(slope), 0.0)
+        intercept = float(intercept) if slope > 0 else float(np.median(values))
+        margin = 0.0
+        if residual_quantile is not None:
+            residuals = values - (slope * sizes + intercept)
+            margin = max(float(np.quantile(residuals, residual_quantile)), 0.0)
+        return slope, intercept, margin
+    
+    @staticmethod
+    def _predict(fit, input_bytes):
+        slope, intercept, margin = fit
+        return max(slope * input_bytes + intercept + margin, 0.0)
+    
+    def predict_memory(self, sample_tuple):
+        """Projected peak memory in MB of a sample tuple (usable as memory_per_sample)."""
+        if self._memory is None:
+            return self.default_memory
+        return self._predict(self._memory, sample_input_bytes(sample_tuple))
+    
+    def predict_runtime(self, sample_tuple):
+        """Projected wall time in seconds of a sample tuple, or None without history."""
+        if self._runtime is None:
+            return None
+        return self._predict(self._runtime, sample_input_bytes(sample_tuple))
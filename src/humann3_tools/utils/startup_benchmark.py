@@ -0,0 +1,136 @@
+# humann3_tools/utils/startup_benchmark.py
+"""
+Start-up benchmark for the command-line entry points.
+
+Each entry point is started in a fresh interpreter with -X importtime. The
+benchmark reports its wall time and fails if a command imports a heavy library
+it does not need at start-up (matplotlib, seaborn, sklearn, statsmodels,
+scikit-posthocs, scipy.stats) or takes longer than its time budget. Run it
+after changing imports to catch start-up regressions:
+
+  python -m src.humann3_tools.utils.startup_benchmark [--repeat 5] [--json startup.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+HEAVY_MODULES = ("matplotlib", "seaborn", "sklearn", "statsmodels", "scikit_posthocs", "scipy.stats")
+# Wall-time budget (seconds) of the commands that must not load heavy modules
+DEFAULT_BUDGET_SECONDS = 1.0
+
+# (name, interpreter arguments, heavy modules the command may import, time budget)
+STARTUP_TARGETS = [
+    ("humann3-tools --help", ["-m", "src.humann3_tools.cli.main_cli", "--help"], (), DEFAULT_BUDGET_SECONDS),
+    ("import src.humann3_tools", ["-c", "import src.humann3_tools"], (), DEFAULT_BUDGET_SECONDS),
+    ("humann3-kneaddata", ["-c", "import src.humann3_tools.cli.kneaddata_cli"], (), DEFAULT_BUDGET_SECONDS),
+    ("humann3-humann3", ["-c", "import src.humann3_tools.cli.humann3_cli"], (), DEFAULT_BUDGET_SECONDS),
+    ("humann3-join", ["-c", "import src.humann3_tools.cli.join_cli"], (), DEFAULT_BUDGET_SECONDS),
+    ("humann3-stats", ["-c", "import src.humann3_tools.cli.stats_cli"], HEAVY_MODULES, None),
+    ("humann3-diff", ["-c", "import src.humann3_tools.cli.diff_cli"], HEAVY_MODULES, None),
+    ("humann3-viz", ["-c", "import src.humann3_tools.cli.viz_cli"], HEAVY_MODULES, None),
+]
+
+# Directory containing the src package
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+
+def _parse_importtime(stderr):
+    """(module, cumulative microseconds) of every import in -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(cumulative)))
+    return imports
+
+def _is_heavy(module, heavy_modules):
+    return any(module == heavy or module.startswith(heavy + ".") for heavy in heavy_modules)
+
+def measure_startup(args, repeat=3, python=sys.executable):
+    """
+    Start a command in fresh interpreters and record its imports.
+    
+    Args:
+        args: Interpreter arguments (e.g. ["-c", "import module"])
+        repeat: Number of runs; the fastest is reported
+        python: Interpreter to run
+    
+    Returns:
+        Dictionary with the best wall time, exit code and the imports of the last run
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        process = subprocess.run([python, "-X", "importtime"] + args, cwd=REPO_ROOT, env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return {"seconds": best, "returncode": process.returncode, "imports": _parse_importtime(process.stderr)}
+
+def run_benchmark(targets=STARTUP_TARGETS, repeat=3, budget_scale=1.0):
+    """
+    Benchmark every start-up target.
+    
+    Args:
+        targets: List of (name, interpreter arguments, allowed heavy modules, budget)
+        repeat: Runs per target
+        budget_scale: Factor applied to every time budget (for slow machines)
+    
+    Returns:
+        List of result dictionaries with a "failures" list each
+    """
+    results = []
+    for name, args, allowed, budget in targets:
+        measured = measure_startup(args, repeat=repeat)
+        forbidden = tuple(heavy for heavy in HEAVY_MODULES if heavy not in allowed)
+        heavy_imported = [heavy for heavy in forbidden
+                          if any(_is_heavy(module, (heavy,)) for module, _ in measured["imports"])]
+        failures = []
+        if measured["returncode"] != 0:
+            failures.append(f"exit code {measured['returncode']}")
+        if heavy_imported:
+            failures.append(f"imports {', '.join(heavy_imported)}")
+        if budget is not None and measured["seconds"] > budget * budget_scale:
+            failures.append(f"slower than {budget * budget_scale:.2f}s")
+        slowest = sorted(measured["imports"], key=lambda item: item[1], reverse=True)[:5]
+        results.append({
+            "name": name,
+            "seconds": round(measured["seconds"], 3),
+            "modules": len(measured["imports"]),
+            "slowest_imports": [{"module": module, "seconds": round(us / 1e6, 3)} for module, us in slowest],
+            "failures": failures,
+        })
+    return results
+
+def main():
+    """Run the start-up benchmark; exit code 1 on a regression."""
+    parser = argparse.ArgumentParser(description="Start-up benchmark for the humann3_tools commands")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per command; the fastest counts (default: 3)")
+    parser.add_argument("--budget-scale", type=float, default=1.0,
+                        help="Scale the time budgets, e.g. 2 on slow shared file systems (default: 1)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    
+    results = run_benchmark(repeat=args.repeat, budget_scale=args.budget_scale)
+    
+    width = max(len(result["name"]) for result in results)
+    for result in results:
+        status = "FAIL: " + "; ".join(result["failures"]) if result["failures"] else "ok"
+        print(f"{result['name']:<{width}}  {result['seconds']:7.3f}s  {result['modules']:5d} modules  {status}")
+        if result["failures"]:
+            slowest = ", ".join(f"{item['module']} {item['seconds']:.2f}s" for item in result["slowest_imports"])
+            print(f"{'':<{width}}  slowest imports: {slowest}")
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    
+    return 1 if any(result["failures"] for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
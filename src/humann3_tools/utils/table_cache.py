@@ -0,0 +1,216 @@
+# humann3_tools/utils/table_cache.py
+"""
+Columnar sidecar cache for joined abundance tables.
+
+Next to a table such as pathway_abundance_cpm_unstratified.tsv the join stage
+writes a directory pathway_abundance_cpm_unstratified.tsv.cache/ holding:
+- values.npy: the features x samples matrix as float64 in column-major order,
+  so it can be memory-mapped and single samples read without touching the rest
+- features.txt: one feature ID per line
+- meta.json: sample names, the feature column name and a fingerprint of the TSV
+
+Loaders use the sidecar only while the TSV's size, mtime and fingerprint still
+match; otherwise they fall back to parsing the TSV.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+CACHE_SUFFIX = ".cache"
+CACHE_VERSION = 1
+FINGERPRINT_BYTES = 1 << 20
+
+def cache_path(table_path):
+    """Path of the sidecar directory for a table."""
+    return table_path + CACHE_SUFFIX
+
+def table_fingerprint(table_path):
+    """
+    Identify the current contents of a table without reading all of it.
+    
+    Hashes the file size with its first and last megabyte, so checking a
+    multi-GB table stays cheap.
+    
+    Returns:
+        Dictionary with size, mtime_ns and hash
+    """
+    stat = os.stat(table_path)
+    digest = hashlib.blake2b(str(stat.st_size).encode("utf-8"), digest_size=16)
+    with open(table_path, "rb") as fh:
+        digest.update(fh.read(FINGERPRINT_BYTES))
+        if stat.st_size > 2 * FINGERPRINT_BYTES:
+            fh.seek(-FINGERPRINT_BYTES, os.SEEK_END)
+            digest.update(fh.read(FINGERPRINT_BYTES))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+def write_table_cache(table_path, df=None, logger=None):
+    """
+    Write the columnar sidecar for a tab-delimited abundance table.
+    
+    Args:
+        table_path: Path to the TSV table (features as rows, first column as index)
+        df: The table if already loaded (default: read table_path)
+        logger: Logger instance
+    
+    Returns:
+        Path to the sidecar directory, or None if the table could not be cached
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    try:
+        fingerprint = table_fingerprint(table_path)
+        if df is None:
+            df = pd.read_csv(table_path, sep='\t', index_col=0)
+        
+        try:
+            values = np.asfortranarray(df.to_numpy(dtype=np.float64))
+        except (TypeError, ValueError):
+            logger.warning(f"Table has non-numeric values, not caching: {table_path}")
+            return None
+        
+        target = cache_path(table_path)
+        tmp_dir = target + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            np.save(os.path.join(tmp_dir, "values.npy"), values)
+            with open(os.path.join(tmp_dir, "features.txt"), "w") as fh:
+                for feature in df.index:
+                    fh.write(f"{feature}\n")
+            meta = {
+                "version": CACHE_VERSION,
+                "index_name": df.index.name,
+                "columns": [str(col) for col in df.columns],
+                "source": fingerprint,
+            }
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as fh:
+                json.dump(meta, fh)
+            # Replace any previous sidecar in one step so readers never see a partial one
+            shutil.rmtree(target, ignore_errors=True)
+            os.rename(tmp_dir, target)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        
+        # The table may have changed while it was read; only keep a cache of what was read
+        if table_fingerprint(table_path) != fingerprint:
+            shutil.rmtree(target, ignore_errors=True)
+            logger.warning(f"Table changed while caching, removed sidecar: {table_path}")
+            return None
+        
+        logger.info(f"Wrote columnar cache for {os.path.basename(table_path)} "
+                    f"({values.shape[0]} features x {values.shape[1]} samples)")
+        return target
+    except Exception as e:
+        logger.warning(f"Could not write columnar cache for {table_path}: {str(e)}")
+        return None
+
+def _load_cache(table_path, logger):
+    """Return (meta, sidecar directory) for a valid sidecar, or None."""
+    target = cache_path(table_path)
+    meta_file = os.path.join(target, "meta.json")
+    if not os.path.isfile(meta_file):
+        return None
+    try:
+        with open(meta_file) as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    
+    source = meta.get("source", {})
+    stat = os.stat(table_path)
+    if source.get("size") != stat.st_size or source.get("mtime_ns") != stat.st_mtime_ns:
+        logger.debug(f"Cache is stale for {table_path}")
+        return None
+    if source.get("hash") != table_fingerprint(table_path)["hash"]:
+        logger.debug(f"Cache fingerprint does not match {table_path}")
+        return None
+    return meta, target
+
+def read_table_cache(table_path, columns=None, logger=None):
+    """
+    Load a table from its sidecar if the sidecar is current.
+    
+    Args:
+        table_path: Path to the TSV table
+        columns: Optional list of sample columns to read (others are never loaded)
+        logger: Logger instance
+    
+    Returns:
+        Tuple of (values, features, columns, index_name) with values a (possibly
+        memory-mapped) features x columns array, or None if there is no valid cache
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    cached = _load_cache(table_path, logger)
+    if cached is None:
+        return None
+    meta, target = cached
+    
+    values = np.load(os.path.join(target, "values.npy"), mmap_mode="r")
+    with open(os.path.join(target, "features.txt")) as fh:
+        features = pd.Index([line.rstrip("\n") for line in fh])
+    all_columns = pd.Index(meta["columns"])
+    if values.shape != (len(features), len(all_columns)):
+        logger.warning(f"Ignoring malformed cache for {table_path}")
+        return None
+    
+    if columns is not None:
+        positions = all_columns.get_indexer(pd.Index(columns))
+        if (positions < 0).any():
+            missing = list(pd.Index(columns)[positions < 0][:5])
+            raise KeyError(f"Columns not found in {table_path}: {missing}")
+        # Column-major storage makes each selected sample a contiguous read
+        values = values[:, positions]
+        all_columns = all_columns[positions]
+    
+    return values, features, all_columns, meta.get("index_name")
+
+def read_abundance_table(table_path, columns=None, use_cache=True, logger=None):
+    """
+    Read a tab-delimited abundance table, using its columnar sidecar when current.
+    
+    Args:
+        table_path: Path to the TSV table (features as rows, first column as index)
+        columns: Optional list of sample columns to read
+        use_cache: Use the sidecar if it matches the table
+        logger: Logger instance
+    
+    Returns:
+        DataFrame of features x samples
+    """
+    if logger is None:
+        logger = logging.getLogger('humann3_analysis')
+    
+    cached = read_table_cache(table_path, columns=columns, logger=logger) if use_cache else None
+    if cached is not None:
+        values, features, sample_columns, index_name = cached
+        df = pd.DataFrame(np.array(values), index=features, columns=sample_columns)
+        df.index.name = index_name
+        logger.debug(f"Loaded {table_path} from columnar cache")
+        return df
+    
+    if columns is None:
+        return pd.read_csv(table_path, sep='\t', index_col=0)
+    
+    # Only parse the feature column and the requested sample columns
+    header = pd.read_csv(table_path, sep='\t', nrows=0).columns
+    df = pd.read_csv(table_path, sep='\t', index_col=0, usecols=[header[0]] + list(columns))
+    return df[list(columns)]
+
+def write_table_caches(table_paths, logger=None):
+    """
+    Write sidecars for several tables, skipping any that cannot be cached.
+    
+    Returns:
+        Dictionary mapping each table to its sidecar directory (or None)
+    """
+    return {path: write_table_cache(path, logger=logger) for path in table_paths if path}